@@ -7,8 +7,16 @@ precise, otherwise the geolocation will be inaccurate
 This uses Python 2.7/3.x and OpenCV2
 
 Use "sudo apt-get install opencv-python" to install OpenCV2
+
+With --shm the frames are also passed to camera_air through a shared
+memory ring (set camera_air's shmring to the same path), and the
+images are written to disk in the background
 '''
-import time, cv2, os
+import time, cv2, os, threading, argparse
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
 def frame_time(t):
     '''return a time string for a filename with 0.01 sec resolution'''
@@ -17,7 +25,47 @@ def frame_time(t):
     hundredths = int(t * 100.0) % 100
     return "%s%02uZ" % (time.strftime("%Y%m%d%H%M%S", time.gmtime(t)), hundredths)
 
+def restart_interval(width, mcu_size=16, tile_mcus=8):
+    '''return the largest JPEG restart interval up to tile_mcus that evenly
+    divides a row of MCUs, as in cuav_jpeg.restart_interval'''
+    mcus_x = (width + mcu_size - 1) // mcu_size
+    for n in range(min(tile_mcus, mcus_x), 0, -1):
+        if mcus_x % n == 0:
+            return n
+
+def save_threadfunc(save_queue):
+    '''write images to disk and update the symlink'''
+    while True:
+        (frametime, image) = save_queue.get()
+        save_image(frametime, image)
+
+def save_image(frametime, image):
+    '''write an image to file and symlink to it'''
+    # restart markers every few MCUs let camera_air decode just the
+    # parts of the image it needs for thumbnails
+    cv2.imwrite(frametime + '.jpg', image, [cv2.IMWRITE_JPEG_RST_INTERVAL, restart_interval(image.shape[1])])
+
+    #Symlink to the latest-written image for cuav processing
+    try:
+        os.unlink('camera.jpg')
+    except OSError:
+        pass
+    os.symlink(frametime + '.jpg', 'camera.jpg')
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser("captureWebcam.py [options]")
+    parser.add_argument("--shm", default=None, help="shared memory frame ring to write to, eg /dev/shm/cuav_ring")
+    args = parser.parse_args()
+
+    ring = None
+    if args.shm:
+        from cuav.lib import cuav_shmring
+        ring = cuav_shmring.FrameRingWriter(args.shm, slot_size=1280*720*3)
+        save_queue = Queue()
+        save_thread = threading.Thread(target=save_threadfunc, args=(save_queue,))
+        save_thread.daemon = True
+        save_thread.start()
+
     #Open the default camera on the system
     camera = cv2.VideoCapture(0)
 
@@ -33,18 +81,16 @@ if __name__ == '__main__':
         while True:
             #grab the image and get timestamp
             camera.grab()
-            frametime = frame_time(time.time())
+            t = time.time()
+            frametime = frame_time(t)
             
-            #Get the grabbed image from the device and write to file as png
+            #Get the grabbed image from the device and write to file as jpg
             return_value, image = camera.retrieve()
-            cv2.imwrite(frametime + '.jpg', image)
-            
-            #Symlink to the latest-written image for cuav processing
-            try:
-                os.unlink('camera.jpg')
-            except OSError:
-                pass
-            os.symlink(frametime + '.jpg', 'camera.jpg')
+            if ring is not None:
+                ring.write(t, image, os.path.realpath(frametime + '.jpg'))
+                save_queue.put((frametime, image))
+            else:
+                save_image(frametime, image)
             print("Got: " + frametime + '.jpg')
             
             time.sleep(1)
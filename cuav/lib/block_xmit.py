@@ -3,7 +3,7 @@
 a module for reliable block data sending over UDP
 
 NOTE: This module should only be used on private networks - it takes
-no account of network congestion.
+no account of network congestion, unless adaptive pacing is enabled.
 
 The protocol is designed to work well with large amounts of packet loss, while
 using a fixed maximum bandwidth. The actual send bandwidth scales closely
@@ -19,16 +19,46 @@ May 2012
 released under the GNU GPL v3 or later
 '''
 
-import socket, select, os, random, time, random, struct, binascii
+import socket, select, os, random, time, random, struct, binascii, re, bisect, collections, errno, zlib
+from cuav.lib import cuav_mmsg
 
 # packet types - first byte of a packet
 PKT_ACK = 0
 PKT_COMPLETE = 1
 PKT_CHUNK = 2
+PKT_PARITY = 3
+PKT_FEATURES = 4
+PKT_FLAGGED_CHUNK = 5
+PKT_FLAGGED_PARITY = 6
+PKT_ACKS = 7
+
+# block flags. Blocks with flags are sent as flagged chunk and parity
+# packets, which carry the flags after the header, and only to peers
+# that have said in a PKT_FEATURES that they understand them
+FLAG_ZLIB = 1
+SUPPORTED_FLAGS = FLAG_ZLIB
+
+# features that are not block flags. A peer with FEATURE_ACKS accepts
+# several acks coalesced into one PKT_ACKS packet
+FEATURE_ACKS = 0x80
+FEATURES = SUPPORTED_FLAGS | FEATURE_ACKS
+
+# largest PKT_ACKS packet when there is no mss, and the UDP/IP overhead of
+# a packet, used to count the bytes coalescing saves
+ACKS_MAX_SIZE = 1400
+UDP_OVERHEAD = 28
 
 # size of packet type plus crc32
 PACKET_HEADER_SIZE = 5
 
+# a run of received chunks in a BlockSenderSet bitmap
+EXTENT_RE = re.compile('1+')
+
+# fec setting to choose the parity group size from the measured efficiency,
+# and the largest group size it will choose
+FEC_AUTO = -1
+FEC_MAX_GROUP = 16
+
 class BlockSenderException(Exception):
 	'''block sender error class'''
 	def __init__(self, msg):
@@ -38,11 +68,17 @@ class BlockSenderException(Exception):
 class BlockSenderSet:
 	'''hold a set of chunk IDs for an identifier.
 	This object is sent as a PKT_ACK to
-	acknowledge receipt of data'''
+	acknowledge receipt of data
+
+	The chunk IDs are kept as a bitmap in a python integer, bit n
+	being set when chunk n has been received, so merging sets and
+	checking for completion work a machine word at a time'''
 	def __init__(self, id, num_chunks, mss):
 		self.id = id
 		self.num_chunks = num_chunks
-		self.chunks = set()
+		self.bits = 0
+		self.count = 0
+		self.all_bits = (1 << num_chunks) - 1
 		self.timestamp = 0
 		self.format = '<QHd'
 		self.header_size = struct.calcsize(self.format)
@@ -52,53 +88,56 @@ class BlockSenderSet:
                 #print("Created %s" % str(self))
 
 	def __str__(self):
-		return 'BlockSenderSet<%u/%u>' % (len(self.chunks), self.num_chunks)
+		return 'BlockSenderSet<%u/%u>' % (self.count, self.num_chunks)
 
 	def update_first_missing(self):
 		'''update the first_missing field'''
-		while self.first_missing < self.num_chunks:
-			if not self.first_missing in self.chunks:
-				break
-			self.first_missing += 1
+		if self.first_missing >= self.num_chunks:
+			return
+		# find the lowest clear bit at or above first_missing
+		bits = self.bits >> self.first_missing
+		self.first_missing += ((~bits) & (bits+1)).bit_length() - 1
+		self.first_missing = min(self.first_missing, self.num_chunks)
 
 	def add(self, chunk_id, ack_to):
 		'''add an extent to the list. This is called when we receive a chunk of data'''
-		self.chunks.add(chunk_id)
+		bit = 1 << chunk_id
+		if not self.bits & bit:
+			self.bits |= bit
+			self.count += 1
 		self.first_missing = ack_to
 
 	def update(self, new):
 		'''add in new chunks. This is called when we receive an ack packet'''
-		self.chunks.update(new.chunks)
+		bits = self.bits | (new.bits & self.all_bits)
+		if bits != self.bits:
+			self.bits = bits
+			self.count = bin(bits).count('1')
 		self.update_first_missing()
 
 	def present(self, chunk_id):
 		'''see if a chunk_id is present in the chunks'''
-		return chunk_id in self.chunks
+		return (self.bits >> chunk_id) & 1 == 1
 
 	def complete(self):
 		'''return True if the chunks cover the whole set of data'''
-		return len(self.chunks) == self.num_chunks
+		return self.bits == self.all_bits
 
 	def started(self):
 		'''return True if we have at least one chunk'''
-		return len(self.chunks) > 0
+		return self.bits != 0
+
+	def extents(self, start=0):
+		'''return a list of (first, count) extents of the chunks from start'''
+		bits = self.bits >> start
+		if bits == 0:
+			return []
+		# bit n of the integer is character n of the reversed binary string
+		return [(start + m.start(), m.end() - m.start()) for m in EXTENT_RE.finditer(bin(bits)[:1:-1])]
 
 	def pack(self):
 		'''return a linearized representation'''
-		chunks = list(self.chunks)
-		chunks.sort()
-		extents = []
-		for i in range(len(chunks)):
-			if chunks[i] < self.first_missing:
-				continue
-			if len(extents) == 0:
-				extents.append((chunks[i], 1))
-				continue
-			(first,count) = extents[-1]
-			if chunks[i] == first+count:
-				extents[-1] = (first, count+1)
-			else:
-				extents.append((chunks[i], 1))
+		extents = self.extents(self.first_missing)
 		buf = bytes(struct.pack(self.format, self.id, self.num_chunks, self.timestamp))
 		if self.mss:
 			max_extents = (self.mss - (len(buf) + PACKET_HEADER_SIZE)) / 2
@@ -110,13 +149,18 @@ class BlockSenderSet:
 					if first > self.last_sent:
 						break
 					extents.pop(0)
+		# send as many extents as fit, always sending at least one
+		count = len(extents)
 		sent_all = True
-		for (first,count) in extents:
-			buf += bytes(struct.pack('<HH', first, count))
-			self.last_sent = first
-			if self.mss and (len(buf)+PACKET_HEADER_SIZE) + 4 > self.mss:
+		if self.mss:
+			limit = max(1, (self.mss - (len(buf) + PACKET_HEADER_SIZE + 4)) // 4 + 1)
+			if limit <= count:
+				count = limit
 				sent_all = False
-				break
+		if count > 0:
+			values = [v for extent in extents[:count] for v in extent]
+			buf += bytes(struct.pack('<%uH' % len(values), *values))
+			self.last_sent = extents[count-1][0]
 		if sent_all:
 			self.last_sent = 0
 		return buf
@@ -126,15 +170,18 @@ class BlockSenderSet:
 		if len(buf) < self.header_size:
 			raise BlockSenderException('buffer too short')
 		(self.id, self.num_chunks, self.timestamp) = struct.unpack_from(self.format, buf)
+		self.all_bits = (1 << self.num_chunks) - 1
 		ofs = self.header_size
 		if (len(buf) - ofs) % 4 != 0:
 			raise BlockSenderException('invalid extents length')
 		n = (len(buf) - ofs) // 4
-		for i in range(n):
-			(first, count) = struct.unpack_from('<HH', buf, ofs)
-			ofs += 4
-			for j in range(first, first+count):
-				self.chunks.add(j)
+		values = struct.unpack_from('<' + 'HH'*n, buf, ofs)
+		bits = self.bits
+		for i in range(0, 2*n, 2):
+			(first, count) = values[i:i+2]
+			bits |= ((1 << count) - 1) << first
+		self.bits = bits & self.all_bits
+		self.count = bin(self.bits).count('1')
 
 
 class BlockSenderComplete:
@@ -158,9 +205,67 @@ class BlockSenderComplete:
 		(self.blockid, self.timestamp) = struct.unpack('<Qd', buf)
 
 
+class BlockSenderAcks:
+	'''several PKT_ACK and PKT_COMPLETE payloads sent as one packet, each
+	preceded by its packet type and length'''
+	def __init__(self):
+		self.acks = []
+
+	def __str__(self):
+		return 'BlockSenderAcks<%u>' % len(self.acks)
+
+	def pack(self):
+		'''return a linearized representation'''
+		parts = []
+		for (type, buf) in self.acks:
+			parts.append(struct.pack('<BH', type, len(buf)))
+			parts.append(buf)
+		return bytes(''.join(parts))
+
+	def unpack(self, buf):
+		'''unpack a linearized representation into a list of BlockSenderSet
+		and BlockSenderComplete objects'''
+		self.acks = []
+		ofs = 0
+		while ofs < len(buf):
+			(type, length) = struct.unpack_from('<BH', buf, ofs)
+			ofs += 3
+			if ofs + length > len(buf):
+				raise BlockSenderException('ack length too long')
+			if type == PKT_ACK:
+				obj = BlockSenderSet(0,0,0)
+			elif type == PKT_COMPLETE:
+				obj = BlockSenderComplete(0, None, None)
+			else:
+				raise BlockSenderException('bad ack type %u' % type)
+			obj.unpack(buf[ofs:ofs+length])
+			self.acks.append(obj)
+			ofs += length
+
+
+class BlockSenderFeatures:
+	'''a packet telling a peer which block flags and features we understand'''
+	def __init__(self, flags):
+		self.flags = flags
+
+	def __str__(self):
+		return 'BlockSenderFeatures<%u>' % self.flags
+
+	def pack(self):
+		'''return a linearized representation'''
+		return bytes(struct.pack('<B', self.flags))
+
+	def unpack(self, buf):
+		'''unpack a linearized representation into the object'''
+		(self.flags,) = struct.unpack('<B', buf)
+
+
 class BlockSenderChunk:
-	'''an incoming chunk packet. This is the main data format'''
-	def __init__(self, blockid, size, chunk_id, data, chunk_size, ack_to, timestamp):
+	'''an incoming chunk packet. This is the main data format. Chunks of
+	blocks with flags have the flags after the header'''
+	FORMAT = '<QLHHHd'
+
+	def __init__(self, blockid, size, chunk_id, data, chunk_size, ack_to, timestamp, flags=0):
 		self.blockid = blockid
 		self.size = size
 		self.chunk_id = chunk_id
@@ -168,8 +273,8 @@ class BlockSenderChunk:
 		self.data = data
 		self.ack_to = ack_to
 		self.timestamp = timestamp
-		self.format = '<QLHHHd'
-		self.header_size = struct.calcsize(self.format)
+		self.flags = flags
+		self.set_format(flags != 0)
 		if data is not None:
 			self.packed_size = len(data) + self.header_size
 		else:
@@ -179,25 +284,87 @@ class BlockSenderChunk:
 	def __str__(self):
 		return 'BlockSenderChunk<%u,%u,%u,%u>' % (self.blockid, self.chunk_id, self.size, self.chunk_size)
 
+	def set_format(self, flagged):
+		'''set the header format, with or without the flags'''
+		self.format = self.FORMAT
+		if flagged:
+			self.format += 'B'
+		self.header_size = struct.calcsize(self.format)
+
+	def header_values(self):
+		'''return the values in the header, without the flags'''
+		return (self.blockid, self.size, self.chunk_id, self.chunk_size, self.ack_to, self.timestamp)
+
+	def pack_header(self):
+		'''return a linearized representation of the chunk header. The
+		data follows it in a packet'''
+		values = self.header_values()
+		if self.flags:
+			values += (self.flags,)
+		return struct.pack(self.format, *values)
+
 	def pack(self):
 		'''return a linearized representation'''        
-		buf = bytes(struct.pack(self.format, self.blockid, self.size, self.chunk_id,
-					    self.chunk_size, self.ack_to, self.timestamp))
-		buf += bytes(self.data)
-		return buf
+		data = self.data
+		if isinstance(data, memoryview):
+			data = data.tobytes()
+		return self.pack_header() + bytes(data)
+
+	def unpack(self, buf, flagged=False):
+		'''unpack a linearized representation into the object. The data
+		is a slice of buf, so a memoryview buf is not copied'''
+		self.set_format(flagged)
+		values = struct.unpack_from(self.format, buf, offset=0)
+		(self.blockid, self.size,
+		 self.chunk_id, self.chunk_size, self.ack_to, self.timestamp) = values[:6]
+		if flagged:
+			self.flags = values[6]
+		self.data = buf[self.header_size:]
 
-	def unpack(self, buf):
+
+class BlockSenderParity(BlockSenderChunk):
+	'''a parity packet, the XOR of a group of chunks of a block, each
+	padded with zeros to the chunk size. The group is the count chunks
+	starting at chunk_id'''
+	FORMAT = '<QLHHHdH'
+
+	def __init__(self, blockid, size, chunk_id, count, data, chunk_size, ack_to, timestamp, flags=0):
+		BlockSenderChunk.__init__(self, blockid, size, chunk_id, data, chunk_size, ack_to, timestamp, flags)
+		self.count = count
+
+	def __str__(self):
+		return 'BlockSenderParity<%u,%u,%u,%u>' % (self.blockid, self.chunk_id, self.count, self.size)
+
+	def header_values(self):
+		'''return the values in the header, without the flags'''
+		return BlockSenderChunk.header_values(self) + (self.count,)
+
+	def unpack(self, buf, flagged=False):
 		'''unpack a linearized representation into the object'''
-		(self.blockid, self.size,
-		 self.chunk_id, self.chunk_size, self.ack_to, self.timestamp) = struct.unpack_from(self.format, buf, offset=0)
-		self.data = bytes(buf[self.header_size:])
+		self.set_format(flagged)
+		values = struct.unpack_from(self.format, buf, offset=0)
+		(self.blockid, self.size, self.chunk_id, self.chunk_size,
+		 self.ack_to, self.timestamp, self.count) = values[:7]
+		if flagged:
+			self.flags = values[7]
+		self.data = buf[self.header_size:]
+
+
+def xor_chunks(chunks, length):
+	'''return the XOR of a list of buffers, each padded with zeros to length'''
+	value = 0
+	for c in chunks:
+		pad = length - len(c)
+		value ^= int(binascii.hexlify(c), 16) << (8*pad) if len(c) else 0
+	return binascii.unhexlify('%0*x' % (2*length, value))
 
 
 class BlockSenderBlock:
 	'''the state of an incoming or outgoing block'''
-	def __init__(self, blockid, size, chunk_size, dest, mss, data=None, callback=None, priority=0):
+	def __init__(self, blockid, size, chunk_size, dest, mss, data=None, callback=None, priority=0, fec=0, flags=0):
 		self.blockid = blockid
 		self.size = size
+		self.flags = flags
 		self.chunk_size = chunk_size
 		self.num_chunks = (self.size + (chunk_size-1)) // chunk_size
 		self.acks = BlockSenderSet(blockid, self.num_chunks, mss)
@@ -205,6 +372,7 @@ class BlockSenderBlock:
 			self.data = bytearray(data)
 		else:
 			self.data = bytearray(size)
+		self.view = memoryview(self.data)
 		self.timestamp = 0
 		self.callback = callback
 		self.dest = dest
@@ -212,20 +380,205 @@ class BlockSenderBlock:
 		self.priority = priority
 		self.sends = 0
 		self.chunk_send_times = {}
+		# chunks per parity group, zero for no parity. Outgoing blocks keep the
+		# groups due a parity packet and those sent, incoming blocks keep
+		# parity packets received until they can be used
+		self.fec = fec
+		self.parity_due = []
+		self.parity_sent = set()
+		self.parity_sends = 0
+		self.parity = {}
                 #print("Created %s" % str(self))
 
 	def __str__(self):
 		return 'BlockSenderBlock<%u,%u,%u,%u>' % (self.blockid,self.size,self.chunk_size,self.num_chunks)
 
 	def chunk(self, chunk_id):
-		'''return data for a chunk'''
+		'''return data for a chunk, as a memoryview of the block data'''
 		start = chunk_id*self.chunk_size
-		return self.data[start:start+self.chunk_size]        
+		return self.view[start:start+self.chunk_size]
 
 	def complete(self):
 		'''return true if all chunks have been sent/received'''
 		return self.acks.complete()
 
+	def group(self, chunk_id):
+		'''return the first chunk and count of the parity group holding a chunk'''
+		first = chunk_id - chunk_id % self.fec
+		return (first, min(self.fec, self.num_chunks - first))
+
+	def parity_data(self, first, count):
+		'''return the parity of a group of chunks'''
+		return xor_chunks([self.chunk(c) for c in range(first, first+count)], self.chunk_size)
+
+
+class BlockSenderQueue:
+	'''the outgoing blocks in send order, indexed by blockid
+
+	Blocks are ordered by priority, highest first, then in the order
+	they were added. Blocks with a priority of zero or less are sent in
+	the order they were added, after all positive priority blocks'''
+	def __init__(self):
+		self.blocks = []
+		self.keys = []
+		self.index = {}
+		self.seq = 0
+
+	def __len__(self):
+		return len(self.blocks)
+
+	def __iter__(self):
+		return iter(self.blocks)
+
+	def __getitem__(self, i):
+		return self.blocks[i]
+
+	def __contains__(self, blockid):
+		return blockid in self.index
+
+	def add(self, blk):
+		'''add a block, after any others of the same or higher priority'''
+		self.seq += 1
+		blk.sort_key = (-max(blk.priority, 0), self.seq)
+		i = bisect.bisect(self.keys, blk.sort_key)
+		self.keys.insert(i, blk.sort_key)
+		self.blocks.insert(i, blk)
+		self.index[blk.blockid] = blk
+
+	def get(self, blockid):
+		'''return the block with a blockid, or None'''
+		return self.index.get(blockid, None)
+
+	def remove(self, blockid):
+		'''remove and return the block with a blockid, or None'''
+		blk = self.index.pop(blockid, None)
+		if blk is None:
+			return None
+		i = bisect.bisect_left(self.keys, blk.sort_key)
+		self.keys.pop(i)
+		self.blocks.pop(i)
+		return blk
+
+
+class BlockSenderPacing:
+	'''a BBR-like estimate of a link's delivery rate and round trip time,
+	from the acks for sent chunks, giving the rate to pace sends at
+
+	The delivery rate is measured over about one round trip, or the
+	min_round a sender takes to send each burst if that is longer, and
+	the bottleneck bandwidth is the highest rate seen over the last
+	bw_rounds round trips. Sending starts by growing the rate by
+	STARTUP_GAIN each round trip until the delivery rate stops rising,
+	drains the queue that built up for a round trip, then cycles through
+	PROBE_GAINS, probing for more bandwidth and draining again in turn.
+
+	max_bandwidth: upper bound on the send rate in bytes/second
+	initial_rate:  send rate until the first measurement (default max_bandwidth/10)
+	min_rate:      lower bound on the send rate (default max_bandwidth/100)
+	bw_rounds:     round trips to keep delivery rate samples for (default 10)
+	min_round:     shortest time to treat as a round trip (default 0.1)
+	'''
+	STARTUP_GAIN = 2.89
+	PROBE_GAINS = [1.25, 0.75, 1, 1, 1, 1, 1, 1]
+
+	def __init__(self, max_bandwidth, initial_rate=None, min_rate=None, bw_rounds=10, min_round=0.1):
+		self.max_bandwidth = max_bandwidth
+		if initial_rate is None:
+			initial_rate = max_bandwidth / 10.0
+		if min_rate is None:
+			min_rate = max_bandwidth / 100.0
+		self.initial_rate = initial_rate
+		self.min_rate = min_rate
+		self.bw_rounds = bw_rounds
+		self.min_round = min_round
+		self.min_rtt_window = 10.0
+		self.delivered = 0
+		self.history = collections.deque()
+		self.bw_samples = collections.deque()
+		self.btl_bw = 0
+		self.min_rtt = None
+		self.min_rtt_time = 0
+		self.state = 'startup'
+		self.gain = self.STARTUP_GAIN
+		self.round_start = 0
+		self.full_bw = 0
+		self.full_bw_rounds = 0
+		self.cycle_index = 0
+
+	def __str__(self):
+		return 'BlockSenderPacing<%s %.0f %.3f>' % (self.state, self.btl_bw, self.round_time())
+
+	def round_time(self):
+		'''return the time taken as one round trip'''
+		if self.min_rtt is None:
+			return self.min_round
+		return max(self.min_rtt, self.min_round)
+
+	def on_rtt(self, rtt, tnow):
+		'''add a round trip time sample'''
+		if rtt <= 0:
+			return
+		if (self.min_rtt is None or rtt <= self.min_rtt or
+		    tnow - self.min_rtt_time > self.min_rtt_window):
+			self.min_rtt = rtt
+			self.min_rtt_time = tnow
+
+	def on_ack(self, nbytes, tnow):
+		'''note that acks have arrived for nbytes of sent data'''
+		self.delivered += nbytes
+		self.history.append((tnow, self.delivered))
+		interval = self.round_time()
+		while len(self.history) > 2 and self.history[1][0] <= tnow - interval:
+			self.history.popleft()
+		(t0, delivered0) = self.history[0]
+		if tnow - t0 > 2 * interval:
+			# the link was idle, so this doesn't measure its capacity
+			self.history.popleft()
+			return
+		if tnow - t0 >= interval / 2:
+			self._add_bw_sample((self.delivered - delivered0) / (tnow - t0), tnow)
+
+	def _add_bw_sample(self, rate, tnow):
+		'''keep a windowed maximum of the delivery rate'''
+		while self.bw_samples and self.bw_samples[-1][1] <= rate:
+			self.bw_samples.pop()
+		self.bw_samples.append((tnow, rate))
+		while self.bw_samples[0][0] < tnow - self.bw_rounds * self.round_time():
+			self.bw_samples.popleft()
+		self.btl_bw = self.bw_samples[0][1]
+
+	def _update_state(self, tnow):
+		'''move on a round trip at a time through the startup, drain and
+		probe states'''
+		if tnow - self.round_start < self.round_time():
+			return
+		self.round_start = tnow
+		if self.state == 'startup':
+			if self.btl_bw >= self.full_bw * 1.25:
+				self.full_bw = self.btl_bw
+				self.full_bw_rounds = 0
+			else:
+				self.full_bw_rounds += 1
+			if self.full_bw_rounds >= 3 or self.btl_bw * self.STARTUP_GAIN > self.max_bandwidth:
+				self.state = 'drain'
+				self.gain = 1.0 / self.STARTUP_GAIN
+		elif self.state == 'drain':
+			self.state = 'probe'
+			self.cycle_index = 0
+			self.gain = self.PROBE_GAINS[0]
+		else:
+			self.cycle_index = (self.cycle_index + 1) % len(self.PROBE_GAINS)
+			self.gain = self.PROBE_GAINS[self.cycle_index]
+
+	def rate(self, tnow):
+		'''return the rate to send at in bytes/second'''
+		self._update_state(tnow)
+		if self.btl_bw <= 0:
+			rate = self.initial_rate
+		else:
+			rate = self.gain * self.btl_bw
+		return min(self.max_bandwidth, max(self.min_rate, rate))
+
 
 class BlockSender:
 	'''a reliable datagram block sender
@@ -245,12 +598,30 @@ class BlockSender:
 	mss:           maximum segment size for any packet. This limits all
 		       packet types (default is zero, meaning no limit)
 	ordered:       set to True to force blocks to be delivered in the sending order (default False)
+	adaptive:      pace sends at an estimate of the link's delivery rate from the
+		       acks, with bandwidth as the upper bound (default False)
+	fec:           forward error correction for sent blocks. Each group of fec chunks is
+		       followed by a parity packet, from which the receiver can rebuild one
+		       lost chunk of the group. FEC_AUTO chooses the group size from the
+		       measured efficiency (default 0, disabled)
 	debug:         enable debugging (default False)
+	batch:         packets to send or receive per system call with sendmmsg() and
+		       recvmmsg(), where available and sock is not given (default 0, disabled)
+	ack_delay:     seconds to wait after a chunk arrives before acking it, so that
+		       the acks for more chunks go in the same packets. A block
+		       completing is acked at once (default 0, no delay)
+
+	Blocks may be sent with compress=True, which zlib compresses them for
+	receivers that have said they can decompress. Receivers send a
+	PKT_FEATURES packet with the flags they understand to each sender of
+	chunks, so older receivers are only ever sent plain blocks. A peer
+	receiving PKT_FEATURES answers with its own, and the acks for several
+	blocks are then coalesced into PKT_ACKS packets.
 	'''
 	def __init__(self, port=0, dest_ip=None, dest_port=None, listen_ip='', bandwidth=100000,
 		     completed_len=1000, chunk_size=1000, backlog=100, rtt=0.01,
 		     sock=None, mss=0, ordered=False,
-		     debug=False):
+		     debug=False, batch=0, fec=0, adaptive=False, ack_delay=0):
 		self.bandwidth = bandwidth
 		self.port = port
 		if dest_port is None:
@@ -266,15 +637,25 @@ class BlockSender:
 			self.sock = sock
 		self.dest_ip = dest_ip
 		self.dest_port = dest_port
-		self.outgoing = []
-		self.incoming = []
+		self.outgoing = BlockSenderQueue()
+		# incoming blocks by blockid in order of arrival, and those complete
+		# but not yet returned by recv() in order of completion
+		self.incoming = collections.OrderedDict()
+		self.incoming_complete = collections.OrderedDict()
 		self.next_blockid = os.getpid() << 20
 		self.last_send_time = time.time()
 		self.last_recv_time = time.time()
 		self.acks_needed = set()
+		self.ack_delay = ack_delay
+		self.ack_due_time = None
+		self.ack_count = 0
+		self.ack_packets = 0
+		self.ack_bytes = 0
+		self.ack_bytes_saved = 0
 		self.packet_loss = 0
 		self.completed_len = completed_len
-		self.completed = []
+		self.completed = set()
+		self.completed_order = collections.deque()
 		if chunk_size > 65535:
 			raise BlockSenderException('chunk size must be less than 65536')
 		self.chunk_size = chunk_size
@@ -282,19 +663,55 @@ class BlockSender:
 		self.backlog = backlog
 		self.rtt_estimate = rtt
 		self.rtt_offset = 0
+		self.clock_offset = None
+		self.clock_reset = 10
 		self.rtt_max = 5
 		self.rtt_multiplier = 3.0
 		self.mss = mss
 		self.ordered = ordered
 		self.bonus_bytes = 0
+		self.send_stalled = False
+		self.stall_interval = 0.05
+		self.ack_retry_time = 0
 		self.efficiency = 1.0
 		self.bandwidth_used = 0.0
 		self.send_count = 0
 		self.recv_count = 0
+		self.fec = fec
+		self.fec_recovered = 0
+		self.pacing = None
+		if adaptive:
+			self.pacing = BlockSenderPacing(bandwidth)
+
+		# block flags each peer understands, from its PKT_FEATURES, and when
+		# we last told each sender of chunks ours
+		self.peer_flags = {}
+		self.features_sent = {}
+		self.features_interval = 10
+		self.compress_level = 6
+		self.compress_saved = 0
+
+		# packets are sent from a list of buffers. Sockets with sendmsg()
+		# gather them in the kernel, otherwise they are copied once into
+		# send_buffer
+		self.sendmsg = getattr(self.sock, 'sendmsg', None)
+		self.send_buffer = bytearray(65536)
+		self.send_view = memoryview(self.send_buffer)
+		self.native_sock = isinstance(self.sock, socket.socket)
+
+		# with batching, packets received by recvmmsg() wait in recv_pending,
+		# and packets sent during a tick() are queued in send_pending
+		self.mmsg = None
+		if sock is None and batch > 1 and cuav_mmsg.available():
+			self.mmsg = cuav_mmsg.MmsgSocket(self.sock, count=batch)
+		self.recv_pending = collections.deque()
+		self.send_pending = None
+		self.send_unsent = []
                 self.last_receive_time = 0
 
-		# work out the overheads of the packet types
-		self.chunk_overhead = BlockSenderChunk(0,0,0,'',0,0,0).header_size
+		# work out the overheads of the packet types. Flagged parity packets
+		# carry a chunk's worth of data with the largest header
+		self.chunk_overhead = BlockSenderParity(0,0,0,0,'',0,0,0,SUPPORTED_FLAGS).header_size
 		self.ack_overhead = BlockSenderSet(0,0,0).header_size
 		if self.mss and (self.mss < self.chunk_overhead + 1 or
 				 self.mss < self.ack_overhead + 4):
@@ -304,6 +721,10 @@ class BlockSender:
 		'''return the port we are receiving on'''
 		return self.port
 
+	def fileno(self):
+		'''return the socket file descriptor, for use with select()'''
+		return self.sock.fileno()
+
 	def set_dest_port(self, port):
 		'''set the port we send to by default'''
 		self.dest_port = port
@@ -315,8 +736,20 @@ class BlockSender:
 		self.packet_loss = loss
 
 	def set_bandwidth(self, bandwidth):
-		'''set the bandwidth on an open sender'''
+		'''set the bandwidth on an open sender. With adaptive pacing this is
+		the upper bound on the send rate'''
 		self.bandwidth = bandwidth
+		if self.pacing is not None:
+			self.pacing.max_bandwidth = bandwidth
+
+	def get_send_rate(self, tnow=None):
+		'''return the rate being sent at in bytes/second. This is the
+		bandwidth, or the paced rate with adaptive pacing'''
+		if self.pacing is None:
+			return self.bandwidth
+		if tnow is None:
+			tnow = time.time()
+		return self.pacing.rate(tnow)
 
 	def get_efficiency(self):
 		'''return the average efficiency of the link. An efficiency of 1.0 means
@@ -328,6 +761,37 @@ class BlockSender:
 		'''return an estimate of the round trip time'''
 		return self.rtt_estimate
 
+	def get_clock_offset(self):
+		'''return an estimate of the remote clock minus our clock, from the
+		timestamps on received chunks, or None if no chunks have been received.
+		This includes the minimum one way delay of the link'''
+		return self.clock_offset
+
+	def get_fec_recovered(self):
+		'''return the number of chunks rebuilt from parity packets'''
+		return self.fec_recovered
+
+	def fec_group_size(self):
+		'''return the parity group size for a new block, zero for none. With
+		FEC_AUTO this is chosen so that a group is expected to lose about one
+		chunk at the loss rate implied by the efficiency'''
+		if self.fec != FEC_AUTO:
+			return self.fec
+		loss = 1.0 - self.efficiency
+		if loss < 1.0 / (FEC_MAX_GROUP + 1):
+			return 0
+		return max(2, min(FEC_MAX_GROUP, int(1.0 / loss) - 1))
+
+	def get_compression_saved(self):
+		'''return the number of bytes saved by compressing blocks'''
+		return self.compress_saved
+
+	def get_ack_stats(self):
+		'''return (acks, packets, bytes, bytes_saved) for the acks sent. The
+		bytes include UDP/IP overhead, and bytes_saved is how much less that
+		is than sending each ack in its own packet'''
+		return (self.ack_count, self.ack_packets, self.ack_bytes, self.ack_bytes_saved)
+
 	def get_bandwidth_used(self):
 		'''return a moving average of the actual bandwidth used'''
 		return self.bandwidth_used
@@ -337,7 +801,7 @@ class BlockSender:
                 return time.time() - self.last_receive_time < timeout
                 
 
-	def send(self, data, dest=None, chunk_size=None, callback=None, priority=0):
+	def send(self, data, dest=None, chunk_size=None, callback=None, priority=0, fec=None, compress=False):
 		'''send a data block
 
 		dest:       optional (host,port) tuple
@@ -345,6 +809,11 @@ class BlockSender:
 		callback:   optional callback function on completion of send (default None)
 		priority:   optional priority for sending this packet. Higher priority packets
 		            are sent first (default 0)
+		fec:        chunks per parity group for this block, 0 for none (defaults to
+		            fec_group_size())
+		compress:   zlib compress the block if the receiver supports it and it
+		            gets smaller. Not worth it for already compressed data such
+		            as images (default False)
 
                 returns blockid for sent block, which may be passed to cancel()
 		'''
@@ -353,49 +822,50 @@ class BlockSender:
 		if self.mss and chunk_size > self.chunk_overhead + self.mss:
 			chunk_size = self.mss - (self.chunk_overhead + PACKET_HEADER_SIZE)
 
+		if dest is None:
+			if self.dest_ip is None:
+				raise BlockSenderException('no destination specified in send')
+			dest = (self.dest_ip, self.dest_port)
+
+		flags = 0
+		if compress and self.peer_flags.get(dest, 0) & FLAG_ZLIB:
+			cdata = zlib.compress(bytes(data), self.compress_level)
+			if len(cdata) < len(data):
+				self.compress_saved += len(data) - len(cdata)
+				data = cdata
+				flags |= FLAG_ZLIB
+
 		num_chunks = (len(data) + (chunk_size-1)) // chunk_size
 		if num_chunks > 65535:
 			raise BlockSenderException('chunk_size of %u is too small for data length %u' % (chunk_size, len(data)))
 		blockid = self.next_blockid
 		self.next_blockid += 1
-		if dest is None:
-			if self.dest_ip is None:
-				raise BlockSenderException('no destination specified in send')
-			dest = (self.dest_ip, self.dest_port)
 
+		if fec is None:
+			fec = self.fec_group_size()
 		newblk = BlockSenderBlock(blockid, len(data), chunk_size, dest, self.mss,
-					  data=data, callback=callback, priority=priority)
-
-		# if this block has a non-zero priority, insert after the last one with a
-		# higher or equal priority
-		if priority > 0:
-			for i in range(len(self.outgoing), 0, -1):
-				if self.outgoing[i-1].priority >= priority:
-                                        #print("Inserted blk %u len=%u %s" % (i, len(self.outgoing), newblk))
-					self.outgoing.insert(i, newblk)
-					return newblk.blockid
-                        #print("Inserted blk %u len=%u %s" % (0, len(self.outgoing), newblk))
-			self.outgoing.insert(0, newblk)
-			return newblk.blockid
-		# otherwise append to the outgoing list
-                #print("Appended blk len=%u %s" % (len(self.outgoing), newblk))
-		self.outgoing.append(newblk)
-                return newblk.blockid
+					  data=data, callback=callback, priority=priority, fec=fec, flags=flags)
+		self.send_stalled = False
+
+		# if this block has a non-zero priority it goes after the last one with a
+		# higher or equal priority, otherwise at the end of the outgoing queue
+		self.outgoing.add(newblk)
+		return newblk.blockid
 
         def cancel(self, blockid):
 		'''cancel send of a block
 
 		blockid:    id of block returned from send()
 		'''
-                for i in range(len(self.outgoing)):
-                        if self.outgoing[i].blockid == blockid:
-                                self.outgoing.pop(i)
-                                self._debug('Cancelled block %u' % blockid)
-                                return
+		if self.outgoing.remove(blockid) is not None:
+			self._debug('Cancelled block %u' % blockid)
 
-	def _crc(self, buffer):
-		'''produce a 32 bit unsigned crc for a buffer'''
-		return binascii.crc32(bytes(buffer)) & 0xFFFFFFFF
+	def _crc(self, *buffers):
+		'''produce a 32 bit unsigned crc for the concatenation of buffers'''
+		crc = 0
+		for buf in buffers:
+			crc = binascii.crc32(buf, crc)
+		return crc & 0xFFFFFFFF
 
 	def _debug(self, s):
 		'''internal debug function'''
@@ -409,60 +879,233 @@ class BlockSender:
 			if random.uniform(0, 1) < self.packet_loss*0.01:
                                 #print("lose packet")
 				return
-		try:
+		if type in (PKT_CHUNK, PKT_FLAGGED_CHUNK):
+			# the chunk data is a view of the block, sent without copying
+			header = obj.pack_header()
+			crc = self._crc(header, obj.data)
+			parts = [struct.pack('<BL', type, crc), header, obj.data]
+		else:
 			buf = obj.pack()
-			crc = self._crc(buf)
-			buf = bytes(struct.pack('<BL', type, crc)) + buf
-			self.sock.sendto(buf, dest)
+			parts = [struct.pack('<BL', type, self._crc(buf)), buf]
+		self._send_parts(parts, dest)
+
+	def _send_packed(self, buf, type, dest):
+		'''send an already packed object'''
+		if self.packet_loss != 0:
+			if random.uniform(0, 1) < self.packet_loss*0.01:
+				return
+		self._send_parts([struct.pack('<BL', type, self._crc(buf)), buf], dest)
+
+	def _send_parts(self, parts, dest):
+		'''send a packet made up of a list of buffers, counting it'''
+		try:
+			if self.send_pending is not None:
+				# counted by _flush_sends once sent
+				self.send_pending.append((parts, dest))
+				return
+			self._sendto(parts, dest)
 			self.send_count += 1
-                        #print("send_count=%u %s" % (self.send_count, obj))
 		except socket.error:
 			pass
 
+	def _sendto(self, parts, dest):
+		'''send a packet made up of a list of buffers'''
+		if self.sendmsg is not None:
+			self.sendmsg(parts, [], 0, dest)
+			return
+		n = 0
+		for p in parts:
+			self.send_view[n:n+len(p)] = p
+			n += len(p)
+		if self.native_sock:
+			self.sock.sendto(self.send_view[:n], dest)
+		else:
+			self.sock.sendto(self.send_view[:n].tobytes(), dest)
+
+	def _flush_sends(self):
+		'''send the packets queued during a tick with sendmmsg(). Those the
+		socket buffer had no room for go first in the next tick, rather
+		than waiting for a retransmit, up to backlog packets'''
+		pending = self.send_pending
+		self.send_pending = None
+		if not pending:
+			return
+		try:
+			sent = self.mmsg.sendmmsg(pending)
+		except socket.error as e:
+			self._debug('_flush_sends: ' + str(e))
+			sent = 0
+		self.send_count += sent
+		self.send_unsent = pending[sent:sent+self.backlog]
+
+	def _recvfrom(self):
+		'''receive a packet, raising socket.error if none are waiting'''
+		if self.mmsg is None:
+			return self.sock.recvfrom(65536)
+		if not self.recv_pending:
+			self.recv_pending.extend(self.mmsg.recvmmsg())
+			if not self.recv_pending:
+				raise socket.error(errno.EAGAIN, 'no packets')
+		return self.recv_pending.popleft()
+
+	def _need_ack(self, obj, urgent=False):
+		'''note that obj needs acking, within ack_delay unless urgent'''
+		due = time.time()
+		if not urgent:
+			due += self.ack_delay
+		if self.ack_due_time is None or due < self.ack_due_time:
+			self.ack_due_time = due
+		self.acks_needed.add(obj)
+
 	def _send_acks(self):
-		'''send extents objects to acknowledge data'''
+		'''send extents objects to acknowledge data. Acks to a peer with
+		FEATURE_ACKS are coalesced into PKT_ACKS packets'''
 		tnow = time.time()
+		if self.ack_due_time is not None and tnow < self.ack_due_time:
+			return
 		deltat = tnow - self.last_recv_time
 		self.last_recv_time = tnow
 		if self.acks_needed and self.enable_debug:
 			print("sending %u acks deltat=%.2f" % (len(self.acks_needed), deltat))
-		acks_needed = self.acks_needed.copy()
-		for obj in acks_needed:
-			try:
-				if isinstance(obj, BlockSenderBlock):
-					obj.acks.timestamp = obj.timestamp
-					if obj.complete():
-						ack = BlockSenderComplete(obj.blockid, obj.timestamp, obj.dest)
-						self._send_object(ack, PKT_COMPLETE, obj.dest)
-					else:
-						pkt = obj.acks
-						self._send_object(obj.acks, PKT_ACK, obj.dest)
+		# the packed acks for each peer, with the objects they are for
+		pending = collections.OrderedDict()
+		for obj in self.acks_needed:
+			if isinstance(obj, BlockSenderBlock):
+				obj.acks.timestamp = obj.timestamp
+				dest = obj.dest
+				if obj.complete():
+					ack = (PKT_COMPLETE, BlockSenderComplete(obj.blockid, obj.timestamp, obj.dest).pack())
 				else:
-					(blockid, dest) = obj
-					ack = BlockSenderComplete(blockid, time.time(), dest)
-					self._send_object(ack, PKT_COMPLETE, dest)
-				self.acks_needed.remove(obj)
-			except Exception as e:
-				self._debug('_send_acks: ' + str(e))
+					ack = (PKT_ACK, obj.acks.pack())
+			else:
+				(blockid, dest) = obj
+				ack = (PKT_COMPLETE, BlockSenderComplete(blockid, tnow, dest).pack())
+			pending.setdefault(dest, []).append((obj, ack))
+		max_size = ACKS_MAX_SIZE
+		if self.mss:
+			max_size = min(max_size, self.mss)
+		max_size -= PACKET_HEADER_SIZE
+		for (dest, acks) in pending.items():
+			coalesce = self.peer_flags.get(dest, 0) & FEATURE_ACKS
+			group = []
+			size = 0
+			for (obj, (type, buf)) in acks:
+				if group and (not coalesce or size + 3 + len(buf) > max_size):
+					if not self._send_ack_group(group, dest, tnow):
+						return
+					group = []
+					size = 0
+				group.append((obj, type, buf))
+				size += 3 + len(buf)
+			if not self._send_ack_group(group, dest, tnow):
 				return
+		self.ack_due_time = None
+
+	def _send_ack_group(self, group, dest, tnow):
+		'''send a list of (obj, type, buf) acks in one packet, which is a
+		PKT_ACKS if there is more than one. Returns False on error'''
+		try:
+			if len(group) == 1:
+				(obj, type, buf) = group[0]
+				self._send_packed(buf, type, dest)
+				size = len(buf)
+			else:
+				pkt = BlockSenderAcks()
+				pkt.acks = [(type, buf) for (obj, type, buf) in group]
+				buf = pkt.pack()
+				self._send_packed(buf, PKT_ACKS, dest)
+				size = len(buf)
+				# the packets this took the place of
+				separate = sum([len(b) + PACKET_HEADER_SIZE + UDP_OVERHEAD for (obj, type, b) in group])
+				self.ack_bytes_saved += separate - (size + PACKET_HEADER_SIZE + UDP_OVERHEAD)
+		except Exception as e:
+			self._debug('_send_acks: ' + str(e))
+			self.ack_retry_time = tnow + self.stall_interval
+			return False
+		self.ack_count += len(group)
+		self.ack_packets += 1
+		self.ack_bytes += size + PACKET_HEADER_SIZE + UDP_OVERHEAD
+		for (obj, type, buf) in group:
+			self.acks_needed.remove(obj)
+		return True
+
+	def _send_features(self, dest, tnow):
+		'''tell a peer which block flags and features we understand. This is
+		repeated every features_interval seconds in case it is lost'''
+		if tnow - self.features_sent.get(dest, 0) < self.features_interval:
+			return
+		self.features_sent[dest] = tnow
+		self._send_object(BlockSenderFeatures(FEATURES), PKT_FEATURES, dest)
+
+	def _valid_chunk(self, blk, chunk):
+		'''check an incoming chunk or parity group lies within its block,
+		and matches the block we already have for it. The block data is
+		held by a memoryview so can't grow to take a chunk past its end'''
+		if chunk.chunk_size == 0:
+			return False
+		if blk is not None and (chunk.size != blk.size or chunk.chunk_size != blk.chunk_size):
+			return False
+		num_chunks = (chunk.size + (chunk.chunk_size-1)) // chunk.chunk_size
+		if isinstance(chunk, BlockSenderParity):
+			# a parity group must lie within the block, or the chunk
+			# recovered from it would be past the end
+			return chunk.chunk_id + chunk.count <= num_chunks
+		if chunk.chunk_id >= num_chunks:
+			return False
+		return chunk.chunk_id*chunk.chunk_size + len(chunk.data) <= chunk.size
 
 	def _add_chunk(self, blk, chunk):
 		'''add an incoming chunk to a block'''
+		was_complete = blk.complete()
 		blk.acks.add(chunk.chunk_id, chunk.ack_to)
+		if blk.complete() and not was_complete:
+			self.incoming_complete[blk.blockid] = blk
 		start = chunk.chunk_id*chunk.chunk_size
 		length = len(chunk.data)
 		blk.data[start:start+length] = chunk.data
-		self.acks_needed.add(blk)
+		self._need_ack(blk, blk.complete())
+		if blk.parity:
+			for first in blk.parity.keys():
+				if first <= chunk.chunk_id < first + blk.parity[first].count:
+					self._recover_chunk(blk, first)
+
+	def _add_parity(self, blk, parity):
+		'''add an incoming parity packet to a block'''
+		blk.parity[parity.chunk_id] = parity
+		self._recover_chunk(blk, parity.chunk_id)
+		self._need_ack(blk, blk.complete())
+
+	def _recover_chunk(self, blk, first):
+		'''rebuild the missing chunk of a parity group, if only one is missing'''
+		parity = blk.parity[first]
+		missing = [c for c in range(first, first+parity.count) if not blk.acks.present(c)]
+		if len(missing) > 1:
+			return
+		del blk.parity[first]
+		if len(missing) == 0:
+			return
+		c = missing[0]
+		others = [blk.chunk(i) for i in range(first, first+parity.count) if i != c]
+		data = xor_chunks(others + [parity.data], blk.chunk_size)
+		length = min(blk.chunk_size, blk.size - c*blk.chunk_size)
+		chunk = BlockSenderChunk(blk.blockid, blk.size, c, data[:length],
+					 blk.chunk_size, parity.ack_to, parity.timestamp, parity.flags)
+		self.fec_recovered += 1
+		self._debug("recovered chunk %u of %u" % (c, blk.blockid))
+		self._add_chunk(blk, chunk)
 
 	def _complete_send(self, blk):
 		'''complete send of a block'''
 		if blk.callback:
                         #print("Callback %s" % blk.callback)
 			blk.callback()
-		if blk.sends == 0:
+		# parity packets count as sends, so the efficiency is what the link
+		# delivers per packet whether chunks were resent or rebuilt
+		sends = blk.sends + blk.parity_sends
+		if sends == 0:
 			efficiency = blk.num_chunks / 1.0
 		else:
-			efficiency = blk.num_chunks / float(blk.sends)
+			efficiency = blk.num_chunks / float(sends)
 		#print("_complete_send: efficiency=%.2f sends=%u recvs=%u" % (efficiency, self.send_count, self.recv_count))
 		self.efficiency = 0.95 * self.efficiency + 0.05 * efficiency
 
@@ -473,11 +1116,65 @@ class BlockSender:
                         self.rtt_offset = obj.timestamp - tnow
                         self._debug("rtt_offset=%.3f" % self.rtt_offset)
                 self.rtt_estimate = min(self.rtt_max, 0.95 * self.rtt_estimate + 0.05 * (self.rtt_offset + tnow - obj.timestamp))
+		if self.pacing is not None:
+			self.pacing.on_rtt(self.rtt_offset + tnow - obj.timestamp, tnow)
+
+	def _acked(self, blk, count, tnow):
+		'''note the acks for count more chunks of an outgoing block'''
+		if self.pacing is not None and count > 0:
+			self.pacing.on_ack(count * (blk.chunk_size + self.chunk_overhead), tnow)
+
+	def _update_clock_offset(self, obj, tnow):
+		'''update the remote clock offset from a received chunk. Like rtt_offset
+		this keeps the largest difference between the remote timestamp and our
+		clock, but restarts if the remote clock steps backwards'''
+		offset = obj.timestamp - tnow
+		if (self.clock_offset is None or offset > self.clock_offset or
+		    offset < self.clock_offset - self.clock_reset):
+			self.clock_offset = offset
+			self._debug("clock_offset=%.3f" % self.clock_offset)
+
+	def _handle_ack(self, obj, tnow):
+		'''handle a received BlockSenderSet or BlockSenderComplete'''
+		if isinstance(obj, BlockSenderSet):
+			# we've received a set of acks for some data
+			# find the corresponding outgoing block
+                        self._update_rtt(obj, tnow)
+			out = self.outgoing.get(obj.id)
+			if out is None:
+				# an ack for something already complete
+				return
+			if self.enable_debug:
+				self._debug("ack %s %f" % (str(out.acks), self.rtt_offset + tnow - obj.timestamp))
+			count = out.acks.count
+			out.acks.update(obj)
+			self._acked(out, out.acks.count - count, tnow)
+			if out.acks.complete():
+				if self.enable_debug:
+					self._debug("send complete %u %s" % (out.blockid, obj))
+				self.outgoing.remove(out.blockid)
+				self._complete_send(out)
+			return
+
+		if isinstance(obj, BlockSenderComplete):
+			# a full block has been received
+			if self.enable_debug:
+				self._debug("full ack for blockid %u" % obj.blockid)
+                        self._update_rtt(obj, tnow)
+			blk = self.outgoing.remove(obj.blockid)
+			if blk is None:
+				# an ack for something already complete
+				return
+			self._acked(blk, blk.num_chunks - blk.acks.count, tnow)
+			if self.enable_debug:
+				self._debug("send complete %u outlen=%u %s %s" % (
+					blk.blockid, len(self.outgoing), obj, blk))
+			self._complete_send(blk)
 
 	def _check_incoming(self):
 		'''check for incoming data or acks. Return True if a packet was received'''
 		try:
-			(buf, fromaddr) = self.sock.recvfrom(65536)
+			(buf, fromaddr) = self._recvfrom()
 		except socket.error:
 			return False
 		if len(buf) == 0:
@@ -493,7 +1190,7 @@ class BlockSender:
 				self._debug('bad packet %s' % msg)
 				return True
 			(magic,crc) = struct.unpack_from('<BL', buf)
-			remaining = buf[PACKET_HEADER_SIZE:]
+			remaining = memoryview(buf)[PACKET_HEADER_SIZE:]
 			if crc != self._crc(remaining):
 				self._debug('bad crc')
 				return True                
@@ -503,8 +1200,20 @@ class BlockSender:
 			elif magic == PKT_COMPLETE:
 				obj = BlockSenderComplete(0, None, None)
 				obj.unpack(remaining)
-			elif magic == PKT_CHUNK:
+			elif magic in (PKT_CHUNK, PKT_FLAGGED_CHUNK):
 				obj = BlockSenderChunk(0, 0, 0, "", 0, 0, 0)
+				obj.unpack(remaining, magic == PKT_FLAGGED_CHUNK)
+			elif magic in (PKT_PARITY, PKT_FLAGGED_PARITY):
+				obj = BlockSenderParity(0, 0, 0, 0, "", 0, 0, 0)
+				obj.unpack(remaining, magic == PKT_FLAGGED_PARITY)
+				if obj.count == 0 or len(obj.data) != obj.chunk_size:
+					self._debug('bad parity packet')
+					return True
+			elif magic == PKT_FEATURES:
+				obj = BlockSenderFeatures(0)
+				obj.unpack(remaining)
+			elif magic == PKT_ACKS:
+				obj = BlockSenderAcks()
 				obj.unpack(remaining)
 			else:
 				self._debug('bad magic %u' % magic)
@@ -515,68 +1224,63 @@ class BlockSender:
 		tnow = time.time()
                 self.last_receive_time = tnow
                 #print(obj)
-		if isinstance(obj, BlockSenderSet):
-			# we've received a set of acks for some data
-			# find the corresponding outgoing block
-                        self._update_rtt(obj, tnow)
-			for i in range(len(self.outgoing)):
-				out = self.outgoing[i]
-				if out.blockid == obj.id:
-					if self.enable_debug:
-						self._debug("ack %s %f" % (str(out.acks), self.rtt_offset + tnow - obj.timestamp))
-					out.acks.update(obj)
-					if out.acks.complete():
-						if self.enable_debug:
-							self._debug("send complete %u %s" % (out.blockid, obj))
-						blk = self.outgoing.pop(i)
-						self._complete_send(blk)
-					return True
-			# an ack for something already complete
+		if isinstance(obj, BlockSenderAcks):
+			# several acks coalesced into one packet
+			for ack in obj.acks:
+				self._handle_ack(ack, tnow)
 			return True
 
-		if isinstance(obj, BlockSenderComplete):
-			# a full block has been received
-			if self.enable_debug:
-				self._debug("full ack for blockid %u" % obj.blockid)
-                        self._update_rtt(obj, tnow)
-			for i in range(len(self.outgoing)):
-				out = self.outgoing[i]
-				if out.blockid == obj.blockid:
-					blk = self.outgoing.pop(i)
-					if self.enable_debug:
-						self._debug("send complete %u outlen=%u %s %s" % (
-                                                        out.blockid, len(self.outgoing), obj, blk))
-					self._complete_send(blk)
-					return True
-			# an ack for something already complete
+		if isinstance(obj, (BlockSenderSet, BlockSenderComplete)):
+			self._handle_ack(obj, tnow)
+			return True
+
+		if isinstance(obj, BlockSenderFeatures):
+			# the flags and features a peer understands. Tell it ours, as
+			# the other end of a link needs them too
+			self.peer_flags[fromaddr] = obj.flags
+			self._send_features(fromaddr, tnow)
 			return True
 
 		if isinstance(obj, BlockSenderChunk):
 			# we've received a chunk of data
+			if obj.flags & ~SUPPORTED_FLAGS:
+				self._debug('unsupported flags 0x%x' % obj.flags)
+				return True
+			self._update_clock_offset(obj, tnow)
+			self._send_features(fromaddr, tnow)
 			if obj.blockid in self.completed:
 				# we've already completed this blockid
 				if self.enable_debug:
 					self._debug("got completed chunk %u of %u" % (obj.chunk_id, obj.blockid))
-				self.acks_needed.add((obj.blockid, fromaddr))
+				self._need_ack((obj.blockid, fromaddr))
+				return True
+			blk = self.incoming.get(obj.blockid, None)
+			if not self._valid_chunk(blk, obj):
+				self._debug('bad chunk %u of %u' % (obj.chunk_id, obj.blockid))
+				return True
+			if isinstance(obj, BlockSenderParity):
+				if blk is None:
+					blk = BlockSenderBlock(obj.blockid, obj.size, obj.chunk_size, fromaddr, self.mss, flags=obj.flags)
+					self.incoming[obj.blockid] = blk
+				blk.timestamp = obj.timestamp
+				self._add_parity(blk, obj)
+				return True
+			if blk is not None:
+				# we have an existing incoming object
+				if self.enable_debug:
+					if blk.acks.present(obj.chunk_id):
+						self._debug("got dup chunk %u of %u" % (obj.chunk_id, obj.blockid))
+					else:
+						self._debug("got chunk %u of %u" % (obj.chunk_id, obj.blockid))
+				blk.timestamp = obj.timestamp
+				self._add_chunk(blk, obj)
 				return True
-			for i in range(len(self.incoming)):
-				blk = self.incoming[i]
-				if blk.blockid == obj.blockid:
-					# we have an existing incoming object
-					if self.enable_debug:
-						if obj.chunk_id in blk.acks.chunks:
-							self._debug("got dup chunk %u of %u" % (obj.chunk_id, obj.blockid))
-						else:
-							self._debug("got chunk %u of %u" % (obj.chunk_id, obj.blockid))
-					blk.timestamp = obj.timestamp
-					self._add_chunk(blk, obj)
-					return True
 			# its a new block
 			if self.enable_debug:
 				self._debug("new block chunk %u of %u (size=%u chunk_size=%u)" % (
                                         obj.chunk_id, obj.blockid, obj.size, obj.chunk_size))
-			self.incoming.append(BlockSenderBlock(obj.blockid, obj.size, obj.chunk_size, fromaddr, self.mss))
-			blk = self.incoming[-1]
+			blk = BlockSenderBlock(obj.blockid, obj.size, obj.chunk_size, fromaddr, self.mss, flags=obj.flags)
+			self.incoming[obj.blockid] = blk
 			blk.timestamp = obj.timestamp
 			self._add_chunk(blk, obj)
 			return True
@@ -591,17 +1295,33 @@ class BlockSender:
 		'''
 		if ordered is None:
 			ordered = self.ordered
-		imax = len(self.incoming)
 		if ordered:
-			imax = min(1, imax)
-		for i in range(imax):
-			if self.incoming[i].complete():
-				blk = self.incoming.pop(i)
-				#print("available sends=%u recvs=%u" % (self.send_count, self.recv_count))
-				self.completed.append(blk.blockid)
-				while len(self.completed) > self.completed_len:
-					self.completed.pop(0)        
-				return blk.data
+			blk = self._first_incoming()
+			if blk is None or not blk.complete():
+				return None
+			self.incoming_complete.pop(blk.blockid, None)
+		elif self.incoming_complete:
+			(blockid, blk) = self.incoming_complete.popitem(last=False)
+		else:
+			return None
+		del self.incoming[blk.blockid]
+		#print("available sends=%u recvs=%u" % (self.send_count, self.recv_count))
+		self.completed.add(blk.blockid)
+		self.completed_order.append(blk.blockid)
+		while len(self.completed_order) > self.completed_len:
+			self.completed.discard(self.completed_order.popleft())
+		if blk.flags & FLAG_ZLIB:
+			try:
+				return bytearray(zlib.decompress(bytes(blk.data)))
+			except zlib.error as e:
+				self._debug('bad compressed block %u: %s' % (blk.blockid, str(e)))
+				return None
+		return blk.data
+
+	def _first_incoming(self):
+		'''return the oldest incoming block, or None'''
+		for blockid in self.incoming:
+			return self.incoming[blockid]
 		return None
 
 	def report(self, detailed=False):
@@ -610,13 +1330,14 @@ class BlockSender:
 		total_chunks = 0
 		for i in range(len(self.outgoing)):
 			blk = self.outgoing[i]
-			total_acked += len(blk.acks.chunks)
+			total_acked += blk.acks.count
 			total_chunks += blk.acks.num_chunks
 			if detailed:
-				print("block %u  acked %u/%u" % (blk.blockid, len(blk.acks.chunks), blk.acks.num_chunks))
+				print("block %u  acked %u/%u" % (blk.blockid, blk.acks.count, blk.acks.num_chunks))
                 complete = "0"
-                if len(self.incoming) > 0:
-                        complete = "%u/%u" % (len(self.incoming[0].acks.chunks), self.incoming[0].acks.num_chunks)
+                first = self._first_incoming()
+                if first is not None:
+                        complete = "%u/%u" % (first.acks.count, first.acks.num_chunks)
                 print("total_acked=%u total_chunks=%u eff=%.2f rtt=%.1f bw=%.2f qsize=%u in=%u/%s" % (
                         total_acked, total_chunks, self.get_efficiency(), self.get_rtt_estimate(),
                         self.get_bandwidth_used(),
@@ -626,6 +1347,10 @@ class BlockSender:
 		'''return number of uncompleted blocks in the send queue'''
 		return len(self.outgoing)
 
+	def is_queued(self, blockid):
+		'''return True if a block is still in the send queue'''
+		return blockid in self.outgoing
+
 
 	def recv(self, timeout=0, ordered=None):
 		'''receive next chunk from network. Return data or None
@@ -638,9 +1363,7 @@ class BlockSender:
 		data = self.available(ordered=ordered)
 		if data is not None:
 			return data
-		if len(self.incoming) > 0 and self.incoming[0].complete():
-			return self.incoming.pop(0).data            
-		if timeout != 0:
+		if timeout != 0 and not self.recv_pending:
 			rin = [self.sock.fileno()]
 			try:
 				(rin, win, xin) = select.select(rin, [], [], timeout)
@@ -662,14 +1385,16 @@ class BlockSender:
 
 		tnow = time.time()
 		deltat = tnow - self.last_send_time
-		bytes_to_send = int(self.bandwidth * deltat + self.bonus_bytes)
+		bandwidth = self.get_send_rate(tnow)
+		bytes_to_send = int(bandwidth * deltat + self.bonus_bytes)
 
                 # don't try and send till we have a reasonable amount we can send. On higher bandwidth links
                 # this makes sending more efficient by using bigger chunks
-                if bytes_to_send <= self.bandwidth/10:
+                if bytes_to_send <= bandwidth/10:
 			return
 		bytes_sent = 0
 		chunks_sent = 0
+		self.send_stalled = False
 
 		count = len(self.outgoing)
 		if max_queue is not None:
@@ -684,6 +1409,9 @@ class BlockSender:
 			if self.ordered and i > 0 and not self.outgoing[i-1].acks.started():
 				break
 
+			# send parity packets still due from the last tick
+			bytes_sent = self._send_parity(blk, tnow, bytes_sent, bytes_to_send)
+
 			# start where we left off
 			chunks = list(range(blk.next_chunk, blk.num_chunks))
 			chunks.extend(range(blk.next_chunk))
@@ -701,7 +1429,7 @@ class BlockSender:
 						continue
 
 				chunk = BlockSenderChunk(blk.blockid, blk.size, c, blk.chunk(c),
-							 blk.chunk_size, blk.acks.first_missing, tnow)
+							 blk.chunk_size, blk.acks.first_missing, tnow, blk.flags)
 
 				if bytes_sent + chunk.packed_size > bytes_to_send:
 					# this would take us over our bandwidth limit
@@ -711,7 +1439,7 @@ class BlockSender:
                                         self._debug('send chunk len=%u dt=%.3f bts=%u bsent=%u bonus=%u' % (
                                                 chunk.packed_size, deltat, bytes_to_send, bytes_sent, self.bonus_bytes))
 				try:
-					self._send_object(chunk, PKT_CHUNK, blk.dest)
+					self._send_object(chunk, PKT_FLAGGED_CHUNK if blk.flags else PKT_CHUNK, blk.dest)
 				except Exception as e:
 					self._debug('_send_outgoing: ' + str(e))
 					break
@@ -723,17 +1451,85 @@ class BlockSender:
 				blk.sends += 1
 				chunks_sent += 1
 				blk.chunk_send_times[c] = tnow
+				if blk.fec:
+					(first, count) = blk.group(c)
+					if (first not in blk.parity_sent and
+					    all(i in blk.chunk_send_times for i in range(first, first+count))):
+						blk.parity_sent.add(first)
+						blk.parity_due.append(first)
+					bytes_sent = self._send_parity(blk, tnow, bytes_sent, bytes_to_send)
 				if chunks_sent == self.backlog:
 					# don't send more than self.backlog per tick
 					break
 
                 # adjust bonus, but don't allow it to get too far ahead
 		self.bonus_bytes = bytes_to_send - bytes_sent
-                self.bonus_bytes = min(self.bonus_bytes, self.bandwidth/2)
+                self.bonus_bytes = min(self.bonus_bytes, bandwidth/2)
                 
                 self.last_send_time = tnow
 		if bytes_sent != 0:
 			self.bandwidth_used = 0.99 * self.bandwidth_used + 0.01 * (bytes_sent/deltat)
+		else:
+			# everything is waiting on acks
+			self.send_stalled = True
+
+	def _send_parity(self, blk, tnow, bytes_sent, bytes_to_send):
+		'''send the parity packets due for a block that fit in the bandwidth
+		left, returning the new bytes_sent. Each group gets one parity packet,
+		after all its chunks have been sent once'''
+		while blk.parity_due:
+			first = blk.parity_due[0]
+			(first, count) = blk.group(first)
+			if all(blk.acks.present(c) for c in range(first, first+count)):
+				# already received
+				blk.parity_due.pop(0)
+				continue
+			parity = BlockSenderParity(blk.blockid, blk.size, first, count,
+						   blk.parity_data(first, count),
+						   blk.chunk_size, blk.acks.first_missing, tnow, blk.flags)
+			if bytes_sent + parity.packed_size > bytes_to_send:
+				break
+			try:
+				self._send_object(parity, PKT_FLAGGED_PARITY if blk.flags else PKT_PARITY, blk.dest)
+			except Exception as e:
+				self._debug('_send_parity: ' + str(e))
+				break
+			blk.parity_due.pop(0)
+			blk.parity_sends += 1
+			bytes_sent += parity.packed_size
+		return bytes_sent
+
+	def tick_deadline(self):
+		'''return the time at which tick() or recv() next has work to do, or
+		None if there is nothing to do until a packet arrives on fileno().
+		This allows a caller to sleep in select() rather than polling'''
+		if self.recv_pending:
+			return 0
+		if self.acks_needed:
+			deadline = self.ack_retry_time
+			if self.ack_due_time is not None and self.ack_due_time > deadline:
+				deadline = self.ack_due_time
+			return deadline
+		if self.ordered:
+			first = self._first_incoming()
+			if first is not None and first.complete():
+				return 0
+		elif self.incoming_complete:
+			return 0
+		if self.send_unsent:
+			# retry once the socket buffer has had time to drain
+			return time.time() + 0.01
+		if len(self.outgoing) == 0:
+			return None
+		# _send_outgoing waits for a tenth of a second of bandwidth
+		wait = 0
+		bandwidth = self.get_send_rate()
+		if bandwidth > 0:
+			wait = 0.1 - self.bonus_bytes / float(bandwidth)
+		if self.send_stalled:
+			# poll for retransmits
+			wait = max(wait, self.stall_interval)
+		return self.last_send_time + wait
 
 
 	def tick(self, packet_count=None, send_acks=True, send_outgoing=True, max_queue=None):
@@ -753,13 +1549,20 @@ class BlockSender:
 			if not self._check_incoming():
 				break
 
-		# send any acks that are needed
-		if send_acks:
-			self._send_acks()
+		if self.mmsg is not None:
+			self.send_pending = self.send_unsent
+			self.send_unsent = []
+		try:
+			# send any acks that are needed
+			if send_acks:
+				self._send_acks()
 
-		# send outgoing data
-		if send_outgoing:
-			self._send_outgoing(max_queue=max_queue)
+			# send outgoing data
+			if send_outgoing:
+				self._send_outgoing(max_queue=max_queue)
+		finally:
+			if self.mmsg is not None:
+				self._flush_sends()
 
 # a simple test suite
 if __name__ == "__main__":
@@ -773,10 +1576,11 @@ if __name__ == "__main__":
 	num_blocks = 100
 	packet_loss = 0
 	average_block_size = 50000
+	ack_delay = 0.05
 
 	# setup a send/recv pair
-	b1 = BlockSender(dest_ip='127.0.0.1', debug=debug, bandwidth=bandwidth, ordered=ordered)
-	b2 = BlockSender(dest_ip='127.0.0.1', debug=debug, bandwidth=bandwidth, ordered=ordered)
+	b1 = BlockSender(dest_ip='127.0.0.1', debug=debug, bandwidth=bandwidth, ordered=ordered, ack_delay=ack_delay)
+	b2 = BlockSender(dest_ip='127.0.0.1', debug=debug, bandwidth=bandwidth, ordered=ordered, ack_delay=ack_delay)
 
 	# setup for some packet loss
 	if packet_loss:
@@ -837,3 +1641,7 @@ if __name__ == "__main__":
 	print("%u blocks received OK %.1f bytes/second" % (num_blocks, total_size/(t1-t0)))
 	print("efficiency %.1f  bandwidth used %.1f bytes/s" % (b1.get_efficiency(),
 							  b1.get_bandwidth_used()))
+	for b in [b1, b2]:
+		(acks, packets, nbytes, saved) = b.get_ack_stats()
+		print("acks %u in %u packets, %u bytes with %u saved by coalescing (%.1f bytes/s)" % (
+			acks, packets, nbytes, saved, nbytes/(t1-t0)))
@@ -7,6 +7,14 @@ class StampedCommand:
     def __init__(self):
         self.timestamp = time.time()
         self.blockid = None
+        self.stamps = {}
+
+    def stamp(self, stage, t=None):
+        '''record the time this packet reached a pipeline stage.
+        See cuav_latency.STAGES'''
+        if t is None:
+            t = time.time()
+        self.stamps[stage] = t
 
 class ImagePacket(StampedCommand):
     '''a jpeg image sent to the ground station'''
@@ -18,13 +26,19 @@ class ImagePacket(StampedCommand):
         self.priority = priority
 
 class ThumbPacket(StampedCommand):
-    '''a thumbnail region sent to the ground station'''
-    def __init__(self, frame_time, regions, thumb, pos):
+    '''a thumbnail region sent to the ground station. hits is an optional
+    list of the number of times the target of each region has been seen,
+    and tracks an optional list of the id of each region's target, or
+    None for regions that are not tracked. A later thumbnail with the
+    same track id is a better view of the same target'''
+    def __init__(self, frame_time, regions, thumb, pos, hits=None, tracks=None):
         StampedCommand.__init__(self)
         self.frame_time = frame_time
         self.regions = regions
         self.thumb = thumb
         self.pos = pos
+        self.hits = hits
+        self.tracks = tracks
 
 class CommandPacket(StampedCommand):
     '''a command to run on the plane'''
@@ -71,6 +85,63 @@ class ChangeImageSetting(StampedCommand):
         self.name = name
         self.value = value
 
+class PerfReport(StampedCommand):
+    '''periodic health and performance report from the aircraft
+
+    queues:    dictionary of queue name to depth
+    latencies: dictionary of pipeline stage to mean latency in seconds
+    cpu:       percentage CPU used by the camera process
+    load:      system load average, or None
+    mem:       resident memory of the camera process in MB, or None
+    disk_free: free space on the image disk in MB, or None
+    links:     list of (sendq, bandwidth_used, efficiency, rtt) tuples, one per link
+    '''
+    def __init__(self, scan_fps, queues, latencies, cpu, load, mem, disk_free, links):
+        StampedCommand.__init__(self)
+        self.scan_fps = scan_fps
+        self.queues = queues
+        self.latencies = latencies
+        self.cpu = cpu
+        self.load = load
+        self.mem = mem
+        self.disk_free = disk_free
+        self.links = links
+
+    def __str__(self):
+        ret = 'fps %.1f  cpu %.0f%%' % (self.scan_fps, self.cpu)
+        if self.load is not None:
+            ret += '  load %.2f' % self.load
+        if self.mem is not None:
+            ret += '  mem %.0fMB' % self.mem
+        if self.disk_free is not None:
+            ret += '  disk %.0fMB' % self.disk_free
+        ret += '  queues ' + ' '.join(['%s=%u' % (k, self.queues[k]) for k in sorted(self.queues.keys())])
+        if self.latencies:
+            ret += '  latency ' + ' '.join(['%s=%.3f' % (k, self.latencies[k]) for k in sorted(self.latencies.keys())])
+        for (i, (sendq, bandwidth_used, efficiency, rtt)) in enumerate(self.links):
+            ret += '  link%u q=%u bw=%.0f eff=%.2f rtt=%.2f' % (i, sendq, bandwidth_used, efficiency, rtt)
+        return ret
+
+class StripePacket:
+    '''a fragment of a packet striped across several links. Fragments are
+    not StampedCommands, as the receiver discards repeated timestamps,
+    and all the fragments of a packet are made at once
+
+    stripe_id: identifies the packet the fragment is part of
+    index:     number of the fragment, from 0
+    count:     number of fragments in the packet
+    size:      length of the whole packet
+    offset:    position of the fragment in the packet
+    data:      the fragment
+    '''
+    def __init__(self, stripe_id, index, count, size, offset, data):
+        self.stripe_id = stripe_id
+        self.index = index
+        self.count = count
+        self.size = size
+        self.offset = offset
+        self.data = data
+
 class BlockCancel(StampedCommand):
     '''cancel object for callback on send1 complete'''
     def __init__(self, blockid):
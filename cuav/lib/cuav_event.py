@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+'''event driven waiting for the camera module threads
+
+Rather than polling on a fixed interval, the transmit loops sleep in
+select() on their BlockSender sockets and an EventQueue, waking early
+when a BlockSender next has data due to send.
+'''
+
+import Queue, select, socket, time
+
+
+class EventQueue(Queue.Queue):
+    '''a Queue that can be waited on with select() alongside sockets.
+    A loopback UDP socket is used for the wakeup, so this also works
+    where select() only supports sockets'''
+    def __init__(self, maxsize=0):
+        Queue.Queue.__init__(self, maxsize)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.setblocking(0)
+        self.addr = self.sock.getsockname()
+
+    def _put(self, item):
+        Queue.Queue._put(self, item)
+        try:
+            self.sock.sendto('x', self.addr)
+        except socket.error:
+            pass
+
+    def fileno(self):
+        '''return the wakeup socket file descriptor'''
+        return self.sock.fileno()
+
+    def clear_wakeup(self):
+        '''discard any pending wakeups'''
+        while True:
+            try:
+                self.sock.recv(1024)
+            except socket.error:
+                return
+
+    def close(self):
+        '''close the wakeup socket'''
+        self.sock.close()
+
+
+def wait(bsends, timeout, queues=[]):
+    '''wait for up to timeout seconds for a packet on one of the bsends,
+    an item on one of the queues, or for one of the bsends to have
+    work due in tick()'''
+    tnow = time.time()
+    for bsnd in bsends:
+        deadline = bsnd.tick_deadline()
+        if deadline is not None:
+            timeout = min(timeout, deadline - tnow)
+    for q in queues:
+        if not q.empty():
+            timeout = 0
+    if timeout > 0:
+        rin = [bsnd.fileno() for bsnd in bsends] + [q.fileno() for q in queues]
+        if len(rin) == 0:
+            time.sleep(timeout)
+        else:
+            try:
+                select.select(rin, [], [], timeout)
+            except select.error:
+                pass
+    for q in queues:
+        q.clear_wakeup()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+'''
+bounded, time indexed store of per-frame metadata
+
+Frames are looked up by their float frame time, matching within a
+small tolerance. Entries older than max_age seconds (relative to the
+newest frame in the store) are evicted, as are the oldest entries once
+there are more than max_entries frames. If a spill file is set then
+evicted entries are appended to it as pickles, so lookups of older
+frames (such as image requests from the GCS) still succeed. Only the
+time and file offset of spilled frames is kept in memory. A frame
+updated after it was spilled has its spilled and in-memory fields
+merged on lookup.
+'''
+
+import os, bisect, threading, array, cPickle
+
+
+class FrameStore:
+    '''hold a dictionary of fields for each frame, keyed by frame time
+
+    max_age:        seconds of frames to hold in memory (default 300)
+    max_entries:    maximum number of frames to hold in memory (default 1000)
+    tolerance:      maximum difference in seconds for a frame time to match (default 0.005)
+    spill_filename: optional file to append evicted frames to (default None)
+    append:         keep existing contents of the spill file (default False)
+    '''
+    def __init__(self, max_age=300, max_entries=1000, tolerance=0.005,
+                 spill_filename=None, append=False):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self.tolerance = tolerance
+        self.lock = threading.Lock()
+        self.times = []
+        self.entries = {}
+        self.spill_filename = None
+        self.spill_times = array.array('d')
+        self.spill_offsets = array.array('L')
+        if spill_filename is not None:
+            self.open_spill(spill_filename, append=append)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __contains__(self, frame_time):
+        return self.lookup(frame_time) is not None
+
+    def open_spill(self, filename, append=False):
+        '''start spilling evicted frames to a file'''
+        with self.lock:
+            self.spill_filename = filename
+            self.spill_times = array.array('d')
+            self.spill_offsets = array.array('L')
+            if not append:
+                try:
+                    os.remove(filename)
+                except OSError:
+                    pass
+                return
+            if not os.path.exists(filename):
+                return
+            # rebuild the index from a previous run
+            with open(filename, 'rb') as f:
+                while True:
+                    ofs = f.tell()
+                    try:
+                        (t, fields) = cPickle.load(f)
+                    except EOFError:
+                        break
+                    self._add_spill_index(t, ofs)
+
+    def update(self, frame_time, **fields):
+        '''set fields for a frame, adding the frame if needed'''
+        frame_time = float(frame_time)
+        with self.lock:
+            key = self._find(frame_time)
+            if key is None:
+                key = frame_time
+                bisect.insort(self.times, key)
+                self.entries[key] = {}
+            self.entries[key].update(fields)
+            self._expire()
+
+    def lookup(self, frame_time):
+        '''return the fields for a frame as a dictionary, or None. Fields
+        in memory take precedence over spilled ones'''
+        frame_time = float(frame_time)
+        with self.lock:
+            ret = self._spill_lookup(frame_time)
+            key = self._find(frame_time)
+            if key is not None:
+                if ret is None:
+                    ret = {}
+                ret.update(self.entries[key])
+            return ret
+
+    def get(self, frame_time, name, default=None):
+        '''return one field for a frame, or default'''
+        fields = self.lookup(frame_time)
+        if fields is None:
+            return default
+        return fields.get(name, default)
+
+    def _find(self, frame_time):
+        '''find the in-memory key for a frame time'''
+        i = bisect.bisect_left(self.times, frame_time - self.tolerance)
+        if i < len(self.times) and self.times[i] <= frame_time + self.tolerance:
+            return self.times[i]
+        return None
+
+    def _expire(self):
+        '''evict old entries'''
+        if len(self.times) == 0:
+            return
+        oldest_allowed = self.times[-1] - self.max_age
+        n = max(len(self.times) - self.max_entries, 0)
+        while n < len(self.times) and self.times[n] < oldest_allowed:
+            n += 1
+        if n == 0:
+            return
+        evicted = [(t, self.entries.pop(t)) for t in self.times[:n]]
+        del self.times[:n]
+        self._spill(evicted)
+
+    def _add_spill_index(self, t, ofs):
+        '''add a spilled record to the index, keeping it sorted by time'''
+        i = bisect.bisect_right(self.spill_times, t)
+        self.spill_times.insert(i, t)
+        self.spill_offsets.insert(i, ofs)
+
+    def _spill(self, evicted):
+        '''append evicted entries to the spill file'''
+        if self.spill_filename is None:
+            return
+        try:
+            with open(self.spill_filename, 'ab') as f:
+                f.seek(0, os.SEEK_END)
+                for (t, fields) in evicted:
+                    self._add_spill_index(t, f.tell())
+                    cPickle.dump((t, fields), f, cPickle.HIGHEST_PROTOCOL)
+        except IOError:
+            pass
+
+    def _spill_lookup(self, frame_time):
+        '''find a frame in the spill file, merging all records for it'''
+        if self.spill_filename is None:
+            return None
+        i = bisect.bisect_left(self.spill_times, frame_time - self.tolerance)
+        if i == len(self.spill_times) or self.spill_times[i] > frame_time + self.tolerance:
+            return None
+        ret = None
+        try:
+            with open(self.spill_filename, 'rb') as f:
+                while i < len(self.spill_times) and self.spill_times[i] <= frame_time + self.tolerance:
+                    f.seek(self.spill_offsets[i])
+                    (t, fields) = cPickle.load(f)
+                    if ret is None:
+                        ret = {}
+                    ret.update(fields)
+                    i += 1
+        except (IOError, EOFError):
+            return None
+        return ret
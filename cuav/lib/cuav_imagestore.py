@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+'''
+managed store of captured image files on the aircraft
+
+Captured images are added as they are queued for scanning, and marked
+once scanned. When the store is over its byte budget, or the disk is
+low on free space, the oldest scanned images that produced no regions
+are deleted. Images that produced regions, were requested by the GCS
+or are still waiting to be scanned are never deleted. With no limits
+set nothing is deleted, so images are forgotten once scanned.
+'''
+
+import os, bisect, threading, collections
+
+# image states
+PENDING = 0
+SCANNED = 1
+KEEP = 2
+
+
+class ImageStore:
+    '''track captured image files, deleting old ones to stay within limits
+
+    max_bytes: bytes of images to keep, 0 for no limit (default 0)
+    min_free:  bytes of free disk space to keep, 0 for no limit (default 0)
+    tolerance: maximum difference in seconds for a frame time to match (default 0.005)
+    '''
+    def __init__(self, max_bytes=0, min_free=0, tolerance=0.005):
+        self.max_bytes = max_bytes
+        self.min_free = min_free
+        self.tolerance = tolerance
+        self.lock = threading.Lock()
+        self.times = []
+        self.images = {}
+        self.candidates = collections.deque()
+        self.total_bytes = 0
+        self.evicted = 0
+        self.directory = None
+
+    def __len__(self):
+        return len(self.times)
+
+    def __str__(self):
+        return '%u/%.1fMB/%u' % (len(self.times), self.total_bytes/1.0e6, self.evicted)
+
+    def add(self, frame_time, filename):
+        '''add a newly captured image, waiting to be scanned'''
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            return
+        frame_time = float(frame_time)
+        with self.lock:
+            if self._find(frame_time) is not None:
+                return
+            bisect.insort(self.times, frame_time)
+            self.images[frame_time] = [filename, size, PENDING]
+            self.total_bytes += size
+            self.directory = os.path.dirname(filename)
+            self._prune()
+
+    def scanned(self, frame_time, keep=False):
+        '''mark an image as scanned. If keep is set (the image produced
+        regions) then it is never deleted'''
+        with self.lock:
+            key = self._find(float(frame_time))
+            if key is None or self.images[key][2] == KEEP:
+                return
+            if self.max_bytes <= 0 and self.min_free <= 0:
+                # without limits the index would grow for the whole flight
+                self._remove(key)
+                return
+            if keep:
+                self.images[key][2] = KEEP
+                return
+            self.images[key][2] = SCANNED
+            self.candidates.append(key)
+            self._prune()
+
+    def keep(self, frame_time):
+        '''never delete an image, such as one requested by the GCS'''
+        with self.lock:
+            key = self._find(float(frame_time))
+            if key is not None:
+                self.images[key][2] = KEEP
+
+    def lookup(self, frame_time):
+        '''return the filename of a stored image, or None'''
+        with self.lock:
+            key = self._find(float(frame_time))
+            if key is None:
+                return None
+            return self.images[key][0]
+
+    def _find(self, frame_time):
+        '''find the key for a frame time'''
+        i = bisect.bisect_left(self.times, frame_time - self.tolerance)
+        if i < len(self.times) and self.times[i] <= frame_time + self.tolerance:
+            return self.times[i]
+        return None
+
+    def _free_space(self):
+        '''return free disk space in bytes, or None if unknown'''
+        try:
+            stat = os.statvfs(self.directory)
+        except (AttributeError, OSError, TypeError):
+            return None
+        return stat.f_bavail * stat.f_frsize
+
+    def _prune(self):
+        '''delete the oldest scanned images without regions while over limits'''
+        need = 0
+        if self.max_bytes > 0:
+            need = self.total_bytes - self.max_bytes
+        if self.min_free > 0:
+            free = self._free_space()
+            if free is not None:
+                need = max(need, self.min_free - free)
+        while need > 0 and self.candidates:
+            key = self.candidates.popleft()
+            image = self.images.get(key)
+            if image is None or image[2] != SCANNED:
+                # since kept or removed
+                continue
+            try:
+                os.remove(image[0])
+            except OSError:
+                pass
+            need -= self._remove(key)
+            self.evicted += 1
+
+    def _remove(self, key):
+        '''stop tracking an image, returning its size'''
+        (filename, size, state) = self.images.pop(key)
+        self.times.pop(bisect.bisect_left(self.times, key))
+        self.total_bytes -= size
+        return size
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+'''
+region-local decoding of JPEG images
+
+A baseline JPEG written with restart markers can be cut up without
+decoding it. Each restart interval holds a fixed number of MCUs (the
+8x8 or 16x16 blocks the image is coded in) and starts with fresh DC
+predictors, so when the interval evenly divides a row of MCUs, or is a
+whole number of rows, the intervals form a grid of tiles. The tiles
+covering a window of the image can be copied into a new, smaller JPEG
+with the same tables, and only that is decoded.
+
+JpegImage decodes windows this way where it can, and falls back to a
+full decode (kept for later calls) for JPEGs without usable restart
+markers, such as progressive images.
+'''
+
+import re, struct
+import numpy, cv2
+
+# start of frame markers for single scan huffman coded images, and
+# for all the others (progressive, lossless or arithmetic coded)
+SOF_BASELINE = ['\xc0', '\xc1']
+SOF_OTHER = ['\xc2', '\xc3', '\xc5', '\xc6', '\xc7', '\xc9', '\xca', '\xcb', '\xcd', '\xce', '\xcf']
+RST_RE = re.compile('\xff[\xd0-\xd7]')
+
+
+class JpegImage:
+    '''a JPEG image, decoded lazily
+
+    filename:  JPEG file to read
+    rotate180: give coordinates and pixels as if rotated by 180 degrees (default False)
+    '''
+    def __init__(self, filename, rotate180=False):
+        self.filename = filename
+        self.rotate180 = rotate180
+        self.data = None
+        self.img = None
+        self.width = None
+        self.height = None
+        self.tiles = None
+        self.full_decodes = 0
+        self.window_decodes = 0
+
+    def _parse(self):
+        '''read the file and find the tiles, if it can be cropped'''
+        if self.data is not None:
+            return
+        with open(self.filename, 'rb') as f:
+            self.data = f.read()
+        try:
+            self._parse_markers()
+        except (IndexError, struct.error):
+            self.tiles = None
+
+    def _parse_markers(self):
+        '''parse the JPEG headers and the restart intervals of the scan'''
+        data = self.data
+        if data[:2] != '\xff\xd8':
+            return
+        ofs = 2
+        sof = None
+        restart_interval = 0
+        while True:
+            while data[ofs] == '\xff' and data[ofs+1] == '\xff':
+                # fill bytes
+                ofs += 1
+            if data[ofs] != '\xff':
+                return
+            marker = data[ofs+1]
+            (length,) = struct.unpack_from('>H', data, ofs+2)
+            if marker in SOF_BASELINE:
+                sof = ofs
+            elif marker in SOF_OTHER:
+                (self.height, self.width) = struct.unpack_from('>HH', data, ofs+5)
+                return
+            elif marker == '\xdd':
+                (restart_interval,) = struct.unpack_from('>H', data, ofs+4)
+            elif marker == '\xda':
+                break
+            ofs += 2 + length
+        if sof is None:
+            return
+        (self.height, self.width, ncomp) = struct.unpack_from('>HHB', data, sof+5)
+        if ncomp == 1:
+            # a single component scan is never interleaved
+            (mcu_w, mcu_h) = (8, 8)
+        else:
+            hmax = vmax = 1
+            for i in range(ncomp):
+                sampling = ord(data[sof+11+3*i])
+                hmax = max(hmax, sampling >> 4)
+                vmax = max(vmax, sampling & 0xf)
+            (mcu_w, mcu_h) = (8*hmax, 8*vmax)
+        if ord(data[ofs+4]) != ncomp or restart_interval == 0:
+            # not one scan of all components, or no restart markers
+            return
+        mcus_x = (self.width + mcu_w - 1) // mcu_w
+        mcus_y = (self.height + mcu_h - 1) // mcu_h
+        if mcus_x % restart_interval == 0:
+            (tile_w, tile_h) = (restart_interval, 1)
+        elif restart_interval % mcus_x == 0:
+            (tile_w, tile_h) = (mcus_x, restart_interval // mcus_x)
+        else:
+            return
+
+        (length,) = struct.unpack_from('>H', data, ofs+2)
+        scan_start = ofs + 2 + length
+        scan_end = data.find('\xff\xd9', scan_start)
+        if scan_end == -1:
+            return
+        segments = []
+        start = scan_start
+        for m in RST_RE.finditer(data, scan_start, scan_end):
+            segments.append((start, m.start()))
+            start = m.end()
+        segments.append((start, scan_end))
+        tiles_x = mcus_x // tile_w
+        tiles_y = (mcus_y + tile_h - 1) // tile_h
+        if len(segments) != tiles_x * tiles_y:
+            return
+        self.sof = sof
+        self.scan_start = scan_start
+        self.segments = segments
+        self.tiles = (tiles_x, tiles_y, tile_w*mcu_w, tile_h*mcu_h)
+
+    def can_crop(self):
+        '''return True if windows can be decoded without decoding the whole image'''
+        self._parse()
+        return self.tiles is not None
+
+    def shape(self):
+        '''return the (width, height) of the image'''
+        self._parse()
+        if self.width is None:
+            self.decode()
+        return (self.width, self.height)
+
+    def decode(self):
+        '''decode the whole image'''
+        if self.img is None:
+            self._parse()
+            self.img = cv2.imdecode(numpy.frombuffer(self.data, dtype=numpy.uint8), cv2.IMREAD_COLOR)
+            if self.img is None:
+                raise IOError('Failed to decode %s' % self.filename)
+            if self.rotate180:
+                self.img = cv2.flip(self.img, -1)
+            (self.height, self.width) = self.img.shape[:2]
+            self.full_decodes += 1
+        return self.img
+
+    def window(self, x1, y1, x2, y2):
+        '''decode a window of the image covering x1<=x<x2, y1<=y<y2, clipped
+        to the image. Returns a tuple (img, x, y) of the decoded pixels and
+        the position of their top left corner in the image, which may be a
+        larger part of the image than asked for'''
+        (w, h) = self.shape()
+        x1 = min(max(x1, 0), w-1)
+        y1 = min(max(y1, 0), h-1)
+        x2 = min(max(x2, x1+1), w)
+        y2 = min(max(y2, y1+1), h)
+        if self.img is not None or self.tiles is None:
+            return (self.decode(), 0, 0)
+        if self.rotate180:
+            (x1, y1, x2, y2) = (w-x2, h-y2, w-x1, h-y1)
+        (tiles_x, tiles_y, tw, th) = self.tiles
+        (tx1, ty1) = (x1 // tw, y1 // th)
+        (tx2, ty2) = ((x2-1) // tw + 1, (y2-1) // th + 1)
+        (wx, wy) = (tx1*tw, ty1*th)
+        ww = min(tx2*tw, w) - wx
+        wh = min(ty2*th, h) - wy
+        img = cv2.imdecode(numpy.frombuffer(self._crop(tx1, ty1, tx2, ty2, ww, wh), dtype=numpy.uint8),
+                           cv2.IMREAD_COLOR)
+        if img is None or img.shape[:2] != (wh, ww):
+            return (self.decode(), 0, 0)
+        self.window_decodes += 1
+        if self.rotate180:
+            return (cv2.flip(img, -1), w-wx-ww, h-wy-wh)
+        return (img, wx, wy)
+
+    def _crop(self, tx1, ty1, tx2, ty2, width, height):
+        '''build a JPEG of a block of tiles'''
+        data = self.data
+        sof = self.sof
+        parts = [data[:sof+5], struct.pack('>HH', height, width), data[sof+9:self.scan_start]]
+        tiles_x = self.tiles[0]
+        n = 0
+        for ty in range(ty1, ty2):
+            for tx in range(tx1, tx2):
+                if n > 0:
+                    parts.append(chr(0xff) + chr(0xd0 + (n-1) % 8))
+                (start, end) = self.segments[ty*tiles_x + tx]
+                parts.append(data[start:end])
+                n += 1
+        parts.append('\xff\xd9')
+        return ''.join(parts)
+
+
+def restart_interval(width, mcu_size=16, tile_mcus=8):
+    '''return a restart interval for an image width, for use with
+    cv2.IMWRITE_JPEG_RST_INTERVAL so that the image can be decoded by
+    region. This is the largest number of MCUs up to tile_mcus that
+    evenly divides a row. The MCU size is 16 for the default 4:2:0
+    chroma subsampling'''
+    mcus_x = (width + mcu_size - 1) // mcu_size
+    for n in range(min(tile_mcus, mcus_x), 0, -1):
+        if mcus_x % n == 0:
+            return n
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+'''latency tracing for packets from camera_air to camera_ground
+
+Thumbnail and image packets carry a dictionary of stage timestamps
+(see StampedCommand.stamp). The ground station collects these into a
+latency histogram per stage, with the time for each stage measured from
+the previous stage present in the packet.
+'''
+
+import time, threading
+
+# pipeline stages in order. The stages up to 'handoff' are stamped on the
+# aircraft, the rest on the ground station. All are local clock times:
+# 'enqueue' is when a frame was queued for scanning and 'capture' when
+# the decode thread took it from the queue. The frame time of the
+# camera is not a stage, as it may be on another clock. 'handoff' is
+# when the encoded packet is given to the BlockSender, so 'received'
+# covers its send queue, retransmits and the link itself
+STAGES = ['enqueue', 'capture', 'decode', 'scan', 'score', 'queued',
+          'encode', 'handoff', 'received', 'decoded', 'displayed']
+AIR_STAGES = STAGES[:STAGES.index('handoff')+1]
+
+# histogram bin upper bounds in seconds
+BINS = [0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 60]
+
+
+class LatencyHistogram:
+    '''a histogram of latencies in seconds'''
+    def __init__(self, bins=BINS):
+        self.bins = bins
+        self.counts = [0] * (len(bins)+1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, latency):
+        '''add a latency to the histogram'''
+        latency = max(latency, 0.0)
+        i = 0
+        while i < len(self.bins) and latency > self.bins[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += latency
+        self.max = max(self.max, latency)
+
+    def mean(self):
+        '''return the mean latency'''
+        if self.count == 0:
+            return 0
+        return self.total / self.count
+
+    def percentile(self, pct):
+        '''return the upper bound of the bin holding the given percentile'''
+        n = 0
+        for i in range(len(self.counts)):
+            n += self.counts[i]
+            if n * 100.0 >= pct * self.count and n > 0:
+                if i < len(self.bins):
+                    return self.bins[i]
+                return self.max
+        return 0
+
+    def __str__(self):
+        return 'n=%u mean=%.3f p50<=%s p90<=%s max=%.3f' % (
+            self.count, self.mean(), self.percentile(50), self.percentile(90), self.max)
+
+
+class LatencyTracker:
+    '''per-stage latency histograms for each kind of packet. Packets may
+    be added from several threads, and snapshot() taken from another
+
+    logfile: optional file to append a line per packet to (default None)
+    '''
+    def __init__(self, logfile=None):
+        self.logfile = logfile
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def add(self, kind, stamps, clock_offset=0):
+        '''add the stage timestamps of a received packet. clock_offset is
+        the aircraft clock minus the ground clock, as estimated by the
+        BlockSender that received the packet'''
+        delays = []
+        first = None
+        prev = None
+        for stage in STAGES:
+            if stage not in stamps:
+                continue
+            t = stamps[stage]
+            if stage in AIR_STAGES:
+                t -= clock_offset
+            if prev is not None:
+                delays.append((stage, t - prev))
+            else:
+                first = t
+            prev = t
+        with self.lock:
+            for (stage, latency) in delays:
+                self._histogram(kind, stage).add(latency)
+            if first is None or prev is None or prev == first:
+                return
+            self._histogram(kind, 'total').add(prev - first)
+        if self.logfile is not None:
+            try:
+                with open(self.logfile, 'a') as f:
+                    f.write('%.3f %s total=%.3f %s\n' % (time.time(), kind, prev - first,
+                                                         ' '.join(['%s=%.3f' % d for d in delays])))
+            except IOError:
+                pass
+
+    def histogram(self, kind, stage):
+        '''get the histogram for one stage of one kind of packet'''
+        with self.lock:
+            return self._histogram(kind, stage)
+
+    def _histogram(self, kind, stage):
+        '''get a histogram, with the lock held'''
+        key = (kind, stage)
+        if key not in self.histograms:
+            self.histograms[key] = LatencyHistogram()
+        return self.histograms[key]
+
+    def snapshot(self):
+        '''return a LatencyTracker holding the latencies added so far, and
+        start again with empty histograms'''
+        ret = LatencyTracker()
+        with self.lock:
+            (ret.histograms, self.histograms) = (self.histograms, {})
+        return ret
+
+    def means(self, kind):
+        '''return a dictionary of stage to mean latency for one kind of packet'''
+        ret = {}
+        for (k, stage) in self.histograms.keys():
+            if k == kind:
+                ret[stage] = self.histograms[(k, stage)].mean()
+        return ret
+
+    def report(self):
+        '''return a multi-line summary of the latency histograms'''
+        ret = []
+        for kind in sorted(set([k for (k, s) in self.histograms.keys()])):
+            for stage in STAGES[1:] + ['total']:
+                if (kind, stage) in self.histograms:
+                    ret.append('%s %s: %s' % (kind, stage, self.histograms[(kind, stage)]))
+        return '\n'.join(ret)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+'''
+batched UDP send and receive with sendmmsg() and recvmmsg()
+
+Linux can send or receive many datagrams in one system call with
+sendmmsg() and recvmmsg(), which python has no binding for. This
+module calls them through ctypes for IPv4 UDP sockets. available()
+says if they can be used, so callers can fall back to sendto() and
+recvfrom() on other systems.
+
+Errors are raised as socket.error, as for the socket methods.
+'''
+
+import os, socket, struct, errno
+import ctypes, ctypes.util
+
+MSG_DONTWAIT = 0x40
+SOCKADDR_IN_SIZE = 16
+
+# errors that mean the socket buffer is full or empty
+WOULD_BLOCK = [errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS]
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.POINTER(iovec)),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", msghdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+def _load_libc():
+    '''load the C library, returning None if it lacks sendmmsg/recvmmsg'''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+libc = _load_libc()
+
+# the message headers are also accessed as arrays of words, which is
+# much quicker from python than going through the structure fields
+WORD = ctypes.c_size_t
+MSG_WORDS = ctypes.sizeof(mmsghdr) // ctypes.sizeof(WORD)
+MSG_LEN_INDEX = mmsghdr.msg_len.offset // ctypes.sizeof(ctypes.c_uint)
+MSG_UINTS = ctypes.sizeof(mmsghdr) // ctypes.sizeof(ctypes.c_uint)
+
+
+def available():
+    '''return True if sendmmsg() and recvmmsg() can be used'''
+    return libc is not None
+
+
+def _raise_errno():
+    '''raise a socket.error for the errno of the last call'''
+    e = ctypes.get_errno()
+    raise socket.error(e, os.strerror(e))
+
+
+class MmsgSocket:
+    '''batched send and receive on an IPv4 UDP socket
+
+    sock:  the socket, which should be non-blocking
+    count: most datagrams to send or receive in one call (default 32)
+    size:  largest datagram that can be received (default 65536)
+    '''
+    def __init__(self, sock, count=32, size=65536):
+        if not available():
+            raise socket.error(errno.ENOSYS, 'sendmmsg/recvmmsg not available')
+        self.sock = sock
+        self.count = count
+        self.size = size
+        self.addresses = {}
+        self.sources = {}
+
+        # receive buffers, one datagram and address per message
+        self.recv_data = ctypes.create_string_buffer(count * size)
+        self.recv_names = ctypes.create_string_buffer(count * SOCKADDR_IN_SIZE)
+        self.recv_iov = (iovec * count)()
+        self.recv_msgs = (mmsghdr * count)()
+        data_base = ctypes.addressof(self.recv_data)
+        name_base = ctypes.addressof(self.recv_names)
+        for i in range(count):
+            self.recv_iov[i].iov_base = data_base + i * size
+            self.recv_iov[i].iov_len = size
+            hdr = self.recv_msgs[i].msg_hdr
+            hdr.msg_name = name_base + i * SOCKADDR_IN_SIZE
+            hdr.msg_namelen = SOCKADDR_IN_SIZE
+            hdr.msg_iov = ctypes.pointer(self.recv_iov[i])
+            hdr.msg_iovlen = 1
+        self.recv_lengths = (ctypes.c_uint * (count * MSG_UINTS)).from_buffer(self.recv_msgs)
+
+        # send messages, pointing into a buffer the datagrams are gathered in
+        self.send_iov = (iovec * count)()
+        self.send_msgs = (mmsghdr * count)()
+        for i in range(count):
+            hdr = self.send_msgs[i].msg_hdr
+            hdr.msg_namelen = SOCKADDR_IN_SIZE
+            hdr.msg_iov = ctypes.pointer(self.send_iov[i])
+            hdr.msg_iovlen = 1
+        self.send_words = (WORD * (count * MSG_WORDS)).from_buffer(self.send_msgs)
+        self.send_iov_words = (WORD * (count * 2)).from_buffer(self.send_iov)
+        self._alloc_send(65536)
+
+    def _alloc_send(self, size):
+        '''allocate the buffer datagrams are gathered into for sending'''
+        self.send_buffer = bytearray(size)
+        self.send_view = memoryview(self.send_buffer)
+        self.send_array = (ctypes.c_char * size).from_buffer(self.send_buffer)
+        self.send_base = ctypes.addressof(self.send_array)
+
+    def _sockaddr(self, dest):
+        '''return the address of a sockaddr_in for a (host, port) tuple'''
+        addr = self.addresses.get(dest, None)
+        if addr is None:
+            (host, port) = dest
+            try:
+                ip = socket.inet_aton(host)
+            except socket.error:
+                ip = socket.inet_aton(socket.gethostbyname(host))
+            raw = struct.pack('=H', socket.AF_INET) + struct.pack('>H', port) + ip
+            buf = ctypes.create_string_buffer(raw, SOCKADDR_IN_SIZE)
+            addr = (buf, ctypes.addressof(buf))
+            self.addresses[dest] = addr
+        return addr[1]
+
+    def _source(self, name):
+        '''return the (host, port) tuple for the port and IP of a sockaddr_in'''
+        src = self.sources.get(name, None)
+        if src is None:
+            (port,) = struct.unpack('>H', name[:2])
+            src = (socket.inet_ntoa(name[2:]), port)
+            self.sources[name] = src
+        return src
+
+    def recvmmsg(self):
+        '''receive up to count datagrams without blocking. Returns a list
+        of (data, (host, port)) tuples, as recvfrom() would'''
+        n = libc.recvmmsg(self.sock.fileno(), self.recv_msgs, self.count, MSG_DONTWAIT, None)
+        if n < 0:
+            _raise_errno()
+        ret = []
+        names = self.recv_names[:n*SOCKADDR_IN_SIZE]
+        for i in range(n):
+            start = i * self.size
+            data = self.recv_data[start:start+self.recv_lengths[i*MSG_UINTS + MSG_LEN_INDEX]]
+            ofs = i * SOCKADDR_IN_SIZE
+            ret.append((data, self._source(names[ofs+2:ofs+8])))
+        return ret
+
+    def sendmmsg(self, packets):
+        '''send a list of (buffers, (host, port)) datagrams, each made up of
+        a list of buffers. Returns the number sent, which is less than the
+        number of packets if the socket buffer filled. An error after some
+        were sent is left to be raised by the next call'''
+        total = 0
+        for (parts, dest) in packets:
+            for p in parts:
+                total += len(p)
+        if total > len(self.send_buffer):
+            self._alloc_send(total)
+        sent = 0
+        ofs = 0
+        fd = self.sock.fileno()
+        while sent < len(packets):
+            batch = packets[sent:sent+self.count]
+            for i in range(len(batch)):
+                (parts, dest) = batch[i]
+                start = ofs
+                for p in parts:
+                    self.send_view[ofs:ofs+len(p)] = p
+                    ofs += len(p)
+                self.send_iov_words[2*i] = self.send_base + start
+                self.send_iov_words[2*i+1] = ofs - start
+                self.send_words[i*MSG_WORDS] = self._sockaddr(dest)
+            n = libc.sendmmsg(fd, self.send_msgs, len(batch), 0)
+            if n < 0:
+                if sent > 0 or ctypes.get_errno() in WOULD_BLOCK:
+                    break
+                _raise_errno()
+            sent += n
+            if n < len(batch):
+                break
+        return sent
@@ -13,7 +13,7 @@ from MAVProxy.modules.lib.mp_menu import *
 from MAVProxy.modules.lib.wxsettings import WXSettings
 
 class MosaicRegion:
-    def __init__(self, ridx, region, filename, pos, full_thumbnail, small_thumbnail, latlon=(None,None)):
+    def __init__(self, ridx, region, filename, pos, full_thumbnail, small_thumbnail, latlon=(None,None), hits=1):
         # self.region is a (minx,miny,maxy,maxy) rectange in image coordinates
         self.region = region
         self.filename = filename
@@ -23,6 +23,8 @@ class MosaicRegion:
         self.latlon = latlon
         self.ridx = ridx
         self.score = region.score
+        # the number of times the aircraft has seen this target
+        self.hits = hits
 
     def tag_image_available(self, color=(0,255,255)):
         '''tag the small thumbnail image with a marker making it clear the
@@ -36,6 +38,8 @@ class MosaicRegion:
             position_string += '%s ' % str(self.latlon)
         if self.pos != None:
             position_string += ' %s %s' % (str(self.pos), time.asctime(time.localtime(self.pos.time)))
+        if self.hits > 1:
+            position_string += ' hits=%u' % self.hits
         return '%s %s' % (position_string, self.filename)
 
 
@@ -86,6 +90,7 @@ class Mosaic():
         self.regions_hidden = set()
         self.mouse_region = None
         self.ridx_by_frame_time = {}
+        self.ridx_by_track = {}
         self.page = 0
         self.sort_type = 'Score'
         self.images = []
@@ -220,16 +225,18 @@ class Mosaic():
         if region.pos is not None:
             if region.pos.altitude is None:
                 region.pos.altitude = 0
-            region_text = "Selected region %u score=%u/%.2f %s\n%s alt=%u yaw=%d\n%s\t\t" % (ridx, region.score,
+            region_text = "Selected region %u score=%u/%.2f hits=%u %s\n%s alt=%u yaw=%d\n%s\t\t" % (ridx, region.score,
                                                                                             region.region.scan_score,
+                                                                                            region.hits,
                                                                                             region.region.center(),
                                                                                             str(region.latlon),
                                                                                             region.pos.altitude,
                                                                                             region.pos.yaw,
                                                                                             os.path.basename(region.filename))
         else:
-            region_text = "Selected region %u score=%u/%.2f %s\n%s alt=N/A yaw=N/A\n%s\t\t" % (ridx, region.score,
+            region_text = "Selected region %u score=%u/%.2f hits=%u %s\n%s alt=N/A yaw=N/A\n%s\t\t" % (ridx, region.score,
                                                                                     region.region.scan_score,
+                                                                                    region.hits,
                                                                                     region.region.center(),
                                                                                     str(region.latlon),
                                                                                     os.path.basename(region.filename))
@@ -749,10 +756,19 @@ class Mosaic():
             thumb = cv2.resize(full, (size, size))
         return thumb
 
-    def add_regions(self, regions, thumbs, filename, pos=None):
-        '''add some regions'''
+    def add_regions(self, regions, thumbs, filename, pos=None, hits=None, tracks=None):
+        '''add some regions. hits and tracks are optional lists of the
+        number of sightings and the track id of each region's target, as
+        in a ThumbPacket. A region with the track id of one already in
+        the mosaic replaces it, as a better view of the same target'''
         for i in range(len(regions)):
             r = regions[i]
+            region_hits = 1
+            if hits is not None:
+                region_hits = hits[i]
+            track_id = None
+            if tracks is not None:
+                track_id = tracks[i]
 
             latlon = r.latlon
             if latlon is None:
@@ -773,20 +789,41 @@ class Mosaic():
             full_thumb = thumbs[i]
             thumb = self.make_thumb(full_thumb, r, self.thumb_size)
 
-            ridx = len(self.regions)
-            self.regions.append(MosaicRegion(ridx, r, filename, pos, thumbs[i], thumb, latlon=(lat,lon)))
-            self.regions_sorted.append(self.regions[-1])
+            frame_time = cuav_util.parse_frame_time(filename)
+            if track_id in self.ridx_by_track:
+                ridx = self.ridx_by_track[track_id]
+                old = self.regions[ridx]
+                self.regions[ridx] = MosaicRegion(ridx, r, filename, pos, thumbs[i], thumb,
+                                                  latlon=(lat,lon), hits=region_hits)
+                if ridx in self.regions_hidden:
+                    # the better view may now be worth showing
+                    self.regions_hidden.discard(ridx)
+                    self.slipmap.hide_object("region %u" % ridx, hide=False)
+                    self.regions_sorted.append(self.regions[ridx])
+                else:
+                    self.regions_sorted[self.regions_sorted.index(old)] = self.regions[ridx]
+                if self.mouse_region is old:
+                    self.mouse_region = self.regions[ridx]
+                old_frame_time = cuav_util.parse_frame_time(old.filename)
+                if ridx in self.ridx_by_frame_time.get(old_frame_time, []):
+                    self.ridx_by_frame_time[old_frame_time].remove(ridx)
+            else:
+                ridx = len(self.regions)
+                self.regions.append(MosaicRegion(ridx, r, filename, pos, thumbs[i], thumb,
+                                                 latlon=(lat,lon), hits=region_hits))
+                self.regions_sorted.append(self.regions[-1])
+                if track_id is not None:
+                    self.ridx_by_track[track_id] = ridx
 
             max_page = (len(self.regions_sorted)-1) / self.display_regions
             self.image_mosaic.set_title("Mosaic (Page %u of %u)" % (self.page+1, max(max_page+1, 1)))
 
-            frame_time = cuav_util.parse_frame_time(filename)
             if not frame_time in self.ridx_by_frame_time:
                 self.ridx_by_frame_time[frame_time] = [ridx]
             else:
                 self.ridx_by_frame_time[frame_time].append(ridx)
 
-            self.display_mosaic_region(len(self.regions_sorted)-1)
+            self.display_mosaic_region(self.regions_sorted.index(self.regions[ridx]))
 
             if (lat,lon) != (None,None):
                 mapthumb = thumb
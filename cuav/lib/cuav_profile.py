@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+'''
+sampling profiler for the camera modules
+
+A background thread samples the stacks of all other threads at a fixed
+interval for a set duration. The samples are kept as collapsed stacks,
+one line per distinct stack of the form
+
+  thread;outer_function (file:line);...;inner_function (file:line) count
+
+which can be turned into a flame graph with flamegraph.pl or speedscope.
+'''
+
+import sys, os, time, threading
+
+
+class SamplingProfiler:
+    '''sample the stacks of all threads
+
+    interval: seconds between samples (default 0.01)
+    '''
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = {}
+        self.sample_count = 0
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def running(self):
+        '''return True if a profile is in progress'''
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, duration, callback=None):
+        '''start sampling for duration seconds. callback is called with the
+        profiler from the sampling thread when it finishes'''
+        self.samples = {}
+        self.sample_count = 0
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._sample_threadfunc, args=(duration, callback))
+        self.thread.name = 'profiler'
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        '''stop sampling early'''
+        self.stop_event.set()
+
+    def _sample_threadfunc(self, duration, callback):
+        '''sampling thread'''
+        tend = time.time() + duration
+        while time.time() < tend and not self.stop_event.wait(self.interval):
+            self.sample()
+        if callback is not None:
+            callback(self)
+
+    def sample(self):
+        '''take one sample of every thread but the calling one'''
+        names = {}
+        for t in threading.enumerate():
+            names[t.ident] = t.name
+        me = threading.current_thread().ident
+        for (ident, frame) in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%u)' % (code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            stack.reverse()
+            key = ';'.join(stack)
+            self.samples[key] = self.samples.get(key, 0) + 1
+        self.sample_count += 1
+
+    def write(self, filename):
+        '''write the samples as collapsed stacks'''
+        with open(filename, 'w') as f:
+            for key in sorted(self.samples.keys()):
+                f.write('%s %u\n' % (key, self.samples[key]))
+
+    def summary(self, count=10):
+        '''return a summary of the functions with the most samples, counting
+        the innermost frame of each stack'''
+        totals = {}
+        total = 0
+        for (key, n) in self.samples.items():
+            stack = key.split(';')
+            leaf = '%s: %s' % (stack[0], stack[-1])
+            totals[leaf] = totals.get(leaf, 0) + n
+            total += n
+        if total == 0:
+            return 'no samples'
+        top = sorted(totals.items(), key=lambda t: t[1], reverse=True)[:count]
+        return '\n'.join(['%5.1f%% %s' % (100.0 * n / total, leaf) for (leaf, n) in top])
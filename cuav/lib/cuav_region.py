@@ -237,25 +237,70 @@ def filter_radius(regions, latlon, radius):
 def CompositeThumbnail(img, regions, thumb_size=100):
     '''extract a composite thumbnail for the regions of an image
 
-    The composite will consist of N thumbnails side by side
+    The composite will consist of N thumbnails side by side. It is
+    allocated once, and each thumbnail is copied or resized straight
+    into its place in the composite
     '''
-    composite = []
+    if len(regions) == 0:
+        return []
+    (w,h) = cuav_util.image_shape(img)
+    composite = numpy.zeros((thumb_size, len(regions)*thumb_size, 3), dtype=img.dtype)
     for i in range(len(regions)):
         (x1,y1,x2,y2) = regions[i].tuple()
-        midx = (x1+x2)/2
-        midy = (y1+y2)/2
+        midx = (x1+x2)//2
+        midy = (y1+y2)//2
+        dest = composite[:, i*thumb_size:(i+1)*thumb_size]
 
         if (x2-x1) > thumb_size or (y2-y1) > thumb_size:
             # we need to shrink the region
             rsize = max(x2+1-x1, y2+1-y1)
-            src = cuav_util.SubImage(img, (midx-rsize/2,midy-rsize/2,rsize,rsize))
-            thumb = cv2.resize(src, (thumb_size, thumb_size))
-        else:
-            x1 = midx - thumb_size/2
-            y1 = midy - thumb_size/2
-            thumb = cuav_util.SubImage(img, (x1, y1, thumb_size, thumb_size))
-        if composite == []:
-            composite = thumb
+            x1 = midx - rsize//2
+            y1 = midy - rsize//2
+            if x1 >= 0 and y1 >= 0 and x1+rsize <= w and y1+rsize <= h:
+                src = img[y1:y1+rsize, x1:x1+rsize]
+            else:
+                src = cuav_util.SubImage(img, (x1,y1,rsize,rsize))
+            dest[:] = cv2.resize(src, (thumb_size, thumb_size))
         else:
-            composite = numpy.concatenate((composite, thumb), axis=1)
+            x1 = midx - thumb_size//2
+            y1 = midy - thumb_size//2
+            if x1 >= 0 and y1 >= 0 and x1+thumb_size <= w and y1+thumb_size <= h:
+                dest[:] = img[y1:y1+thumb_size, x1:x1+thumb_size]
+            else:
+                cuav_util.SubImage(img, (x1, y1, thumb_size, thumb_size), dest=dest)
+    return composite
+
+def CompositeThumbnailJpeg(jpeg, regions, thumb_size=100, max_regions=4):
+    '''extract a composite thumbnail for the regions of a
+    cuav_jpeg.JpegImage, decoding only the parts of the image around
+    each region. With more than max_regions regions, or a JPEG that
+    can't be decoded by region, the whole image is decoded instead'''
+    if len(regions) == 0:
+        return []
+    if len(regions) > max_regions or not jpeg.can_crop():
+        return CompositeThumbnail(jpeg.decode(), regions, thumb_size)
+    composite = numpy.zeros((thumb_size, len(regions)*thumb_size, 3), dtype=numpy.uint8)
+    for i in range(len(regions)):
+        (x1,y1,x2,y2) = regions[i].tuple()
+        midx = (x1+x2)//2
+        midy = (y1+y2)//2
+        # the area CompositeThumbnail takes for this region
+        rsize = max(x2+1-x1, y2+1-y1, thumb_size)
+        (img, ox, oy) = jpeg.window(midx - rsize//2, midy - rsize//2,
+                                    midx - rsize//2 + rsize, midy - rsize//2 + rsize)
+        r = Region(x1-ox, y1-oy, x2-ox, y2-oy, regions[i].scan_shape)
+        composite[:, i*thumb_size:(i+1)*thumb_size] = CompositeThumbnail(img, [r], thumb_size)
     return composite
+
+def ScaleRegions(regions, scan_shape, full_shape):
+    '''map a list of Regions from the shape of a scanned image to the
+    shape of the full image, which becomes their scan_shape'''
+    (scan_w, scan_h) = scan_shape
+    (full_w, full_h) = full_shape
+    for r in regions:
+        r.x1 = (r.x1 * full_w) // scan_w
+        r.x2 = (r.x2 * full_w) // scan_w
+        r.y1 = (r.y1 * full_h) // scan_h
+        r.y2 = (r.y2 * full_h) // scan_h
+        r.scan_shape = full_shape
+    return regions
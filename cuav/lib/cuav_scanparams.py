@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+'''
+scanner parameter snapshots for camera_air
+
+The scanner parameters are built from the image settings and, when the
+terrain altitude is known, the ground size of a pixel. ScanParams keeps
+the parameter dictionary between frames, rebuilding it only when a
+setting changes or the altitude moves by more than a set fraction. A
+rebuild makes a new dictionary rather than changing the old one, so a
+frame being scanned always sees one consistent set of parameters.
+'''
+
+from cuav.lib import cuav_util
+
+
+class ScanParams:
+    '''a snapshot of the scanner parameters
+
+    alt_change: fractional change in altitude that triggers a rebuild (default 0.05)
+    '''
+    def __init__(self, alt_change=0.05):
+        self.alt_change = alt_change
+        self.parms = None
+        self.altitude = None
+        self.last_change = None
+        self.rebuilds = 0
+
+    def get(self, image_settings, camera_settings, c_params, terrain_alt, scale=1):
+        '''return the parameter dictionary to pass to scanner.scan(). scale
+        is the number of full resolution pixels per scanned pixel'''
+        altitude = terrain_alt
+        if altitude is not None and altitude < camera_settings.minalt:
+            altitude = camera_settings.minalt
+        last_change = (image_settings.last_change(), camera_settings.last_change(), scale)
+        if (self.parms is None or last_change != self.last_change or
+            self._altitude_changed(altitude)):
+            self.parms = self._build(image_settings, c_params, altitude, scale)
+            self.altitude = altitude
+            self.last_change = last_change
+            self.rebuilds += 1
+        return self.parms
+
+    def _altitude_changed(self, altitude):
+        '''see if the altitude has moved enough to change the pixel size'''
+        if altitude is None or self.altitude is None:
+            return altitude != self.altitude
+        return abs(altitude - self.altitude) > self.alt_change * self.altitude
+
+    def _build(self, image_settings, c_params, altitude, scale):
+        '''build a new parameter dictionary'''
+        parms = {}
+        for name in image_settings.list():
+            parms[name] = image_settings.get(name)
+        if altitude is not None:
+            parms['MetersPerPixel'] = cuav_util.pixel_width(altitude,
+                                                            c_params.xresolution,
+                                                            c_params.lens,
+                                                            c_params.sensorwidth) * scale
+        return parms
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+'''
+shared memory ring buffer for passing captured frames to camera_air
+
+A capture program writes raw frames with FrameRingWriter into a memory
+mapped file (normally in /dev/shm), and camera_air reads them with
+FrameRingReader, so frames don't have to be written to and read back
+from the SD card before they are scanned. The capture program can
+still save the frames to disk for archiving, passing the filename with
+each frame so that image requests from the GCS can find them.
+
+The file holds a header followed by a fixed number of slots:
+
+  header: magic, version, num_slots, slot_size, write_seq
+  slot:   seq_start, seq_end, frame_time, height, width, channels,
+          itemsize, nbytes, filename, then slot_size bytes of data
+
+Frame n (counting from 1) goes in slot (n-1) % num_slots. The writer
+sets seq_start before and seq_end after filling a slot, then updates
+write_seq. A reader copies a slot and only accepts it if both sequence
+numbers match the frame it wanted, so a slot overwritten while being
+read is dropped rather than returned torn.
+
+This module works with both python2 and python3 so that capture
+programs can use it.
+'''
+
+import os, mmap, struct
+import numpy
+
+MAGIC = b'CUAVRING'
+VERSION = 1
+HEADER_FORMAT = '<8sIIQQ'
+HEADER_SIZE = 64
+SLOT_FORMAT = '<QQdIIIIQ256s'
+SLOT_HEADER_SIZE = 320
+WRITE_SEQ_OFFSET = struct.calcsize('<8sIIQ')
+
+
+class FrameRingException(Exception):
+    '''frame ring error'''
+    def __init__(self, msg):
+        Exception.__init__(self, msg)
+
+
+def ring_size(num_slots, slot_size):
+    '''return the size of a ring file'''
+    return HEADER_SIZE + num_slots * (SLOT_HEADER_SIZE + slot_size)
+
+
+class FrameRingWriter:
+    '''write frames into a shared memory ring
+
+    path:      file to map, for example /dev/shm/cuav_ring
+    num_slots: number of frames held (default 4)
+    slot_size: maximum bytes in a frame (default 1280*960*3)
+    '''
+    def __init__(self, path, num_slots=4, slot_size=1280*960*3):
+        self.num_slots = num_slots
+        self.slot_size = slot_size
+        size = ring_size(num_slots, slot_size)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.file = os.fdopen(fd, 'r+b')
+        # only ever grow the file, as a reader may have it mapped
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)
+        self.mm = mmap.mmap(fd, size)
+        self.write_seq = 0
+        (magic, version, nslots, ssize, seq) = struct.unpack_from(HEADER_FORMAT, self.mm, 0)
+        if magic == MAGIC and version == VERSION and nslots == num_slots and ssize == slot_size:
+            # carry on from a previous writer, so readers see new frames
+            self.write_seq = seq
+        struct.pack_into(HEADER_FORMAT, self.mm, 0, MAGIC, VERSION, num_slots, slot_size, self.write_seq)
+
+    def write(self, frame_time, img, filename=''):
+        '''add a frame. img is a numpy array of up to 3 dimensions.
+        filename is where the frame is being saved to, if anywhere'''
+        img = numpy.ascontiguousarray(img)
+        if img.nbytes > self.slot_size:
+            raise FrameRingException('frame of %u bytes too large for slot size %u' % (img.nbytes, self.slot_size))
+        shape = img.shape + (1, 1)
+        seq = self.write_seq + 1
+        ofs = HEADER_SIZE + ((seq-1) % self.num_slots) * (SLOT_HEADER_SIZE + self.slot_size)
+        struct.pack_into('<Q', self.mm, ofs, seq)
+        dest = numpy.frombuffer(self.mm, dtype=numpy.uint8, count=img.nbytes, offset=ofs+SLOT_HEADER_SIZE)
+        dest[:] = img.reshape(-1).view(numpy.uint8)
+        if not isinstance(filename, bytes):
+            filename = filename.encode('utf-8')
+        struct.pack_into(SLOT_FORMAT, self.mm, ofs, seq, seq, frame_time,
+                         shape[0], shape[1], shape[2], img.itemsize, img.nbytes, filename)
+        self.write_seq = seq
+        struct.pack_into('<Q', self.mm, WRITE_SEQ_OFFSET, seq)
+
+    def close(self):
+        '''close the ring'''
+        self.mm.close()
+        self.file.close()
+
+
+class FrameRingReader:
+    '''read frames from a shared memory ring
+
+    path: file written by a FrameRingWriter
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        if size < HEADER_SIZE:
+            self.file.close()
+            raise FrameRingException('%s is not a frame ring' % path)
+        self.mm = mmap.mmap(self.file.fileno(), size, access=mmap.ACCESS_READ)
+        (magic, version, self.num_slots, self.slot_size, seq) = struct.unpack_from(HEADER_FORMAT, self.mm, 0)
+        if magic != MAGIC or version != VERSION or size < ring_size(self.num_slots, self.slot_size):
+            self.close()
+            raise FrameRingException('%s is not a version %u frame ring' % (path, VERSION))
+        # only frames written after we start are read
+        self.last_seq = seq
+        self.dropped = 0
+
+    def changed(self):
+        '''return True if the writer has restarted with a different layout,
+        in which case the reader should be reopened'''
+        (magic, version, num_slots, slot_size, seq) = struct.unpack_from(HEADER_FORMAT, self.mm, 0)
+        return (magic != MAGIC or version != VERSION or
+                num_slots != self.num_slots or slot_size != self.slot_size)
+
+    def read_new(self):
+        '''return a list of (frame_time, img, filename) tuples for the frames
+        written since the last call, oldest first. Frames overwritten before
+        they could be read are counted in self.dropped'''
+        (write_seq,) = struct.unpack_from('<Q', self.mm, WRITE_SEQ_OFFSET)
+        if write_seq < self.last_seq:
+            # the writer has restarted
+            self.last_seq = 0
+        first = max(self.last_seq + 1, write_seq - self.num_slots + 1)
+        self.dropped += first - (self.last_seq + 1)
+        ret = []
+        for seq in range(first, write_seq + 1):
+            frame = self._read_slot(seq)
+            if frame is None:
+                self.dropped += 1
+            else:
+                ret.append(frame)
+        self.last_seq = max(self.last_seq, write_seq)
+        return ret
+
+    def _read_slot(self, seq):
+        '''copy a frame out of its slot, or return None if it has been overwritten'''
+        ofs = HEADER_SIZE + ((seq-1) % self.num_slots) * (SLOT_HEADER_SIZE + self.slot_size)
+        (seq_start, seq_end, frame_time, height, width, channels,
+         itemsize, nbytes, filename) = struct.unpack_from(SLOT_FORMAT, self.mm, ofs)
+        if seq_end != seq or nbytes > self.slot_size or itemsize not in (1, 2):
+            return None
+        data = numpy.frombuffer(self.mm, dtype=numpy.uint8, count=nbytes, offset=ofs+SLOT_HEADER_SIZE).copy()
+        (seq_start,) = struct.unpack_from('<Q', self.mm, ofs)
+        if seq_start != seq:
+            return None
+        if itemsize == 2:
+            data = data.view(numpy.uint16)
+        if channels == 1:
+            img = data.reshape((height, width))
+        else:
+            img = data.reshape((height, width, channels))
+        filename = filename.rstrip(b'\0').decode('utf-8')
+        return (frame_time, img, filename)
+
+    def close(self):
+        '''close the ring'''
+        self.mm.close()
+        self.file.close()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+'''
+striping of packets across several links
+
+With more than one link to the ground station, camera_air normally
+sends each packet whole on every link, and cancels the others when one
+finishes. In striping mode a packet is instead cut into fragments, one
+per link, sized in proportion to each link's throughput, so that the
+links carry it together. The ground station puts the fragments back
+together with a StripeAssembler.
+'''
+
+import time
+from cuav.lib import cuav_command
+
+# smallest fragment worth sending on a link. Smaller ones are mostly
+# encoding and packet headers
+MIN_FRAGMENT = 500
+
+
+def link_weight(bsend):
+    '''return the throughput of a link in bytes/second: the rate it sends
+    at, which is measured with adaptive pacing, times the fraction of
+    sends that get through'''
+    return bsend.get_send_rate() * bsend.get_efficiency()
+
+
+def split(size, weights, min_size=MIN_FRAGMENT):
+    '''split size bytes in proportion to a list of link weights. Returns a
+    list of fragment lengths, one per link, which is zero for links given
+    nothing because their share would be below min_size'''
+    use = [w > 0 for w in weights]
+    while True:
+        total = sum([w for (w, u) in zip(weights, use) if u])
+        if total <= 0:
+            return [0] * len(weights)
+        shares = [size * w / total if u else 0 for (w, u) in zip(weights, use)]
+        small = [i for i in range(len(shares)) if use[i] and shares[i] < min_size]
+        if len(small) == 0 or sum(use) == 1:
+            break
+        # drop the slowest link and share again
+        use[min(small, key=lambda i: weights[i])] = False
+    lengths = [int(s) for s in shares]
+    # the rounding left over goes to the fastest link
+    fastest = max(range(len(weights)), key=lambda i: shares[i])
+    lengths[fastest] += size - sum(lengths)
+    return lengths
+
+
+def fragments(stripe_id, buf, lengths):
+    '''cut buf into StripePackets of the given lengths, returning a list
+    with a packet, or None for a zero length, for each entry'''
+    count = len([n for n in lengths if n > 0])
+    ret = []
+    offset = 0
+    index = 0
+    for n in lengths:
+        if n == 0:
+            ret.append(None)
+            continue
+        ret.append(cuav_command.StripePacket(stripe_id, index, count, len(buf),
+                                             offset, buf[offset:offset+n]))
+        offset += n
+        index += 1
+    return ret
+
+
+class StripeAssembler:
+    '''put striped packets back together
+
+    max_age: seconds to keep an incomplete packet (default 60)
+    '''
+    def __init__(self, max_age=60):
+        self.max_age = max_age
+        self.partial = {}
+        self.completed = 0
+        self.expired = 0
+
+    def add(self, pkt, tnow=None):
+        '''add a StripePacket. Returns the whole packet once all its
+        fragments have arrived, otherwise None'''
+        if tnow is None:
+            tnow = time.time()
+        self.expire(tnow)
+        (t, parts) = self.partial.setdefault(pkt.stripe_id, (tnow, {}))
+        parts[pkt.index] = pkt
+        if len(parts) < pkt.count:
+            return None
+        del self.partial[pkt.stripe_id]
+        buf = ''.join([parts[i].data for i in range(pkt.count) if i in parts])
+        if len(buf) != pkt.size:
+            return None
+        self.completed += 1
+        return buf
+
+    def expire(self, tnow):
+        '''drop incomplete packets older than max_age'''
+        for stripe_id in list(self.partial.keys()):
+            if tnow - self.partial[stripe_id][0] > self.max_age:
+                del self.partial[stripe_id]
+                self.expired += 1
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+'''
+cross-frame tracking of detected targets
+
+A target is typically detected in several consecutive frames as the
+aircraft passes over it. TargetTracker clusters georeferenced regions
+by position, so that only the first detection of a target and any
+later detections with a better score need to be sent to the ground.
+Each target has an id, so the ground station can replace the thumbnail
+of a target when a better one arrives.
+'''
+
+import time
+from cuav.lib import cuav_util
+
+
+class TargetCluster:
+    '''the detections of one target'''
+    def __init__(self, track_id, latlon, score, frame_time):
+        self.track_id = track_id
+        (self.lat, self.lon) = latlon
+        self.hits = 1
+        self.best_score = score
+        self.last_seen = frame_time
+
+    def add(self, latlon, frame_time):
+        '''add a detection, moving the cluster to the mean position'''
+        self.hits += 1
+        self.lat += (latlon[0] - self.lat) / self.hits
+        self.lon += (latlon[1] - self.lon) / self.hits
+        self.last_seen = max(self.last_seen, frame_time)
+
+
+class TargetTracker:
+    '''cluster regions from successive frames into targets
+
+    radius: distance in meters for a region to join a target, 0 to disable (default 30)
+    window: seconds since a target was last seen before it is forgotten (default 60)
+    '''
+    def __init__(self, radius=30.0, window=60.0):
+        self.radius = radius
+        self.window = window
+        self.clusters = []
+        self.newest_frame_time = 0
+        self.suppressed = 0
+        # ids start from the time the tracker was created, so that a
+        # restarted tracker does not reuse the ids of targets already sent
+        self.next_id = int(time.time()) << 16
+
+    def update(self, frame_time, regions):
+        '''add the regions of a frame. Returns a tuple (regions, hits, tracks)
+        of the regions to send, which are new targets or better scoring
+        detections of a known target, the number of times each target has
+        been seen and the id of each target, or None for regions that are
+        not tracked'''
+        self.newest_frame_time = max(self.newest_frame_time, frame_time)
+        self._expire()
+        send = []
+        hits = []
+        tracks = []
+        for r in regions:
+            score = r.score or 0
+            if r.latlon is None or self.radius <= 0:
+                send.append(r)
+                hits.append(1)
+                tracks.append(None)
+                continue
+            cluster = self._nearest(r.latlon)
+            if cluster is None:
+                cluster = TargetCluster(self.next_id, r.latlon, score, frame_time)
+                self.next_id += 1
+                self.clusters.append(cluster)
+                send.append(r)
+                hits.append(1)
+                tracks.append(cluster.track_id)
+                continue
+            cluster.add(r.latlon, frame_time)
+            if score > cluster.best_score:
+                cluster.best_score = score
+                send.append(r)
+                hits.append(cluster.hits)
+                tracks.append(cluster.track_id)
+            else:
+                self.suppressed += 1
+        return (send, hits, tracks)
+
+    def _nearest(self, latlon):
+        '''return the nearest cluster within radius, or None'''
+        ret = None
+        best = self.radius
+        for c in self.clusters:
+            d = cuav_util.gps_distance(c.lat, c.lon, latlon[0], latlon[1])
+            if d <= best:
+                best = d
+                ret = c
+        return ret
+
+    def _expire(self):
+        '''forget targets not seen within the window'''
+        oldest = self.newest_frame_time - self.window
+        self.clusters = [c for c in self.clusters if c.last_seen >= oldest]
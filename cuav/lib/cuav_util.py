@@ -341,14 +341,19 @@ def image_width(img):
     return getattr(img, 'width')
 
 
-def SubImage(src, region):
+def SubImage(src, region, dest=None):
     '''return a subimage as a new image. This allows
     for the region going past the edges.
-    region is of the form (x1,y1,width,height)'''
+    region is of the form (x1,y1,width,height)
+    If dest is given the subimage is copied into it instead of a new
+    image. dest must be zeroed and of size width x height'''
     (x1,y1,width,height) = region
     #if src == None:
     #    return numpy.zeros((height,width,3),dtype=numpy.uint16)
-    ret = numpy.zeros((height,width,3),dtype=src.dtype)
+    if dest is None:
+        ret = numpy.zeros((height,width,3),dtype=src.dtype)
+    else:
+        ret = dest
     (img_width,img_height) = image_shape(src)
     if x1 < 0:
         sx1 = 0
@@ -371,9 +376,9 @@ def SubImage(src, region):
     else:
         h = img_height - sy1
     if yofs+h > height:
-        h = h - yofs
+        h = height - yofs
     if xofs+w > width:
-        w = w - xofs
+        w = width - xofs
         
     ret[yofs:yofs+h, xofs:xofs+w] = src[sy1:sy1+h, sx1:sx1+w]
     return ret
@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+'''
+binary encoding of the packets sent between the aircraft and the GCS
+
+The cuav_command objects used to be sent as pickles, which name the
+module, class and every attribute of each object, describe numpy
+arrays at length, and let whoever is on the other end of the link run
+code on the receiver. Here each class instead has a fixed type id and a
+schema: the list of attributes that are sent, and the type of each.
+
+A packet is a two byte magic, a version byte and then the object, as a
+type id followed by its fields. Numeric fields are packed together
+with one struct, and the rest are written as tagged values, which may
+be None, bools, numbers, strings, lists, tuples, dicts, numpy arrays or
+other objects with a schema. Attributes not in the schema, such as the
+extra scores Region picks up during scoring, are not sent, and decoded
+objects are made without calling __init__.
+
+Packets of another version, or with unknown type ids or tags, raise a
+WireError, as do objects that have no schema.
+'''
+
+import struct, types
+import numpy
+from cuav.lib import cuav_command, cuav_region, cuav_latency, mav_position
+
+MAGIC = 'cw'
+# the version changes with the encoding, which includes the order of
+# cuav_latency.STAGES in the stamps
+VERSION = 2
+
+HEADER = struct.Struct('<2sBB')
+
+INT32 = struct.Struct('<i')
+INT64 = struct.Struct('<q')
+DOUBLE = struct.Struct('<d')
+UINT16 = struct.Struct('<H')
+UINT32 = struct.Struct('<L')
+
+
+class WireError(Exception):
+    '''an object that can't be encoded or a buffer that can't be decoded'''
+    pass
+
+
+class Schema:
+    '''the type id and fields of an encoded class
+
+    type_id:  number identifying the class on the wire, 1 to 255
+    cls:      the class
+    fields:   list of (name, type) tuples, see below
+    defaults: dictionary of attributes set on decoded objects that
+              aren't sent
+
+    A field type is a struct format character, optionally with a count
+    for a tuple of that many values, such as '2d', and a trailing '?' if
+    the field may be None. Up to 8 fields may be None. These fields are
+    packed with one struct. The other types are 'v' for a tagged value
+    and 'stamps' for a dictionary of cuav_latency stage timestamps, and
+    a list holding a class, such as [Region], is a list of objects of
+    that class.
+    '''
+    def __init__(self, type_id, cls, fields, defaults={}):
+        self.type_id = type_id
+        self.cls = cls
+        self.defaults = defaults
+        self.old_style = not isinstance(cls, type)
+        self.fixed = []
+        self.values = []
+        bit = 1
+        for (name, t) in fields:
+            if t == 'v':
+                self.values.append((name, _encode_value, _decode_value))
+            elif t == 'stamps':
+                self.values.append((name, _encode_stamps, _decode_stamps))
+            elif isinstance(t, list):
+                self.values.append((name, _encode_object_list(t[0]), _decode_object_list(t[0])))
+            else:
+                optional = 0
+                if t.endswith('?'):
+                    optional = bit
+                    bit <<= 1
+                    t = t[:-1]
+                self.fixed.append((name, t[-1], int(t[:-1] or 1), optional))
+        if bit > 0x100:
+            raise WireError('too many optional fields in %s' % cls.__name__)
+        self.all_bits = bit - 1
+        self.names = [f[0] for f in self.fixed]
+        self.layouts = {}
+        # a mask byte is only sent for classes with tuples or fields
+        # that may be None
+        self.masked = len([f for f in self.fixed if f[2] != 1 or f[3]]) > 0
+
+    def layout(self, mask):
+        '''return the struct of the fixed fields, given the mask of the
+        fields that may be None which are present, and a list of the
+        (name, index, count) of each field in the unpacked values, with a
+        count of zero for a field that is None'''
+        ret = self.layouts.get(mask, None)
+        if ret is None:
+            if mask & ~self.all_bits:
+                raise WireError('bad mask for %s' % self.cls.__name__)
+            if self.masked:
+                fmt = '<B'
+                i = 1
+            else:
+                fmt = '<'
+                i = 0
+            fields = []
+            for (name, t, count, bit) in self.fixed:
+                if bit and not mask & bit:
+                    fields.append((name, i, 0))
+                    continue
+                fmt += '%u%s' % (count, t)
+                fields.append((name, i, count))
+                i += count
+            ret = (struct.Struct(fmt), fields)
+            self.layouts[mask] = ret
+        return ret
+
+    def pack(self, d):
+        '''pack the fixed fields from an object dictionary'''
+        if not self.masked:
+            return self.layout(0)[0].pack(*[d[name] for name in self.names])
+        mask = 0
+        values = []
+        for (name, t, count, bit) in self.fixed:
+            v = d[name]
+            if bit:
+                if v is None:
+                    continue
+                mask |= bit
+            if count == 1:
+                values.append(v)
+            else:
+                values.extend(v)
+        return self.layout(mask)[0].pack(mask, *values)
+
+    def decode(self, buf, ofs):
+        '''decode an object of this class, returning the object and the
+        offset after it. The object is made without calling __init__'''
+        mask = ord(buf[ofs]) if self.masked else 0
+        (s, fields) = self.layouts.get(mask, None) or self.layout(mask)
+        values = s.unpack_from(buf, ofs)
+        ofs += s.size
+        if self.masked:
+            d = {}
+            for (name, i, count) in fields:
+                if count == 0:
+                    d[name] = None
+                elif count == 1:
+                    d[name] = values[i]
+                else:
+                    d[name] = values[i:i+count]
+        else:
+            d = dict(zip(self.names, values))
+        d.update(self.defaults)
+        for (name, encoder, decoder) in self.values:
+            (d[name], ofs) = decoder(buf, ofs)
+        if self.old_style:
+            return (types.InstanceType(self.cls, d), ofs)
+        obj = self.cls.__new__(self.cls)
+        obj.__dict__.update(d)
+        return (obj, ofs)
+
+
+def _encode_fields(schema, obj, out):
+    d = obj.__dict__
+    try:
+        out.append(schema.pack(d))
+    except (struct.error, TypeError) as e:
+        raise WireError('bad field in %s: %s' % (obj.__class__.__name__, e))
+    for (name, encoder, decoder) in schema.values:
+        encoder(d[name], out)
+
+
+def _encode_object(obj, out):
+    schema = SCHEMA_BY_CLASS.get(obj.__class__, None)
+    if schema is None:
+        raise WireError('no schema for %s' % obj.__class__.__name__)
+    out.append(chr(schema.type_id))
+    _encode_fields(schema, obj, out)
+
+
+def _encode_object_list(cls):
+    '''return an encoder for a list of objects of one class, which are
+    sent without their type ids'''
+    def encoder(v, out):
+        schema = SCHEMA_BY_CLASS[cls]
+        out.append(UINT32.pack(len(v)))
+        for obj in v:
+            if obj.__class__ is not cls:
+                raise WireError('%s in list of %s' % (obj.__class__.__name__, cls.__name__))
+            _encode_fields(schema, obj, out)
+    return encoder
+
+
+def _encode_int(v, out):
+    if -0x80000000 <= v < 0x80000000:
+        out.append('i' + INT32.pack(v))
+    elif -0x8000000000000000 <= v < 0x8000000000000000:
+        out.append('q' + INT64.pack(v))
+    else:
+        raise WireError('integer %d too large' % v)
+
+
+def _encode_str(v, out):
+    if len(v) < 256:
+        out.append('s' + chr(len(v)))
+    else:
+        out.append('S' + UINT32.pack(len(v)))
+    out.append(v)
+
+
+def _encode_sequence(tag, v, out):
+    out.append(tag + UINT32.pack(len(v)))
+    for x in v:
+        _encode_value(x, out)
+
+
+def _encode_list(v, out):
+    # lists of small ints, such as the hits of a ThumbPacket, are packed
+    # as an array
+    if len(v) > 0 and all([type(x) is int and -0x80000000 <= x < 0x80000000 for x in v]):
+        out.append('I' + struct.pack('<L%ui' % len(v), len(v), *v))
+    else:
+        _encode_sequence('l', v, out)
+
+
+def _encode_dict(v, out):
+    out.append('D' + UINT32.pack(len(v)))
+    for (k, x) in v.iteritems():
+        _encode_value(k, out)
+        _encode_value(x, out)
+
+
+def _encode_array(v, out):
+    v = numpy.ascontiguousarray(v)
+    dtype = v.dtype.str
+    out.append('a' + chr(len(dtype)) + dtype + chr(v.ndim))
+    out.append(struct.pack('<%uL' % v.ndim, *v.shape))
+    out.append(UINT32.pack(v.nbytes))
+    out.append(v.tostring())
+
+
+def _encode_unicode(v, out):
+    v = v.encode('utf8')
+    out.append('u' + UINT32.pack(len(v)))
+    out.append(v)
+
+
+ENCODERS = {
+    type(None) : lambda v, out: out.append('N'),
+    bool       : lambda v, out: out.append('T' if v else 'F'),
+    int        : _encode_int,
+    long       : _encode_int,
+    float      : lambda v, out: out.append('d' + DOUBLE.pack(v)),
+    str        : _encode_str,
+    unicode    : _encode_unicode,
+    list       : _encode_list,
+    tuple      : lambda v, out: _encode_sequence('t', v, out),
+    dict       : _encode_dict,
+    numpy.ndarray : _encode_array,
+    }
+
+
+def _encode_value(v, out):
+    encoder = ENCODERS.get(type(v), None)
+    if encoder is not None:
+        encoder(v, out)
+    elif isinstance(v, (numpy.integer, numpy.floating, numpy.bool_)):
+        _encode_value(v.item(), out)
+    else:
+        out.append('o')
+        _encode_object(v, out)
+
+
+STAGE_BITS = dict([(stage, 1<<i) for (i, stage) in enumerate(cuav_latency.STAGES)])
+
+
+def _encode_stamps(stamps, out):
+    '''stage timestamps are sent as a mask of the stages present and the
+    times in stage order'''
+    mask = 0
+    for stage in stamps:
+        if stage not in STAGE_BITS:
+            raise WireError('unknown stage %s' % stage)
+        mask |= STAGE_BITS[stage]
+    times = [stamps[stage] for stage in cuav_latency.STAGES if stage in stamps]
+    out.append(struct.pack('<H%ud' % len(times), mask, *times))
+
+
+def encode(obj):
+    '''encode an object with a schema, returning a string'''
+    # the type id of the object completes the header
+    out = [MAGIC + chr(VERSION)]
+    try:
+        _encode_object(obj, out)
+    except KeyError as e:
+        raise WireError('missing field %s' % e)
+    return ''.join(out)
+
+
+def _decode_object(buf, ofs, type_id):
+    schema = SCHEMA_BY_ID.get(type_id, None)
+    if schema is None:
+        raise WireError('unknown type id %u' % type_id)
+    return schema.decode(buf, ofs)
+
+
+def _decode_object_list(cls):
+    '''return a decoder for a list of objects of one class'''
+    def decoder(buf, ofs):
+        decode = SCHEMA_BY_CLASS[cls].decode
+        (n,) = UINT32.unpack_from(buf, ofs)
+        ofs += 4
+        ret = []
+        for i in xrange(n):
+            (obj, ofs) = decode(buf, ofs)
+            ret.append(obj)
+        return (ret, ofs)
+    return decoder
+
+
+def _decode_bytes(buf, ofs, n):
+    if ofs + n > len(buf):
+        raise WireError('truncated')
+    return (buf[ofs:ofs+n], ofs+n)
+
+
+def _decode_sequence(buf, ofs):
+    (n,) = UINT32.unpack_from(buf, ofs)
+    ofs += 4
+    ret = []
+    for i in xrange(n):
+        (v, ofs) = _decode_value(buf, ofs)
+        ret.append(v)
+    return (ret, ofs)
+
+
+def _decode_int_list(buf, ofs):
+    (n,) = UINT32.unpack_from(buf, ofs)
+    return (list(struct.unpack_from('<%ui' % n, buf, ofs+4)), ofs + 4 + 4*n)
+
+
+def _decode_tuple(buf, ofs):
+    (ret, ofs) = _decode_sequence(buf, ofs)
+    return (tuple(ret), ofs)
+
+
+def _decode_dict(buf, ofs):
+    (n,) = UINT32.unpack_from(buf, ofs)
+    ofs += 4
+    ret = {}
+    for i in xrange(n):
+        (k, ofs) = _decode_value(buf, ofs)
+        (ret[k], ofs) = _decode_value(buf, ofs)
+    return (ret, ofs)
+
+
+def _decode_array(buf, ofs):
+    n = ord(buf[ofs])
+    dtype = numpy.dtype(buf[ofs+1:ofs+1+n])
+    ofs += 1 + n
+    ndim = ord(buf[ofs])
+    shape = struct.unpack_from('<%uL' % ndim, buf, ofs+1)
+    ofs += 1 + 4 * ndim
+    (nbytes,) = UINT32.unpack_from(buf, ofs)
+    ofs += 4
+    if ofs + nbytes > len(buf) or dtype.hasobject:
+        raise WireError('bad array')
+    # copied so that the array is writeable, as an unpickled one is
+    arr = numpy.frombuffer(buf, dtype, nbytes // dtype.itemsize, ofs).reshape(shape).copy()
+    return (arr, ofs + nbytes)
+
+
+def _decode_unicode(buf, ofs):
+    (n,) = UINT32.unpack_from(buf, ofs)
+    (v, ofs) = _decode_bytes(buf, ofs+4, n)
+    return (v.decode('utf8'), ofs)
+
+
+DECODERS = {
+    'N' : lambda buf, ofs: (None, ofs),
+    'T' : lambda buf, ofs: (True, ofs),
+    'F' : lambda buf, ofs: (False, ofs),
+    'i' : lambda buf, ofs: (INT32.unpack_from(buf, ofs)[0], ofs+4),
+    'q' : lambda buf, ofs: (INT64.unpack_from(buf, ofs)[0], ofs+8),
+    'd' : lambda buf, ofs: (DOUBLE.unpack_from(buf, ofs)[0], ofs+8),
+    's' : lambda buf, ofs: _decode_bytes(buf, ofs+1, ord(buf[ofs])),
+    'S' : lambda buf, ofs: _decode_bytes(buf, ofs+4, UINT32.unpack_from(buf, ofs)[0]),
+    'u' : _decode_unicode,
+    'l' : _decode_sequence,
+    'I' : _decode_int_list,
+    't' : _decode_tuple,
+    'D' : _decode_dict,
+    'a' : _decode_array,
+    'o' : lambda buf, ofs: _decode_object(buf, ofs+1, ord(buf[ofs])),
+    }
+
+
+def _decode_value(buf, ofs):
+    decoder = DECODERS.get(buf[ofs], None)
+    if decoder is None:
+        raise WireError('unknown tag %r' % buf[ofs])
+    return decoder(buf, ofs+1)
+
+
+# the stages and struct of the times for each mask of stages
+STAMP_LAYOUTS = {}
+
+
+def _decode_stamps(buf, ofs):
+    (mask,) = UINT16.unpack_from(buf, ofs)
+    layout = STAMP_LAYOUTS.get(mask, None)
+    if layout is None:
+        if mask >> len(cuav_latency.STAGES):
+            raise WireError('unknown stage in mask 0x%x' % mask)
+        stages = [stage for stage in cuav_latency.STAGES if mask & STAGE_BITS[stage]]
+        layout = (stages, struct.Struct('<%ud' % len(stages)))
+        STAMP_LAYOUTS[mask] = layout
+    (stages, s) = layout
+    return (dict(zip(stages, s.unpack_from(buf, ofs+2))), ofs + 2 + s.size)
+
+
+def decode(buf):
+    '''decode a string made by encode()'''
+    try:
+        (magic, version, type_id) = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise WireError('bad magic')
+        if version != VERSION:
+            raise WireError('unsupported version %u' % version)
+        (obj, ofs) = _decode_object(buf, HEADER.size, type_id)
+    except (struct.error, IndexError, ValueError, TypeError) as e:
+        raise WireError('bad packet: %s' % e)
+    if ofs != len(buf):
+        raise WireError('%u bytes left over' % (len(buf) - ofs))
+    return obj
+
+
+STAMPED = [('timestamp', 'd'), ('stamps', 'stamps')]
+NO_BLOCKID = {'blockid' : None}
+
+# the type ids must never be reused for something else. Changing the
+# fields of a class means a new VERSION
+SCHEMAS = [
+    Schema(1, cuav_command.ImagePacket,
+           STAMPED + [('frame_time', 'd'), ('jpeg', 'v'), ('pos', 'v'), ('priority', 'v')],
+           NO_BLOCKID),
+    Schema(2, cuav_command.ThumbPacket,
+           STAMPED + [('frame_time', 'd'), ('regions', [cuav_region.Region]), ('thumb', 'v'), ('pos', 'v'), ('hits', 'v'),
+                     ('tracks', 'v')],
+           NO_BLOCKID),
+    Schema(3, cuav_command.CommandPacket, STAMPED + [('command', 'v')], NO_BLOCKID),
+    Schema(4, cuav_command.CommandResponse, STAMPED + [('response', 'v')], NO_BLOCKID),
+    Schema(5, cuav_command.ImageRequest,
+           STAMPED + [('frame_time', 'd'), ('fullres', 'v')], NO_BLOCKID),
+    Schema(6, cuav_command.HeartBeat, STAMPED, NO_BLOCKID),
+    Schema(7, cuav_command.CameraMessage, STAMPED + [('msg', 'v')], NO_BLOCKID),
+    Schema(8, cuav_command.ChangeCameraSetting,
+           STAMPED + [('name', 'v'), ('value', 'v')], NO_BLOCKID),
+    Schema(9, cuav_command.ChangeImageSetting,
+           STAMPED + [('name', 'v'), ('value', 'v')], NO_BLOCKID),
+    Schema(10, cuav_command.PerfReport,
+           STAMPED + [('scan_fps', 'd'), ('cpu', 'd'), ('queues', 'v'), ('latencies', 'v'),
+                      ('load', 'v'), ('mem', 'v'), ('disk_free', 'v'), ('links', 'v')],
+           NO_BLOCKID),
+    Schema(11, cuav_command.StripePacket,
+           [('index', 'H'), ('count', 'H'), ('size', 'L'), ('offset', 'L'),
+            ('stripe_id', 'v'), ('data', 'v')]),
+    Schema(12, cuav_command.BlockCancel, STAMPED + [('blockid', 'v')]),
+    Schema(32, cuav_region.Region,
+           [('x1', 'i'), ('y1', 'i'), ('x2', 'i'), ('y2', 'i'), ('scan_shape', '2i'),
+            ('scan_score', 'd'), ('latlon', '2d?'), ('score', 'd?'), ('whiteness', 'd?')]),
+    Schema(33, mav_position.MavPosition,
+           [('lat', 'd'), ('lon', 'd'), ('altitude', 'd'), ('roll', 'd'), ('pitch', 'd'), ('yaw', 'd'),
+            ('time', 'd?')]),
+    ]
+
+SCHEMA_BY_CLASS = dict([(s.cls, s) for s in SCHEMAS])
+SCHEMA_BY_ID = dict([(s.type_id, s) for s in SCHEMAS])
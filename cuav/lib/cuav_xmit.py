@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+'''transmit control for the camera modules
+
+QualityController picks a JPEG quality and thumbnail scale for a
+block_xmit link, so that the link's send queue drains within a
+target latency. When the link degrades the quality and then the
+thumbnail size are reduced, so detections keep arriving promptly.
+
+TransmitScheduler gives thumbnails a block_xmit priority from their
+region scores, age and distance from the target, and picks the lowest
+value queued thumbnail to drop when a link's queue is full.
+'''
+
+import time
+from cuav.lib import cuav_util
+
+class QualityController:
+    '''adaptive image quality for one BlockSender link
+
+    bsend:           the BlockSender to control
+    target_latency:  time in seconds the send queue should drain in (default 5)
+    min_quality:     lowest JPEG quality to use (default 30)
+    min_scale:       smallest thumbnail scale to use (default 0.5)
+    update_interval: minimum time in seconds between adjustments (default 1)
+    '''
+    def __init__(self, bsend, target_latency=5.0, min_quality=30, min_scale=0.5, update_interval=1.0):
+        self.bsend = bsend
+        self.target_latency = target_latency
+        self.min_quality = min_quality
+        self.min_scale = min_scale
+        self.update_interval = update_interval
+        # level runs from 0 (smallest, lowest quality) to 1 (full quality).
+        # The upper half controls JPEG quality, the lower half thumbnail scale
+        self.level = 1.0
+        self.block_size = 0
+        self.last_update = 0
+
+    def __str__(self):
+        return 'Q%.2f' % self.level
+
+    def record_send(self, size):
+        '''note the size of a block sent on the link'''
+        if self.block_size == 0:
+            self.block_size = size
+        else:
+            self.block_size = 0.9 * self.block_size + 0.1 * size
+
+    def latency(self):
+        '''estimate the time in seconds to drain the send queue'''
+        rate = self.bsend.get_bandwidth_used() * self.bsend.get_efficiency()
+        if rate <= 0:
+            rate = self.bsend.get_send_rate() * self.bsend.get_efficiency()
+        if rate <= 0:
+            return 0
+        return self.bsend.sendq_size() * self.block_size / rate
+
+    def update(self, tnow=None):
+        '''adjust the level from the current link state. Decrease
+        multiplicatively when over the target latency, increase slowly
+        when well under it'''
+        if tnow is None:
+            tnow = time.time()
+        if tnow - self.last_update < self.update_interval:
+            return
+        self.last_update = tnow
+        if self.target_latency <= 0:
+            self.level = 1.0
+            return
+        latency = self.latency()
+        if latency > self.target_latency and self.bsend.sendq_size() > 1:
+            self.level = max(0.0, self.level * 0.8)
+        elif latency < 0.5 * self.target_latency:
+            self.level = min(1.0, self.level + 0.05)
+
+    def quality(self, max_quality):
+        '''return the JPEG quality to use, given the configured maximum'''
+        if max_quality <= self.min_quality:
+            return max_quality
+        frac = max(0.0, 2.0 * self.level - 1.0)
+        return int(self.min_quality + frac * (max_quality - self.min_quality))
+
+    def scale(self):
+        '''return the scale factor to apply to thumbnails'''
+        frac = min(1.0, 2.0 * self.level)
+        return self.min_scale + frac * (1.0 - self.min_scale)
+
+
+class TransmitScheduler:
+    '''priorities for thumbnail packets
+
+    max_priority: thumbnails get priorities below this, so control
+                  packets sent at max_priority go first (default 10000)
+    score_scale:  region score giving half of the score weighting (default 1000)
+    age_halflife: frame age in seconds that halves the priority (default 60)
+    target_scale: distance in meters from the target that halves the priority,
+                  when no target radius is set (default 500)
+    '''
+    def __init__(self, max_priority=10000, score_scale=1000.0, age_halflife=60.0, target_scale=500.0):
+        self.max_priority = max_priority
+        self.score_scale = score_scale
+        self.age_halflife = age_halflife
+        self.target_scale = target_scale
+        self.newest_frame_time = 0
+        self.queued = {}
+        self.dropped = 0
+
+    def priority(self, frame_time, regions, target=None):
+        '''return the block_xmit priority for a thumbnail packet.
+        target is an optional (latitude, longitude, radius) tuple'''
+        score = 0
+        for r in regions:
+            if r.score is not None:
+                score = max(score, r.score)
+        value = score / (score + self.score_scale)
+
+        # age is relative to the newest frame seen, so that old or
+        # simulated frame times are handled
+        self.newest_frame_time = max(self.newest_frame_time, frame_time)
+        age = self.newest_frame_time - frame_time
+        value *= 0.5 ** (age / self.age_halflife)
+
+        if target is not None:
+            (lat, lon, radius) = target
+            if radius <= 0:
+                radius = self.target_scale
+            distance = None
+            for r in regions:
+                if r.latlon is None:
+                    continue
+                d = cuav_util.gps_distance(lat, lon, r.latlon[0], r.latlon[1])
+                if distance is None or d < distance:
+                    distance = d
+            if distance is not None:
+                value *= 1.0 / (1.0 + distance / radius)
+
+        return int(1 + (self.max_priority - 2) * value)
+
+    def sent(self, bsend, blockid, priority):
+        '''record a thumbnail block queued on a link'''
+        queued = self.queued.setdefault(bsend, {})
+        queued[blockid] = priority
+        if len(queued) > 2 * bsend.sendq_size() + 100:
+            self._prune(bsend)
+
+    def _prune(self, bsend):
+        '''forget thumbnails that have completed or been cancelled'''
+        queued = self.queued.get(bsend, {})
+        for blockid in list(queued.keys()):
+            if not bsend.is_queued(blockid):
+                queued.pop(blockid)
+        return queued
+
+    def make_room(self, bsend, priority):
+        '''cancel the lowest priority queued thumbnail on a full link if it is
+        lower than priority. Return True if there is now room to send.
+        Either way one thumbnail is dropped'''
+        self.dropped += 1
+        queued = self._prune(bsend)
+        if len(queued) == 0:
+            return False
+        lowest = min(queued, key=queued.get)
+        if queued[lowest] >= priority:
+            return False
+        bsend.cancel(lowest)
+        queued.pop(lowest)
+        return True
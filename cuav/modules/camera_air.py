@@ -4,23 +4,31 @@ It takes in captured images from a directory and scans
 them in realtime, geotags and sends to the GCS'''
 
 #Notes:
-#-There are 3 threads - capture, scan and transmit
-#-There are 2 queues - scan_queue, transmit_queue
+#-There are 4 threads - capture, decode, scan and transmit
+#-There are 3 queues - scan_queue, decode_queue, transmit_queue
 
 # todo:
 #    - add ability to lower score and get past images sent
 
-import time, threading, sys, os, numpy, Queue, cPickle, cStringIO
+import time, threading, sys, os, numpy, Queue, cStringIO
 import functools, cv2, pkg_resources
 
 from MAVProxy.modules.lib import mp_module
 
 from cuav.image import scanner
-from cuav.lib import mav_position, cuav_util, cuav_joe, block_xmit, cuav_region, cuav_command
+from cuav.lib import mav_position, cuav_util, cuav_joe, block_xmit, cuav_region, cuav_command, cuav_framestore, cuav_xmit, cuav_event, cuav_imagestore, cuav_track, cuav_shmring, cuav_scanparams, cuav_latency, cuav_profile, cuav_jpeg, cuav_stripe, cuav_wire
 from MAVProxy.modules.lib import mp_settings
 from cuav.camera.cam_params import CameraParams
 from pymavlink import mavutil
 
+# flags to decode a JPEG at a reduced size
+REDUCED_JPEG = {2 : cv2.IMREAD_REDUCED_COLOR_2,
+                4 : cv2.IMREAD_REDUCED_COLOR_4,
+                8 : cv2.IMREAD_REDUCED_COLOR_8}
+
+# links that have not heard from the ground for this many seconds are
+# left out of striping. The ground sends a heartbeat every 5 seconds
+STRIPE_LINK_TIMEOUT = 10
 
 class CameraAirModule(mp_module.MPModule):
     def __init__(self, mpstate):
@@ -31,13 +39,19 @@ class CameraAirModule(mp_module.MPModule):
         self.unload_event.clear()
 
         self.capture_thread = None
+        self.decode_thread = None
         self.scan_thread = None
         self.transmit_thread = None
         self.airstart_triggered = False
         self.terrain_alt = None
-        self.handled_timestamps = {}
-        self.imagefilenamemapping = {}
-        self.posmapping = {}
+        # scanner parameters, rebuilt on setting or altitude changes
+        self.scan_parms = cuav_scanparams.ScanParams()
+        # commands are sent on every link, so remember which we have handled
+        self.handled_timestamps = cuav_framestore.FrameStore(max_age=60, tolerance=0)
+        # per-frame image filename and position, for image requests
+        self.frames = cuav_framestore.FrameStore()
+        # captured image files, pruned to the maxstore and minfree settings
+        self.images = cuav_imagestore.ImageStore()
         self.is_armed = True
 
         # prevent loopback of messages
@@ -52,8 +66,12 @@ class CameraAirModule(mp_module.MPModule):
               MPSetting('minalt', int, 30, 'MinAltitude of images', range=(0,10000), increment=1),
               MPSetting('rotate180', bool, False, 'rotate images by 180', tab='Capture2'),
               MPSetting('ignoretimestamps', bool, False, 'Ignore image timestamps', tab='Capture2'),
+              MPSetting('maxstore', int, 0, 'Maximum MB of captured images to keep (0 for no limit)', tab='Capture2'),
+              MPSetting('minfree', int, 0, 'Delete old images without regions to keep this many MB free (0 to disable)', tab='Capture2'),
+              MPSetting('scan_reduce', int, 1, 'Scan images reduced by this factor, keeping thumbnails full resolution', range=(1,8), increment=1, tab='Capture2'),
               MPSetting('camparms', str, None, 'camera parameters file (json) in cuav package', tab='Imaging'),
               MPSetting('imagefile', str, None, 'latest captured image', tab='Imaging'),
+              MPSetting('shmring', str, None, 'shared memory frame ring from the capture program, instead of imagefile', tab='Imaging'),
               MPSetting('filter_type', str, 'simple', 'Filter Type',
                         choice=['simple'], tab='Imaging'),
               MPSetting('use_capture_time', bool, True, 'Use Capture Time (false for sim)', tab='Simulation'),
@@ -63,10 +81,22 @@ class CameraAirModule(mp_module.MPModule):
 
               MPSetting('gcs_address', str, "", 'GCS Addresses in RemIP:RemPort:LocalPort:Bandwidth format (127.0.0.1:1440:1234:45, ...)', tab='GCS'),
               MPSetting('qualitysend', int, 90, 'Compression Quality for send', range=(1,100), increment=1, tab='GCS'),
+              MPSetting('qualitythumb', int, 90, 'Compression Quality for thumbnails', range=(1,100), increment=1, tab='GCS'),
+              MPSetting('minquality', int, 30, 'Minimum adaptive Compression Quality', range=(1,100), increment=1, tab='GCS'),
+              MPSetting('xmit_latency', float, 5.0, 'Target transmit latency for adaptive quality (0 to disable)', tab='GCS'),
               MPSetting('transmit', bool, True, 'Transmit Enable for thumbnails', tab='GCS'),
               MPSetting('maxqueue', int, 100, 'Maximum images queue', tab='GCS'),
+              MPSetting('xmit_stripe', bool, False, 'Split packets across the links in proportion to their throughput, rather than sending them on every link', tab='GCS'),
+              MPSetting('stripe_dup_priority', int, 10000, 'When striping, packets of this priority or higher are still sent whole on every link', tab='GCS'),
+              MPSetting('xmit_adaptive', bool, False, 'Pace sends to the measured link capacity, up to the GCS address bandwidth', tab='GCS'),
+              MPSetting('xmit_fec', int, 0, 'Chunks per FEC parity packet (0 to disable, -1 for automatic)', range=(-1,16), increment=1, tab='GCS'),
+              MPSetting('xmit_batch', int, 0, 'Packets per system call with sendmmsg/recvmmsg (0 to disable)', range=(0,1024), increment=1, tab='GCS'),
+              MPSetting('xmit_compress', bool, True, 'Compress packets other than images and thumbnails, if the GCS supports it', tab='GCS'),
+              MPSetting('perf_interval', float, 5, 'Seconds between performance reports to the GCS (0 to disable)', tab='GCS'),
 
               MPSetting('thumbsize', int, 60, 'Thumbnail Size', range=(10, 200), increment=1),
+              MPSetting('track_radius', float, 30, 'Radius in meters to group detections of a target (0 to disable)', tab='GCS'),
+              MPSetting('track_window', float, 60, 'Time in seconds to remember a target', tab='GCS'),
               MPSetting('minscore', int, 400, 'Min Score to pass detection', range=(0,5000), increment=1, tab='Imaging'),
               MPSetting('clock_sync', bool, False, 'GPS Clock Sync'),
               MPSetting('RegionHue', int, 110, 'Target Hue (0 to disable)', range=(0,180), increment=1, digits=1, tab='Imaging'),
@@ -91,7 +121,10 @@ class CameraAirModule(mp_module.MPModule):
         self.region_count = 0
         self.scan_fps = 0
         self.scan_queue = Queue.Queue()
-        self.transmit_queue = Queue.Queue()
+        # decoded frames waiting for the scanner. This is kept short so the
+        # decode thread only works a frame or two ahead of the scanner
+        self.decode_queue = Queue.Queue(maxsize=2)
+        self.transmit_queue = cuav_event.EventQueue()
         self.have_set_gps_time = False
 
         self.c_params = None
@@ -106,14 +139,28 @@ class CameraAirModule(mp_module.MPModule):
         self.bandwidth_used = []
         self.rtt_estimate = []
         self.bsend = [] #note this is an array of bsends
+        self.xmit_control = [] #adaptive quality, one per bsend
+        self.xmit_quality = []
+        self.scheduler = cuav_xmit.TransmitScheduler()
+        # striped packets are identified by the module start time and a count
+        self.stripe_id = (time.time(), 0)
+        self.tracker = cuav_track.TargetTracker()
         self.last_heartbeat = time.time()
 
+        # statistics for performance reports
+        self.perf_latency = cuav_latency.LatencyTracker()
+        self.last_perf = time.time()
+        self.perf_cpu = os.times()
+        self.perf_scan_count = 0
+        self.disk_free = None
+        self.profiler = cuav_profile.SamplingProfiler()
+
         self.mpos = mav_position.MavInterpolator(backlog=500, gps_lag=0.0)
         self.joelog = None #cuav_joe.JoeLog(os.path.join(self.settings.imagefile, '..', 'joe.log'), append=self.continue_mode)
 
         self.add_command('camera', self.cmd_camera,
                          'camera control',
-                         ['<start|stop|status|boundary|airstart>',
+                         ['<start|stop|status|boundary|airstart|profile>',
                           'set (CAMERASETTING)'])
         self.add_completion_function('(CAMERASETTING)', self.settings.completion)
         self.add_completion_function('(CAMERASETTING)', self.camera_settings.completion)
@@ -121,7 +168,7 @@ class CameraAirModule(mp_module.MPModule):
 
     def cmd_camera(self, args):
         '''camera commands'''
-        usage = "usage: camera <start|airstart|stop|status|queue|set>"
+        usage = "usage: camera <start|airstart|stop|status|queue|set|profile>"
         if len(args) == 0:
             print(usage)
             return
@@ -136,7 +183,9 @@ class CameraAirModule(mp_module.MPModule):
             if self.running == False:
                 self.running = True
                 self.joelog = cuav_joe.JoeLog(os.path.join(os.path.dirname(self.camera_settings.imagefile), 'joe_air.log'), append=self.continue_mode)
+                self.frames.open_spill(os.path.join(os.path.dirname(self.camera_settings.imagefile), 'frames_air.log'), append=self.continue_mode)
                 self.capture_thread = self.start_thread(self.capture_threadfunc)
+                self.decode_thread = self.start_thread(self.decode_threadfunc)
                 self.scan_thread = self.start_thread(self.scan_threadfunc)
                 self.transmit_thread = self.start_thread(self.transmit_threadfunc)
                 time.sleep(0.1)
@@ -152,24 +201,29 @@ class CameraAirModule(mp_module.MPModule):
             print("Stopped cuav")
             self.send_message("Stopped cuav")
         elif args[0] == "status":
-            ret = "Cap imgs:%u err:%u scan:%u regions:%u jsize:%.0f xmitq:%s sq:%.1f eff:%s" % (
+            ret = "Cap imgs:%u err:%u scan:%u regions:%u jsize:%.0f xmitq:%s sq:%.1f eff:%s store:%s" % (
                 self.capture_count, self.error_count, self.scan_count,
                 self.region_count,
                 self.jpeg_size,
                 self.xmit_queue, self.scan_queue.qsize(),
-                self.efficiency)
+                self.efficiency, self.images)
             print(ret)
             self.send_message(ret)
         elif args[0] == "queue":
-            ret = "scan %u  transmit %u  eff %s  bw %s  rtt %s" % (
+            ret = "scan %u  transmit %u  eff %s  bw %s  rtt %s  quality %s  dropped %u  suppressed %u" % (
                 self.scan_queue.qsize(),
                 self.transmit_queue.qsize(),
                 self.efficiency,
                 self.bandwidth_used,
-                self.rtt_estimate)
+                self.rtt_estimate,
+                self.xmit_quality,
+                self.scheduler.dropped,
+                self.tracker.suppressed)
             print(ret)
         elif args[0] == "set":
             self.camera_settings.command(args[1:])
+        elif args[0] == "profile":
+            self.cmd_profile(args[1:])
         elif args[0] == "airstart":
             #just keep the block xmit going for now
             self.capture_count = 0
@@ -208,8 +262,17 @@ class CameraAirModule(mp_module.MPModule):
         '''image capture thread, via monitoring the
         link for changed linked filenames'''
         prev_image = None
+        ring = None
         self.scan_queue = Queue.Queue()
         while not self.unload_event.wait(0.05):
+            if self.is_armed and self.camera_settings.imagefile:
+                stopfile = self.camera_settings.imagefile + ".stop"
+                if os.path.exists(stopfile):
+                    print("Removing stopfile")
+                    os.unlink(stopfile)
+            if self.camera_settings.shmring:
+                ring = self.capture_ring(ring)
+                continue
             try:
                 filename = os.path.realpath(self.camera_settings.imagefile)
                 if not self.camera_settings.ignoretimestamps:
@@ -222,47 +285,118 @@ class CameraAirModule(mp_module.MPModule):
             #ensure all items are valid and the queue isn't overfilled > 100
             if filename != None and prev_image != filename and filetime != None and self.scan_queue.qsize() < 100:
                 self.scan_queue.put((filetime, filename))
-                self.imagefilenamemapping[str(filetime)] = filename
+                self.frames.update(filetime, filename=filename, enqueued=time.time())
+                self.images.max_bytes = self.camera_settings.maxstore * 1000000
+                self.images.min_free = self.camera_settings.minfree * 1000000
+                self.images.add(filetime, filename)
                 self.capture_count += 1
                 prev_image = filename
-            if self.is_armed:
-                stopfile = self.camera_settings.imagefile + ".stop"
-                if os.path.exists(stopfile):
-                    print("Removing stopfile")
-                    os.unlink(self.camera_settings.imagefile + ".stop")
+
+    def capture_ring(self, ring):
+        '''queue new frames from the shared memory ring for scanning,
+        returning the ring reader'''
+        path = self.camera_settings.shmring
+        if ring is not None and (ring.path != path or ring.changed()):
+            ring.close()
+            ring = None
+        if ring is None:
+            try:
+                ring = cuav_shmring.FrameRingReader(path)
+            except (IOError, OSError, cuav_shmring.FrameRingException):
+                return None
+        for (frame_time, img, filename) in ring.read_new():
+            if self.scan_queue.qsize() >= 100:
+                continue
+            if self.camera_settings.ignoretimestamps:
+                frame_time = float(time.time())
+            self.scan_queue.put((frame_time, img))
+            # the capture program saves the frame to filename in the background
+            if filename:
+                self.frames.update(frame_time, filename=filename, enqueued=time.time())
+            else:
+                self.frames.update(frame_time, enqueued=time.time())
+            self.capture_count += 1
+        return ring
+
+    def decode_threadfunc(self):
+        '''image decode thread, keeping decoded frames ready for the
+        scan thread'''
+        while not self.unload_event.is_set():
+            try:
+                (frame_time,im) = self.scan_queue.get(timeout=0.5)
+            except Queue.Empty:
+                continue
+
+            # stage times for latency tracing, see cuav_latency. The
+            # frame time may be from the camera clock, so is kept apart
+            stamps = {'capture': time.time()}
+            enqueued = self.frames.get(frame_time, 'enqueued')
+            if enqueued is not None:
+                stamps['enqueue'] = enqueued
+
+            # with scan_reduce the scanner gets a reduced image, and the
+            # full resolution image is kept for thumbnails
+            reduce = self.camera_settings.scan_reduce
+            full = None
+            if isinstance(im, numpy.ndarray):
+                # a raw frame from the shared memory ring
+                img = im
+            elif reduce in REDUCED_JPEG and im.lower().endswith(('.jpg', '.jpeg')):
+                # the JPEG decoder can scale down cheaply as it decodes,
+                # and thumbnails only need the parts around each region
+                img = cv2.imread(im, REDUCED_JPEG[reduce])
+                full = cuav_jpeg.JpegImage(im, rotate180=self.camera_settings.rotate180)
+            else:
+                img = cv2.imread(im, -1)
+            if img is None:
+                self.error_count += 1
+                self.error_msg = "Failed to decode %s" % im
+                self.scan_queue.task_done()
+                continue
+            if self.camera_settings.rotate180:
+                # flipping both axes is a 180 degree rotation
+                img = cv2.flip(img, -1)
+            if reduce > 1 and full is None:
+                full = img
+                (h, w) = img.shape[:2]
+                img = cv2.resize(full, (w//reduce, h//reduce), interpolation=cv2.INTER_AREA)
+            stamps['decode'] = time.time()
+
+            while not self.unload_event.is_set():
+                try:
+                    self.decode_queue.put((frame_time, img, full, stamps), timeout=0.5)
+                    break
+                except Queue.Full:
+                    pass
+            # marked done once handed on, so a frame is always unfinished
+            # in one of the queues until it has been scanned
+            self.scan_queue.task_done()
 
     def scan_threadfunc(self):
         '''image scanning thread'''
-        while not self.unload_event.wait(0.05):
+        while not self.unload_event.is_set():
             try:
-                (frame_time,im) = self.scan_queue.get()
+                (frame_time, img_scan, full, stamps) = self.decode_queue.get(timeout=0.5)
             except Queue.Empty:
                 continue
-            scan_parms = {}
-            for name in self.image_settings.list():
-                scan_parms[name] = self.image_settings.get(name)
-
-            if self.terrain_alt is not None:
-                altitude = self.terrain_alt
-                if altitude < self.camera_settings.minalt:
-                    altitude = self.camera_settings.minalt
-                scan_parms['MetersPerPixel'] = cuav_util.pixel_width(altitude,
-                                                                     self.c_params.xresolution,
-                                                                     self.c_params.lens,
-                                                                     self.c_params.sensorwidth)
+            scan_shape = cuav_util.image_shape(img_scan)
+            if full is None:
+                full_shape = scan_shape
+            elif isinstance(full, numpy.ndarray):
+                full_shape = cuav_util.image_shape(full)
+            else:
+                full_shape = full.shape()
+            (w, h) = full_shape
+            scan_parms = self.scan_parms.get(self.image_settings, self.camera_settings,
+                                             self.c_params, self.terrain_alt,
+                                             float(w) / scan_shape[0])
 
             t1 = time.time()
-            img_scan = cv2.imread(im, -1)
-            (h, w) = img_scan.shape[:2]
-            if self.camera_settings.rotate180:
-                M = cv2.getRotationMatrix2D(center, angle180, scale)
-                img_scan = cv2.warpAffine(img_scan, M, (w, h))
             im_numpy = numpy.ascontiguousarray(img_scan)
             regions = scanner.scan(im_numpy, scan_parms)
-            regions = cuav_region.RegionsConvert(regions,
-                                                 cuav_util.image_shape(img_scan),
-                                                 cuav_util.image_shape(img_scan))
+            regions = cuav_region.RegionsConvert(regions, scan_shape, scan_shape)
             t2 = time.time()
+            stamps['scan'] = t2
             self.scan_fps = 1.0 / (t2-t1)
             self.scan_count += 1
 
@@ -271,7 +405,12 @@ class CameraAirModule(mp_module.MPModule):
                                                  min_score=self.camera_settings.minscore,
                                                  filter_type=self.camera_settings.filter_type,
                                                  target_hue=self.camera_settings.RegionHue)
+            if full is not None:
+                regions = cuav_region.ScaleRegions(regions, scan_shape, full_shape)
             self.region_count += len(regions)
+            stamps['score'] = time.time()
+            self.perf_latency.add('frame', stamps)
+            self.images.scanned(frame_time, keep=len(regions) > 0)
             
             if self.camera_settings.roll_stabilised:
                 roll=0
@@ -279,7 +418,7 @@ class CameraAirModule(mp_module.MPModule):
                 roll=None
             pos = self.get_plane_position(frame_time, roll=roll)
             if pos is not None:
-                self.posmapping[str(frame_time)] = pos
+                self.frames.update(frame_time, pos=pos)
 
             # this adds the latlon field to the regions (georeferencing)
             for r in regions:
@@ -299,19 +438,30 @@ class CameraAirModule(mp_module.MPModule):
             if self.boundary_polygon:
                 regions = cuav_region.filter_boundary(regions, self.boundary_polygon, pos)
 
+            # only send new targets, or better detections of targets already sent
+            self.tracker.radius = self.camera_settings.track_radius
+            self.tracker.window = self.camera_settings.track_window
+            (regions, hits, tracks) = self.tracker.update(frame_time, regions)
+
             if len(regions) > 0 and self.camera_settings.transmit:
                 # send a region message with thumbnails to the ground station
-                thumb_img = cuav_region.CompositeThumbnail(img_scan, regions,
-                                                           thumb_size=self.camera_settings.thumbsize)
-                encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 90]
-                (result, thumb) = cv2.imencode('.jpg', thumb_img, encode_param)
-                pkt = cuav_command.ThumbPacket(frame_time, regions, thumb, pos)
+                if isinstance(full, cuav_jpeg.JpegImage):
+                    thumb_img = cuav_region.CompositeThumbnailJpeg(full, regions,
+                                                                   thumb_size=self.camera_settings.thumbsize)
+                else:
+                    thumb_img = cuav_region.CompositeThumbnail(img_scan if full is None else full, regions,
+                                                               thumb_size=self.camera_settings.thumbsize)
+                # the thumbnail is jpeg encoded per link in send_object
+                pkt = cuav_command.ThumbPacket(frame_time, regions, thumb_img, pos, hits, tracks)
+                pkt.stamps = stamps
 
                 if self.transmit_queue.qsize() < 100:
+                    pkt.stamp('queued')
                     self.transmit_queue.put((pkt, None, None))
                 else:
                     self.send_message("Warning: image Tx queue too long")
                     print("Warning: image Tx queue too long")
+            self.decode_queue.task_done()
 
     def get_plane_position(self, frame_time,roll=None):
         '''get a MavPosition object for the planes position if possible'''
@@ -339,46 +489,123 @@ class CameraAirModule(mp_module.MPModule):
         in addition to reading commands from the camera_ground'''
         self.start_aircraft_bsend()
         self.spacewarning = False
-
-        while (not self.unload_event.wait(0.05)) or self.airstart_triggered:
+        last_space_check = 0
+
+        while (not self.unload_event.is_set()) or self.airstart_triggered:
+            # sleep until a packet arrives, something is queued to send or
+            # a link has data due to go out
+            timeout = self.last_heartbeat + 5 - time.time()
+            if self.camera_settings.perf_interval > 0:
+                timeout = min(timeout, self.last_perf + self.camera_settings.perf_interval - time.time())
+            cuav_event.wait(self.bsend, max(timeout, 0.01), [self.transmit_queue])
             for bsnd in self.bsend:
                 bsnd.tick(packet_count=1000, max_queue=self.camera_settings.maxqueue)
                 self.check_commands(bsnd)
             self.send_heartbeats()
 
             #check remaining disk space and warn user if required
-            try:
-                stat = os.statvfs(os.path.dirname(self.camera_settings.imagefile))
-                if not self.spacewarning and stat.f_bfree*stat.f_bsize < 20971520:
-                    self.send_message("Warning: <200Mb disk space left on cuav_air")
-                    self.spacewarning = True
-            except OSError:
-                pass
+            if time.time() - last_space_check > 5:
+                last_space_check = time.time()
+                try:
+                    stat = os.statvfs(os.path.dirname(self.camera_settings.imagefile))
+                    self.disk_free = stat.f_bavail * stat.f_frsize / 1.0e6
+                    if not self.spacewarning and stat.f_bfree*stat.f_bsize < 20971520:
+                        self.send_message("Warning: <200Mb disk space left on cuav_air")
+                        self.spacewarning = True
+                except OSError:
+                    pass
 
             while not self.transmit_queue.empty():
                 (pkt, priority, linktosend) = self.transmit_queue.get()
-                self.send_object(pkt, priority, linktosend)
+                if pkt is not None:
+                    self.send_object(pkt, priority, linktosend)
 
             #update the stats
             self.xmit_queue = []
             self.efficiency = []
             self.bandwidth_used = []
             self.rtt_estimate = []
+            self.xmit_quality = []
             for bsnd in self.bsend:
                 self.xmit_queue.append(bsnd.sendq_size())
                 self.efficiency.append(bsnd.get_efficiency())
                 self.bandwidth_used.append(bsnd.get_bandwidth_used())
                 self.rtt_estimate.append(bsnd.get_rtt_estimate())
+            for ctl in self.xmit_control:
+                ctl.target_latency = self.camera_settings.xmit_latency
+                ctl.min_quality = self.camera_settings.minquality
+                ctl.update()
+                self.xmit_quality.append(ctl.quality(self.camera_settings.qualitythumb))
+            self.send_perf_report()
+
+    def process_memory(self):
+        '''return the resident memory of this process in MB, or None'''
+        try:
+            with open('/proc/self/statm') as f:
+                pages = int(f.read().split()[1])
+            return pages * os.sysconf('SC_PAGE_SIZE') / 1.0e6
+        except (IOError, ValueError, IndexError, AttributeError, OSError):
+            return None
+
+    def perf_report(self):
+        '''build a PerfReport, starting a new reporting interval'''
+        tnow = time.time()
+        elapsed = max(tnow - self.last_perf, 0.001)
+        t = os.times()
+        cpu = 100.0 * ((t[0] + t[1]) - (self.perf_cpu[0] + self.perf_cpu[1])) / elapsed
+        scan_fps = (self.scan_count - self.perf_scan_count) / elapsed
+        self.last_perf = tnow
+        self.perf_cpu = t
+        self.perf_scan_count = self.scan_count
+
+        latency = self.perf_latency.snapshot()
+        latencies = latency.means('frame')
+        thumb = latency.means('thumb')
+        if 'total' in thumb:
+            latencies['thumb'] = thumb['total']
 
-    def send_image(self, img, frame_time, priority, pos, linktosend):
+        try:
+            load = os.getloadavg()[0]
+        except (AttributeError, OSError):
+            load = None
+        queues = {'scan' : self.scan_queue.qsize(),
+                  'decode' : self.decode_queue.qsize(),
+                  'transmit' : self.transmit_queue.qsize()}
+        links = []
+        for bsnd in self.bsend:
+            links.append((bsnd.sendq_size(), bsnd.get_bandwidth_used(),
+                          bsnd.get_efficiency(), bsnd.get_rtt_estimate()))
+        return cuav_command.PerfReport(scan_fps, queues, latencies, cpu, load,
+                                       self.process_memory(), self.disk_free, links)
+
+    def send_perf_report(self):
+        '''possibly send a performance report to the GCS'''
+        interval = self.camera_settings.perf_interval
+        if interval > 0 and time.time() - self.last_perf > interval:
+            self.send_object(self.perf_report())
+
+    def get_xmit_control(self, bsnd):
+        '''get the adaptive quality controller for a link'''
+        if bsnd in self.bsend:
+            return self.xmit_control[self.bsend.index(bsnd)]
+        return None
+
+    def send_image(self, img, frame_time, priority, pos, linktosend, stamps=None):
         '''send an image object to the GCS'''
-        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), self.camera_settings.qualitysend]
+        quality = self.camera_settings.qualitysend
+        ctl = self.get_xmit_control(linktosend)
+        if ctl is not None:
+            quality = ctl.quality(quality)
+        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
         (result, jpeg) = cv2.imencode('.jpg', img, encode_param)
 
         # keep filtered image size
         self.jpeg_size = 0.95 * self.jpeg_size + 0.05 * len(jpeg)
 
         pkt = cuav_command.ImagePacket(frame_time, jpeg, pos, priority)
+        if stamps is not None:
+            pkt.stamps = stamps
+        pkt.stamp('encode')
         self.transmit_queue.put((pkt, priority, linktosend))
 
     def start_aircraft_bsend(self):
@@ -388,15 +615,55 @@ class CameraAirModule(mp_module.MPModule):
                 try:
                     [remoteip, remoteport, localport, bw] = lnk.split(':')
                     newbsnd = block_xmit.BlockSender(bandwidth=int(bw), debug=False,
-                                        dest_ip=remoteip, dest_port=int(remoteport), port=int(localport))
+                                        dest_ip=remoteip, dest_port=int(remoteport), port=int(localport),
+                                        batch=self.camera_settings.xmit_batch,
+                                        fec=self.camera_settings.xmit_fec,
+                                        adaptive=self.camera_settings.xmit_adaptive)
                     self.bsend.append(newbsnd)
+                    self.xmit_control.append(cuav_xmit.QualityController(newbsnd,
+                                                                         target_latency=self.camera_settings.xmit_latency,
+                                                                         min_quality=self.camera_settings.minquality))
                 except:
                     print("Bad GCS endpoint (must be remIP:remport:localport:bw): " + str(lnk))
                     pass
 
+    def cmd_profile(self, args):
+        '''profile the camera threads for a number of seconds'''
+        if len(args) < 1:
+            print("usage: camera profile <seconds> [TOPN]")
+            return
+        if self.profiler.running():
+            print("profile already running")
+            return
+        top = 0
+        if len(args) > 1:
+            top = int(args[1])
+        self.profiler.start(float(args[0]), functools.partial(self.profile_complete, top))
+        print("Profiling for %s seconds" % args[0])
+
+    def profile_complete(self, top, profiler):
+        '''save a completed profile next to joe_air.log, sending a summary
+        of the top functions to the GCS if requested'''
+        logdir = '.'
+        if self.camera_settings.imagefile:
+            logdir = os.path.dirname(self.camera_settings.imagefile)
+        filename = os.path.join(logdir, 'profile_air_%s.txt' % cuav_util.frame_time(time.time()))
+        try:
+            profiler.write(filename)
+            msg = "Profile of %u samples saved to %s" % (profiler.sample_count, filename)
+        except IOError as e:
+            msg = "Failed to save profile: %s" % e
+        print(msg)
+        self.send_message(msg)
+        if top > 0:
+            summary = profiler.summary(top)
+            print(summary)
+            self.send_message("Profile top %u:\n%s" % (top, summary))
+
     def start_thread(self, fn):
         '''start a thread running'''
         t = threading.Thread(target=fn)
+        t.name = fn.__name__
         t.daemon = True
         t.start()
         return t
@@ -405,8 +672,10 @@ class CameraAirModule(mp_module.MPModule):
         '''unload module'''
         self.running = False
         self.unload_event.set()
+        self.transmit_queue.put((None, None, None))
         if self.capture_thread is not None:
             self.capture_thread.join(1.0)
+            self.decode_thread.join(1.0)
             self.scan_thread.join(1.0)
             self.transmit_thread.join(1.0)
         print('camera unload OK')
@@ -419,7 +688,7 @@ class CameraAirModule(mp_module.MPModule):
         if buf is None:
             return
         try:
-            obj = cPickle.loads(str(buf))
+            obj = cuav_wire.decode(str(buf))
             if obj == None:
                 return
         except Exception as e:
@@ -429,7 +698,7 @@ class CameraAirModule(mp_module.MPModule):
             if obj.timestamp in self.handled_timestamps:
                 # we've seen this packet before, discard
                 return
-            self.handled_timestamps[obj.timestamp] = time.time()
+            self.handled_timestamps.update(obj.timestamp, received=time.time())
 
         if isinstance(obj, cuav_command.ImageRequest):
             self.handle_image_request(obj, bsend)
@@ -460,7 +729,9 @@ class CameraAirModule(mp_module.MPModule):
             if m.airspeed > self.camera_settings.minspeed or m.groundspeed > self.camera_settings.minspeed:
                 self.running = True
                 self.joelog = cuav_joe.JoeLog(os.path.join(os.path.dirname(self.camera_settings.imagefile), 'joe_air.log'), append=self.continue_mode)
+                self.frames.open_spill(os.path.join(os.path.dirname(self.camera_settings.imagefile), 'frames_air.log'), append=self.continue_mode)
                 self.capture_thread = self.start_thread(self.capture_threadfunc)
+                self.decode_thread = self.start_thread(self.decode_threadfunc)
                 self.scan_thread = self.start_thread(self.scan_threadfunc)
                 self.send_message("Started cuav running")
                 print("Started cuav running")
@@ -496,7 +767,15 @@ class CameraAirModule(mp_module.MPModule):
 
     def handle_image_request(self, obj, bsend):
         '''handle ImageRequest from GCS. Only sends to the requesting GCS'''
-        filename = self.imagefilenamemapping[str(obj.frame_time)]
+        filename = self.images.lookup(obj.frame_time)
+        if filename is None:
+            filename = self.frames.get(obj.frame_time, 'filename')
+        if filename is None:
+            print("No image for frame time %f" % obj.frame_time)
+            return
+        # keep the image before looking at it, so the capture thread
+        # can't prune it in between
+        self.images.keep(obj.frame_time)
         if not os.path.exists(filename):
             print("No file: %s" % filename)
             return
@@ -504,12 +783,16 @@ class CameraAirModule(mp_module.MPModule):
             img = cv2.imread(filename, -1)
         except Exception:
             return
+        if img is None:
+            print("Failed to load: %s" % filename)
+            return
         if not obj.fullres:
             im_small = cv2.resize(img, (0,0), fx=0.5, fy=0.5)
             img = im_small
+        stamps = {'decode': time.time()}
         print("Sending image %s" % filename)
-        pos = self.posmapping.get(str(obj.frame_time), None)
-        self.send_image(img, obj.frame_time, 10000, pos, bsend)
+        pos = self.frames.get(obj.frame_time, 'pos')
+        self.send_image(img, obj.frame_time, 10000, pos, bsend, stamps)
 
     def camera_settings_callback(self, setting):
         '''called on a changed camera setting'''
@@ -538,20 +821,121 @@ class CameraAirModule(mp_module.MPModule):
                 if bsend != bsnd:
                     bsnd.cancel(obj.blockid)
 
+    def pack_object(self, obj, bsnd, encoded):
+        '''encode an object for sending on a link. ThumbPackets hold the
+        raw composite thumbnail, which is jpeg encoded here at the quality
+        and scale chosen for the link. encoded caches the results across
+        links. Packets are stamped 'handoff' here, as they go to the
+        BlockSender'''
+        if not isinstance(obj, cuav_command.ThumbPacket):
+            if None not in encoded:
+                if isinstance(obj, cuav_command.ImagePacket):
+                    obj.stamp('handoff')
+                encoded[None] = cuav_wire.encode(obj)
+            return encoded[None]
+        quality = self.camera_settings.qualitythumb
+        scale = 1.0
+        ctl = self.get_xmit_control(bsnd)
+        if ctl is not None:
+            quality = ctl.quality(quality)
+            scale = ctl.scale()
+        (h, w) = obj.thumb.shape[:2]
+        thumb_size = max(int(h * scale), 10)
+        key = (quality, thumb_size)
+        if key not in encoded:
+            thumb_img = obj.thumb
+            if thumb_size != h:
+                thumb_img = cv2.resize(thumb_img, ((w//h)*thumb_size, thumb_size))
+            encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+            (result, thumb) = cv2.imencode('.jpg', thumb_img, encode_param)
+            pkt = cuav_command.ThumbPacket(obj.frame_time, obj.regions, thumb, obj.pos, obj.hits, obj.tracks)
+            pkt.timestamp = obj.timestamp
+            pkt.stamps = dict(obj.stamps)
+            pkt.stamp('encode')
+            pkt.stamp('handoff')
+            self.perf_latency.add('thumb', pkt.stamps)
+            encoded[key] = cuav_wire.encode(pkt)
+        return encoded[key]
+
+    def thumb_priority(self, obj):
+        '''get the send priority for a ThumbPacket'''
+        target = None
+        if self.camera_settings.target_latitude != 0 or self.camera_settings.target_longitude != 0:
+            target = (self.camera_settings.target_latitude,
+                      self.camera_settings.target_longitude,
+                      self.camera_settings.target_radius)
+        return self.scheduler.priority(obj.frame_time, obj.regions, target)
+
     def send_object(self, obj, priority=None, linktosend=None):
         '''send an object to all links if linktosend is none
         otherwise just send to the specified link'''
-        buf = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+        is_thumb = isinstance(obj, cuav_command.ThumbPacket)
         if priority is None:
-            priority = 10000
-        #only send if the queue is not clogged
+            if is_thumb:
+                priority = self.thumb_priority(obj)
+            else:
+                priority = 10000
         if not linktosend:
-            for bsnd in self.bsend:
-                if bsnd.sendq_size() < self.camera_settings.maxqueue:
-                    obj.blockid = bsnd.send(buf, priority=priority, callback=functools.partial(self.send_object_complete, obj, bsnd))
+            links = self.bsend
         else:
-            if linktosend.sendq_size() < self.camera_settings.maxqueue:
-                obj.blockid = linktosend.send(buf, priority=priority, callback=functools.partial(self.send_object_complete, obj, linktosend))
+            links = [linktosend]
+        #only send if the queue is not clogged, though a thumbnail may
+        #replace a lower priority one. This is decided once per link, as
+        #making room drops a thumbnail
+        links = [bsnd for bsnd in links if self.link_room(bsnd, priority, is_thumb)]
+        if (not linktosend and self.camera_settings.xmit_stripe and
+            priority < self.camera_settings.stripe_dup_priority and
+            self.send_striped(obj, priority, is_thumb, links)):
+            return
+        encoded = {}
+        # images and thumbnails are already compressed
+        compress = (self.camera_settings.xmit_compress and not is_thumb and
+                    not isinstance(obj, cuav_command.ImagePacket))
+        for bsnd in links:
+            buf = self.pack_object(obj, bsnd, encoded)
+            ctl = self.get_xmit_control(bsnd)
+            if ctl is not None:
+                ctl.record_send(len(buf))
+            obj.blockid = bsnd.send(buf, priority=priority, callback=functools.partial(self.send_object_complete, obj, bsnd),
+                                    compress=compress)
+            if is_thumb:
+                self.scheduler.sent(bsnd, obj.blockid, priority)
+
+    def link_room(self, bsnd, priority, is_thumb):
+        '''return True if an object can be queued on a link. A thumbnail
+        may make room on a full link by dropping a lower priority one'''
+        if bsnd.sendq_size() < self.camera_settings.maxqueue:
+            return True
+        return is_thumb and self.scheduler.make_room(bsnd, priority)
+
+    def send_striped(self, obj, priority, is_thumb, links):
+        '''send an object split across those of links that have heard from
+        the ground recently, in proportion to their throughput. Returns
+        False if it is not worth splitting, so it should be sent whole'''
+        links = [bsnd for bsnd in links if bsnd.is_alive(STRIPE_LINK_TIMEOUT)]
+        if len(links) < 2:
+            return False
+        weights = [cuav_stripe.link_weight(bsnd) for bsnd in links]
+        # thumbnails are encoded for the fastest link
+        fastest = links[weights.index(max(weights))]
+        buf = self.pack_object(obj, fastest, {})
+        lengths = cuav_stripe.split(len(buf), weights)
+        if len([n for n in lengths if n > 0]) < 2:
+            return False
+        (start, count) = self.stripe_id
+        self.stripe_id = (start, count+1)
+        obj.blockid = None
+        for (bsnd, frag) in zip(links, cuav_stripe.fragments(self.stripe_id, buf, lengths)):
+            if frag is None:
+                continue
+            fbuf = cuav_wire.encode(frag)
+            ctl = self.get_xmit_control(bsnd)
+            if ctl is not None:
+                ctl.record_send(len(fbuf))
+            blockid = bsnd.send(fbuf, priority=priority)
+            if is_thumb:
+                self.scheduler.sent(bsnd, blockid, priority)
+        return True
 
     def handle_command_packet(self, obj, bsend):
         '''handle CommandPacket from other end'''
@@ -4,14 +4,14 @@ It takes in sent images from camera_air and displays them
 via a GUI'''
 
 
-import time, threading, os, cPickle
+import time, threading, os
 import functools, cv2, pkg_resources
 
 from MAVProxy.modules.lib import mp_module, mp_image
 from MAVProxy.modules.lib.mp_settings import MPSettings, MPSetting
 from MAVProxy.modules.mavproxy_map import mp_slipmap
 
-from cuav.lib import cuav_mosaic, cuav_util, cuav_joe, block_xmit, cuav_command
+from cuav.lib import cuav_mosaic, cuav_util, cuav_joe, block_xmit, cuav_command, cuav_latency, cuav_event, cuav_profile, cuav_stripe, cuav_wire
 from cuav.camera.cam_params import CameraParams
 
 
@@ -27,6 +27,8 @@ class CameraGroundModule(mp_module.MPModule):
 
         self.view_thread = None
         self.handled_timestamps = {}
+        # packets striped across the links by camera_air
+        self.stripes = cuav_stripe.StripeAssembler()
 
         self.camera_settings = MPSettings(
             [MPSetting('air_address',
@@ -43,6 +45,9 @@ class CameraGroundModule(mp_module.MPModule):
              MPSetting('mosaic_thumbsize', int, 35, 'Mosaic Thumbnail Size',
                        range=(10, 200), increment=1),
              MPSetting('maxqueue', int, 100, 'Maximum images queue'),
+             MPSetting('xmit_batch', int, 0, 'Packets per system call with sendmmsg/recvmmsg (0 to disable)',
+                       range=(0, 1024), increment=1, tab='GCS'),
+             MPSetting('xmit_compress', bool, True, 'Compress commands sent to the aircraft, if it supports it', tab='GCS'),
              MPSetting('target_latitude', float, 0, 'filter detected images to latitude', tab='Filter to Location'),
              MPSetting('target_longitude', float, 0, 'filter detected images to longitude', tab='Filter to Location'),
              MPSetting('target_radius', float, 0, 'filter detected images to radius', tab='Filter to Location'),
@@ -66,12 +71,15 @@ class CameraGroundModule(mp_module.MPModule):
         self.last_heartbeat = time.time()
 
         self.joelog = None
+        self.latency = cuav_latency.LatencyTracker()
+        self.perf_report = None
+        self.profiler = cuav_profile.SamplingProfiler()
 
         self.c_params = None
 
         self.add_command('camera', self.cmd_camera,
                          'camera control',
-                         ['<status|view|boundary>',
+                         ['<status|view|boundary|profile>',
                           'set (CAMERASETTING)'])
         self.add_command('remote', self.cmd_remote, "remote command", ['(COMMAND)'])
         self.add_completion_function('(CAMERASETTING)', self.settings.completion)
@@ -80,7 +88,7 @@ class CameraGroundModule(mp_module.MPModule):
 
     def cmd_camera(self, args):
         '''camera commands'''
-        usage = "usage: camera <status|view|boundary|set>"
+        usage = "usage: camera <status|view|boundary|set|profile>"
         if len(args) == 0:
             print(usage)
             return
@@ -91,6 +99,11 @@ class CameraGroundModule(mp_module.MPModule):
             self.send_packet(pkt)
             pkt = cuav_command.CommandPacket('queue')
             self.send_packet(pkt)
+            report = self.latency.report()
+            if report:
+                print(report)
+            if self.perf_report is not None:
+                print('AIR PERF: %s' % self.perf_report)
         elif args[0] == "view":
             #check cam params
             if not self.check_camera_parms():
@@ -104,11 +117,14 @@ class CameraGroundModule(mp_module.MPModule):
             self.joelog = cuav_joe.JoeLog(os.path.join(self.camera_dir,
                                                        'joe_ground.log'),
                                           append=self.continue_mode)
+            self.latency.logfile = os.path.join(self.camera_dir, 'latency_ground.log')
             if self.view_thread is None:
                 self.view_thread = self.start_thread(self.view_threadfunc)
             self.viewing = True
         elif args[0] == "set":
             self.camera_settings.command(args[1:])
+        elif args[0] == "profile":
+            self.cmd_profile(args[1:])
         elif args[0] == "boundary":
             if len(args) != 2:
                 print("boundary=%s" % self.boundary)
@@ -179,7 +195,8 @@ class CameraGroundModule(mp_module.MPModule):
                     newbsnd = block_xmit.BlockSender(bandwidth=int(bw), debug=False,
                                                      dest_ip=remoteip,
                                                      dest_port=int(remoteport),
-                                                     port=int(localport))
+                                                     port=int(localport),
+                                                     batch=self.camera_settings.xmit_batch)
                     self.bsend.append(newbsnd)
                 except:
                     print("Bad Air endpoint (must be remIP:remport:localport:bw): " + str(lnk))
@@ -215,7 +232,10 @@ class CameraGroundModule(mp_module.MPModule):
                                          image_settings=None,
                                          thumb_size=self.camera_settings.mosaic_thumbsize)
 
-        while not self.unload_event.wait(0.05):
+        while not self.unload_event.is_set():
+            # wake as soon as a packet arrives, polling the mosaic for
+            # user events at least every 0.1 seconds
+            cuav_event.wait(self.bsend, 0.1)
             if self.boundary_polygon is not None:
                 self.mosaic.set_boundary(self.boundary_polygon)
             if self.continue_mode:
@@ -251,10 +271,16 @@ class CameraGroundModule(mp_module.MPModule):
         buf = bsend.recv(0)
         if buf is None:
             return
+        received = time.time()
         try:
-            obj = cPickle.loads(str(buf))
+            obj = cuav_wire.decode(str(buf))
             if obj is None:
                 return
+            if isinstance(obj, cuav_command.StripePacket):
+                buf = self.stripes.add(obj)
+                if buf is None:
+                    return
+                obj = cuav_wire.decode(buf)
         except Exception as e:
             return
 
@@ -271,10 +297,13 @@ class CameraGroundModule(mp_module.MPModule):
 
             self.thumb_total_bytes += len(buf)
 
+            obj.stamp('received', received)
+
             # add the thumbnails to the mosaic
             thumbdec = cv2.imdecode(obj.thumb, 1)
             if thumbdec is None:
                 pass
+            obj.stamp('decoded')
             thumbs = cuav_mosaic.ExtractThumbs(thumbdec, len(obj.regions))
             thumbsRGB = []
 
@@ -289,7 +318,10 @@ class CameraGroundModule(mp_module.MPModule):
             self.log_joe_position(obj.pos, obj.frame_time, obj.regions, filename, None)
 
             # update the mosaic and map
-            self.mosaic.add_regions(obj.regions, thumbsRGB, filename, obj.pos)
+            # a better thumbnail of a tracked target replaces the earlier one
+            self.mosaic.add_regions(obj.regions, thumbsRGB, filename, obj.pos, obj.hits, obj.tracks)
+            obj.stamp('displayed')
+            self.latency.add('thumb', obj.stamps, bsend.get_clock_offset() or 0)
 
             # update console display
             self.region_count += len(obj.regions)
@@ -304,8 +336,11 @@ class CameraGroundModule(mp_module.MPModule):
             # we have an image from the plane
             self.image_total_bytes += len(buf)
 
+            obj.stamp('received', received)
+
             #save to file
             imagedec = cv2.imdecode(obj.jpeg, 1)
+            obj.stamp('decoded')
             ff = os.path.join(self.view_dir, cuav_util.frame_time(obj.frame_time)) + ".jpg"
             write_param = [int(cv2.IMWRITE_JPEG_QUALITY), 99]
             cv2.imwrite(ff, imagedec, write_param)
@@ -313,6 +348,8 @@ class CameraGroundModule(mp_module.MPModule):
 
             if obj.pos is not None:
                 self.mosaic.add_image(obj.frame_time, ff, obj.pos)
+            obj.stamp('displayed')
+            self.latency.add('image', obj.stamps, bsend.get_clock_offset() or 0)
             
             # update console
             self.image_count += 1
@@ -332,14 +369,61 @@ class CameraGroundModule(mp_module.MPModule):
         if isinstance(obj, cuav_command.CameraMessage):
             print('CUAV AIR REMOTE: %s' % obj.msg)
 
+        if isinstance(obj, cuav_command.PerfReport):
+            self.handle_perf_report(obj)
+
+    def handle_perf_report(self, obj):
+        '''show a performance report from the aircraft on the console. The
+        status goes red if the aircraft is falling behind'''
+        self.perf_report = obj
+        scan_backlog = obj.queues.get('scan', 0)
+        xmit_backlog = max([link[0] for link in obj.links] + [0])
+        color = 'black'
+        if (scan_backlog > 10 or obj.cpu > 90 or xmit_backlog >= self.camera_settings.maxqueue or
+            (obj.disk_free is not None and obj.disk_free < 200)):
+            color = 'red'
+        self.console.set_status('AirFPS', 'AirFPS %.1f' % obj.scan_fps, row=8, fg=color)
+        self.console.set_status('AirCPU', 'AirCPU %.0f%%' % obj.cpu, row=8, fg=color)
+        self.console.set_status('AirQueue', 'AirQueue %u/%u' % (scan_backlog, xmit_backlog), row=8, fg=color)
+        if obj.disk_free is not None:
+            self.console.set_status('AirDisk', 'AirDisk %.0fMB' % obj.disk_free, row=8, fg=color)
+        if 'thumb' in obj.latencies:
+            self.console.set_status('AirLatency', 'AirLatency %.1fs' % obj.latencies['thumb'], row=8, fg=color)
+
     def log_joe_position(self, pos, frame_time, regions, filename=None, thumb_filename=None):
         '''add to joe_ground.log if possible, returning a list of (lat,lon) tuples
         for the positions of the identified image regions'''
         return self.joelog.add_regions(frame_time, regions, pos, filename, thumb_filename)
 
+    def cmd_profile(self, args):
+        '''profile the camera threads for a number of seconds'''
+        if len(args) < 1:
+            print("usage: camera profile <seconds> [TOPN]")
+            return
+        if self.profiler.running():
+            print("profile already running")
+            return
+        top = 0
+        if len(args) > 1:
+            top = int(args[1])
+        self.profiler.start(float(args[0]), functools.partial(self.profile_complete, top))
+        print("Profiling for %s seconds" % args[0])
+
+    def profile_complete(self, top, profiler):
+        '''save a completed profile in the log directory'''
+        filename = os.path.join(self.camera_dir, 'profile_ground_%s.txt' % cuav_util.frame_time(time.time()))
+        try:
+            profiler.write(filename)
+            print("Profile of %u samples saved to %s" % (profiler.sample_count, filename))
+        except IOError as e:
+            print("Failed to save profile: %s" % e)
+        if top > 0:
+            print(profiler.summary(top))
+
     def start_thread(self, fn):
         '''start a thread running'''
         t = threading.Thread(target=fn)
+        t.name = fn.__name__
         t.daemon = True
         t.start()
         return t
@@ -386,12 +470,13 @@ class CameraGroundModule(mp_module.MPModule):
                 bsnd.cancel(obj.blockid)
 
     def send_object(self, obj, priority):
-        buf = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+        buf = cuav_wire.encode(obj)
         #only send if the queue is not clogged
         for bsnd in self.bsend:
             if bsnd.sendq_size() < self.camera_settings.maxqueue:
                 obj.blockid = bsnd.send(buf, priority=priority,
-                                        callback=functools.partial(self.send_object_complete, obj))
+                                        callback=functools.partial(self.send_object_complete, obj),
+                                        compress=self.camera_settings.xmit_compress)
 
 
 
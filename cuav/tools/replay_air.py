@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+'''
+replay a mavlink log and image directory through camera_air
+
+The images are fed straight into the decode and scan threads of an
+in-process CameraAirModule, and the log is fed to mavlink_packet, with
+no network links or sleeps in between. The log time is the clock: the
+log is delivered up to each image's frame time before the image is
+queued, so the pipeline runs as fast as it can while georeferencing
+each frame from the same messages every run. The throughput, stage
+latencies and the set of regions that would have been sent to the GCS
+are reported, so changes to the pipeline can be compared on the same
+flight.
+'''
+
+import sys, os, time, Queue
+from argparse import ArgumentParser
+from pymavlink import mavutil
+from MAVProxy.modules.lib.mp_settings import MPSettings
+from cuav.lib import cuav_command, cuav_latency
+from cuav.tools.playback import scan_image_directory
+import cuav.modules.camera_air as camera_air
+
+
+class ReplayStatus:
+    '''the parts of the MAVProxy status used by camera_air'''
+    def __init__(self, logdir):
+        self.watch = None
+        self.logdir = logdir
+
+
+class ReplayState:
+    '''the parts of the MAVProxy state used by camera_air'''
+    def __init__(self, logdir):
+        self.public_modules = {}
+        self.command_map = {}
+        self.completions = {}
+        self.completion_functions = {}
+        self.settings = MPSettings([])
+        self.status = ReplayStatus(logdir)
+        self.continue_mode = False
+        self.console = None
+        self.functions = None
+
+    def module(self, name):
+        '''find a public module'''
+        return self.public_modules.get(name)
+
+
+class ReplayResult:
+    '''the results of a replay'''
+    def __init__(self):
+        self.frames = 0
+        self.scanned = 0
+        self.errors = 0
+        self.region_count = 0
+        self.log_time = 0
+        self.wall_time = 0
+        self.latency = None
+        self.regions = []
+
+    def fps(self):
+        '''return the frames scanned per second'''
+        if self.wall_time <= 0:
+            return 0
+        return self.scanned / self.wall_time
+
+    def speedup(self):
+        '''return the log time covered per second of replay'''
+        if self.wall_time <= 0:
+            return 0
+        return self.log_time / self.wall_time
+
+    def __str__(self):
+        ret = ['Frames: %u scanned %u errors %u' % (self.frames, self.scanned, self.errors),
+               'Throughput: %.2f fps %.1fx realtime in %.1fs' % (self.fps(), self.speedup(), self.wall_time),
+               'Regions: %u scored %u sent' % (self.region_count, len(self.regions))]
+        if self.latency is not None:
+            ret.append(self.latency.report())
+        return '\n'.join(ret)
+
+    def write_regions(self, filename):
+        '''write the regions sent, one per line, for comparing runs'''
+        with open(filename, 'w') as f:
+            for r in self.regions:
+                f.write(format_region(r) + '\n')
+
+
+def format_region(r):
+    '''format a region tuple (frame_time, latlon, score, hits)'''
+    (frame_time, latlon, score, hits) = r
+    if latlon is None:
+        pos = 'None'
+    else:
+        pos = '%.7f %.7f' % latlon
+    return '%.3f %s %s %u' % (frame_time, pos, score, hits)
+
+
+def next_msg(mlog, condition):
+    '''return the next message from the log, skipping corrupt data, which
+    can carry any timestamp'''
+    while True:
+        msg = mlog.recv_match(condition=condition)
+        if msg is None or msg.get_type() != 'BAD_DATA':
+            return msg
+
+
+def collect_regions(module, result):
+    '''take the packets queued for transmit, keeping the regions of thumbnails'''
+    while True:
+        try:
+            (pkt, priority, link) = module.transmit_queue.get_nowait()
+        except Queue.Empty:
+            return
+        if not isinstance(pkt, cuav_command.ThumbPacket):
+            continue
+        hits = pkt.hits or [1] * len(pkt.regions)
+        for (r, h) in zip(pkt.regions, hits):
+            result.regions.append((pkt.frame_time, r.latlon, r.score, h))
+
+
+def replay(logfile, images, camparms, outdir='.', settings=[], condition=None, max_inflight=1, timeout=30):
+    '''replay a mavlink log and a list of playback.ImageFile through
+    camera_air, returning a ReplayResult. The module's logs and stop
+    file go in outdir. settings is a list of
+    (name, value) camera settings. With max_inflight of 1 each frame
+    is scanned before the log moves on, making the results repeatable.
+    Higher values let frames overlap in the pipeline for throughput'''
+    images = [i for i in images if i.frame_time is not None]
+    module = camera_air.init(ReplayState(outdir))
+    module.perf_latency = cuav_latency.LatencyTracker()
+    module.camera_settings.set('camparms', camparms)
+    module.camera_settings.set('imagefile', os.path.join(outdir, 'replay.jpg'))
+    for (name, value) in settings:
+        module.camera_settings.set(name, value)
+    if not module.check_camera_parms():
+        module.unload()
+        raise RuntimeError('Failed to load camera parameters %s' % camparms)
+    module.decode_thread = module.start_thread(module.decode_threadfunc)
+    module.scan_thread = module.start_thread(module.scan_threadfunc)
+
+    result = ReplayResult()
+    mlog = mavutil.mavlink_connection(logfile, robust_parsing=True)
+    msg = next_msg(mlog, condition)
+    t0 = time.time()
+    for img in images:
+        # deliver the log up to the frame, and one message past it for
+        # interpolation, so its position can be found
+        while msg is not None and msg._timestamp <= img.frame_time:
+            module.mavlink_packet(msg)
+            msg = next_msg(mlog, condition)
+        if msg is not None:
+            module.mavlink_packet(msg)
+            msg = next_msg(mlog, condition)
+        module.frames.update(img.frame_time, filename=img.filename, enqueued=time.time())
+        module.scan_queue.put((img.frame_time, img.filename))
+        module.capture_count += 1
+        wait_inflight(module, max_inflight, timeout)
+        collect_regions(module, result)
+    wait_inflight(module, 1, timeout)
+    result.wall_time = time.time() - t0
+    collect_regions(module, result)
+    module.unload()
+    module.decode_thread.join(1.0)
+    module.scan_thread.join(1.0)
+
+    result.frames = module.capture_count
+    result.scanned = module.scan_count
+    result.errors = module.error_count
+    result.region_count = module.region_count
+    result.latency = module.perf_latency
+    if len(images) > 1:
+        result.log_time = images[-1].frame_time - images[0].frame_time
+    return result
+
+
+def wait_inflight(module, max_inflight, timeout):
+    '''wait until fewer than max_inflight frames are waiting to be decoded
+    or scanned. Each queue counts a frame as unfinished until the thread
+    taking it has handed it on or finished with it'''
+    tend = time.time() + timeout
+    while time.time() < tend:
+        inflight = module.scan_queue.unfinished_tasks + module.decode_queue.unfinished_tasks
+        if inflight < max_inflight:
+            return
+        time.sleep(0.001)
+    raise RuntimeError('Timed out waiting for the scan thread')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("imagedir", help='image directory')
+    parser.add_argument("logfile", help='mavlink log file')
+    parser.add_argument("--camparms", default='data/ChameleonArecort/params.json', help='camera parameters file in the cuav package')
+    parser.add_argument("--outdir", default='.', help='directory for the module logs')
+    parser.add_argument("--condition", default=None, help='condition on mavlink log')
+    parser.add_argument("--set", action='append', default=[], help='camera setting as name=value')
+    parser.add_argument("--max-inflight", type=int, default=1, help='frames in the pipeline at once. Above 1 results may vary between runs')
+    parser.add_argument("--regions", default=None, help='file to write the regions sent to')
+    args = parser.parse_args()
+
+    images = scan_image_directory(args.imagedir)
+    if len(images) == 0:
+        print("No images supplied")
+        sys.exit(1)
+    settings = [s.split('=', 1) for s in args.set]
+    result = replay(args.logfile, images, args.camparms, args.outdir, settings, args.condition, args.max_inflight)
+    print(result)
+    for r in result.regions:
+        print(format_region(r))
+    if args.regions is not None:
+        result.write_regions(args.regions)
@@ -26,6 +26,8 @@ if __name__ == '__main__':
     parser.add_argument("--debug", action='store_true', default=False, help="verbose debug")
     parser.add_argument("--mss", type=int, default=0, help="maximum segment size")
     parser.add_argument("--count", type=int, default=1, help="number of blocks to send")
+    parser.add_argument("--fec", type=int, default=0, help="chunks per FEC parity packet, -1 for automatic")
+    parser.add_argument("--ack-delay", type=float, default=0, help="seconds to delay acks so more are coalesced")
     args = parser.parse_args()
 
     bs = block_xmit.BlockSender(args.port,
@@ -35,6 +37,8 @@ if __name__ == '__main__':
                     chunk_size=args.chunk_size,
                     backlog=args.backlog,
                     mss=args.mss,
+                    fec=args.fec,
+                    ack_delay=args.ack_delay,
                     debug=args.debug)
 
     if args.loss:
@@ -72,3 +76,4 @@ if __name__ == '__main__':
     print('rtt_estimate=%f' % bs.rtt_estimate)
     print("efficiency %.1f  bandwidth used %.1f bytes/s" % (bs.get_efficiency(),
                                 bs.get_bandwidth_used()))
+    print("fec group size %u" % bs.fec_group_size())
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+'''
+benchmark the camera transmit loop over loopback
+
+An echo thread stands in for camera_air's transmit thread, passing
+each received block through a queue before sending it back. This
+compares the fixed 50ms polling loop with the event driven loop in
+cuav_event, for round trip latency and idle CPU usage.
+'''
+
+import os, time, struct, threading
+from argparse import ArgumentParser
+from cuav.lib import block_xmit, cuav_event
+
+
+def loop_wait(mode, bsend, queue=None):
+    '''wait for the next loop iteration'''
+    if mode == 'poll':
+        time.sleep(0.05)
+    elif queue is not None:
+        cuav_event.wait([bsend], 1.0, [queue])
+    else:
+        cuav_event.wait([bsend], 1.0)
+
+def cpu_time():
+    '''return the user+system CPU time of this process'''
+    t = os.times()
+    return t[0] + t[1]
+
+def run(mode, count=20, idle_time=2.0, bandwidth=1000000):
+    '''run the benchmark. mode is 'poll' or 'event'. Returns the
+    mean and maximum round trip latency and the CPU fraction used
+    while idle'''
+    air = block_xmit.BlockSender(dest_ip='127.0.0.1', bandwidth=bandwidth)
+    gnd = block_xmit.BlockSender(dest_ip='127.0.0.1', bandwidth=bandwidth)
+    air.set_dest_port(gnd.get_port())
+    gnd.set_dest_port(air.get_port())
+    queue = cuav_event.EventQueue()
+    stop = threading.Event()
+
+    def echo_threadfunc():
+        while not stop.is_set():
+            loop_wait(mode, air, queue)
+            air.tick()
+            buf = air.recv(0)
+            if buf is not None:
+                queue.put(buf)
+            while not queue.empty():
+                buf = queue.get()
+                if buf is not None:
+                    air.send(buf)
+
+    t = threading.Thread(target=echo_threadfunc)
+    t.daemon = True
+    t.start()
+
+    latencies = []
+    for i in range(count):
+        t0 = time.time()
+        gnd.send(struct.pack('<d', t0))
+        while time.time() - t0 < 5:
+            loop_wait(mode, gnd)
+            gnd.tick()
+            if gnd.recv(0) is not None:
+                latencies.append(time.time() - t0)
+                break
+    # let the acks settle, then measure the CPU used by the idle loops
+    tend = time.time() + 0.5
+    while time.time() < tend:
+        loop_wait(mode, gnd)
+        gnd.tick()
+    c0 = cpu_time()
+    t0 = time.time()
+    while time.time() - t0 < idle_time:
+        loop_wait(mode, gnd)
+        gnd.tick()
+    idle_cpu = (cpu_time() - c0) / (time.time() - t0)
+
+    stop.set()
+    queue.put(None)
+    t.join(2.0)
+    queue.close()
+    if len(latencies) == 0:
+        return (None, None, idle_cpu)
+    return (sum(latencies) / len(latencies), max(latencies), idle_cpu)
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=50, help="number of round trips")
+    parser.add_argument("--idle-time", type=float, default=5.0, help="seconds to measure idle CPU over")
+    parser.add_argument("--bandwidth", type=int, default=1000000, help="bandwidth to use in bytes/sec")
+    args = parser.parse_args()
+
+    for mode in ['poll', 'event']:
+        (mean, maxlat, idle_cpu) = run(mode, args.count, args.idle_time, args.bandwidth)
+        if mean is None:
+            print('%-6s no round trips completed' % mode)
+            continue
+        print('%-6s latency mean %.1fms max %.1fms  idle CPU %.2f%%' % (
+            mode, mean*1000, maxlat*1000, idle_cpu*100))
@@ -76,3 +76,441 @@ def test_block_xmit():
     #print("%u blocks received OK %.1f bytes/second" % (num_blocks, total_size/(t1-t0)))
     #print("efficiency %.1f  bandwidth used %.1f bytes/s" % (b1.get_efficiency(),
     #                          b1.get_bandwidth_used()))
+
+def test_BlockSenderSet():
+    s = block_xmit.BlockSenderSet(1, 300, 0)
+    assert not s.started()
+    assert s.pack()[s.header_size:] == b''
+    for c in [0, 1, 2, 5, 6, 64, 299]:
+        s.add(c, 0)
+    s.add(5, 0)
+    assert s.count == 7
+    assert s.started()
+    assert s.present(64) and not s.present(63)
+    assert s.extents() == [(0, 3), (5, 2), (64, 1), (299, 1)]
+    assert s.extents(1) == [(1, 2), (5, 2), (64, 1), (299, 1)]
+    s.update_first_missing()
+    assert s.first_missing == 3
+
+    # round trip through an ack packet
+    r = block_xmit.BlockSenderSet(0, 0, 0)
+    r.unpack(s.pack())
+    assert (r.id, r.num_chunks) == (1, 300)
+    assert r.extents() == [(5, 2), (64, 1), (299, 1)]
+
+    # merging acks
+    t = block_xmit.BlockSenderSet(1, 300, 0)
+    t.update(r)
+    assert t.count == 4
+    assert t.first_missing == 0
+    r.bits |= (1 << 300) - 1
+    t.update(r)
+    assert t.complete()
+    assert t.count == 300
+    assert t.first_missing == 300
+
+def test_BlockSenderSet_random():
+    '''compare with a set of chunk ids'''
+    random.seed(1)
+    for num_chunks in [1, 7, 64, 500]:
+        s = block_xmit.BlockSenderSet(1, num_chunks, 0)
+        chunks = set()
+        while len(chunks) < num_chunks:
+            c = random.randint(0, num_chunks-1)
+            chunks.add(c)
+            s.add(c, 0)
+            assert s.count == len(chunks)
+            r = block_xmit.BlockSenderSet(0, 0, 0)
+            r.unpack(s.pack())
+            assert set([i for i in range(num_chunks) if r.present(i)]) == chunks
+            assert r.complete() == (len(chunks) == num_chunks)
+
+def test_send_queue():
+    '''priority ordering, cancel and is_queued'''
+    b = block_xmit.BlockSender(dest_ip='127.0.0.1')
+    ids = {}
+    for (name, priority) in [('a', 0), ('b', 50), ('c', 0), ('d', 70), ('e', 50), ('f', -5)]:
+        ids[name] = b.send(bytes(os.urandom(10)), priority=priority)
+    order = [blk.blockid for blk in b.outgoing]
+    assert order == [ids[n] for n in ['d', 'b', 'e', 'a', 'c', 'f']]
+    assert b.is_queued(ids['e'])
+    b.cancel(ids['e'])
+    b.cancel(ids['e'])
+    assert not b.is_queued(ids['e'])
+    assert b.sendq_size() == 5
+    assert [blk.blockid for blk in b.outgoing] == [ids[n] for n in ['d', 'b', 'a', 'c', 'f']]
+    assert b.outgoing.get(ids['b']).priority == 50
+
+def test_completed_len():
+    '''only the most recent completed blocks are remembered'''
+    b1 = block_xmit.BlockSender(dest_ip='127.0.0.1', bandwidth=1000000)
+    b2 = block_xmit.BlockSender(dest_ip='127.0.0.1', bandwidth=1000000, completed_len=3)
+    b1.set_dest_port(b2.get_port())
+    b2.set_dest_port(b1.get_port())
+    ids = [b1.send(bytes(os.urandom(3000))) for i in range(5)]
+    received = []
+    t0 = time.time()
+    while (len(received) < 5 or b1.sendq_size() > 0) and time.time() - t0 < 5:
+        b1.tick()
+        b2.tick()
+        blk = b2.recv(0.01)
+        if blk is not None:
+            received.append(blk)
+    assert len(received) == 5
+    assert b1.sendq_size() == 0
+    assert len(b2.incoming) == 0
+    assert len(b2.completed) == 3
+
+class LoopbackSock:
+    '''a socket with just sendto() and recvfrom(), delivering to itself'''
+    def __init__(self):
+        self.packets = []
+
+    def sendto(self, buf, dest):
+        assert isinstance(buf, bytes)
+        self.packets.append((buf, dest))
+
+    def recvfrom(self, size):
+        if len(self.packets) == 0:
+            raise block_xmit.socket.error('no packet')
+        return self.packets.pop(0)
+
+def test_chunk_views():
+    '''chunks are sent from views of the block data, and arrive intact'''
+    data = bytes(os.urandom(2500))
+    blk = block_xmit.BlockSenderBlock(1, len(data), 1000, None, 0, data=data)
+    chunk = blk.chunk(2)
+    assert isinstance(chunk, memoryview)
+    assert chunk.tobytes() == data[2000:]
+
+    sock = LoopbackSock()
+    b = block_xmit.BlockSender(sock=sock, dest_ip='127.0.0.1', dest_port=1, bandwidth=1000000)
+    b.send(data)
+    b.last_send_time -= 1
+    b.tick(send_acks=False)
+    assert len(sock.packets) == 3
+    for (buf, dest) in sock.packets:
+        assert b._crc(buf[block_xmit.PACKET_HEADER_SIZE:]) == block_xmit.struct.unpack_from('<L', buf, 1)[0]
+    assert b.recv() is None
+    b.tick(send_acks=False, send_outgoing=False)
+    assert bytes(b.recv()) == data
+
+@pytest.mark.parametrize("batch", [0, 32])
+def test_batch(batch):
+    '''blocks arrive with and without sendmmsg/recvmmsg batching'''
+    b1 = block_xmit.BlockSender(dest_ip='127.0.0.1', bandwidth=10000000, batch=batch)
+    b2 = block_xmit.BlockSender(dest_ip='127.0.0.1', bandwidth=10000000, batch=batch)
+    if batch and block_xmit.cuav_mmsg.available():
+        assert b1.mmsg is not None
+    else:
+        assert b1.mmsg is None
+    b1.set_dest_port(b2.get_port())
+    b2.set_dest_port(b1.get_port())
+    blocks = [bytes(os.urandom(random.randint(1, 50000))) for i in range(10)]
+    for blk in blocks:
+        b1.send(blk)
+    received = []
+    t0 = time.time()
+    while (len(received) < len(blocks) or b1.sendq_size() > 0) and time.time() - t0 < 5:
+        b1.tick(packet_count=1000)
+        b2.tick(packet_count=10)
+        blk = b2.recv(0.01)
+        if blk is not None:
+            received.append(bytes(blk))
+    assert sorted(received) == sorted(blocks)
+    assert b1.sendq_size() == 0
+
+def test_bad_chunks():
+    '''chunks that don't fit their block are dropped, not added'''
+    sock = LoopbackSock()
+    b = block_xmit.BlockSender(sock=sock, dest_ip='127.0.0.1', dest_port=1, bandwidth=1000000)
+    dest = ('127.0.0.1', 1)
+    data = bytes(os.urandom(100))
+    bad = [block_xmit.BlockSenderChunk(7, 100, 5, data[:50], 50, 0, 0),
+           block_xmit.BlockSenderChunk(7, 100, 1, data, 50, 0, 0),
+           block_xmit.BlockSenderChunk(7, 100, 0, data[:10], 0, 0, 0)]
+    for chunk in bad:
+        b._send_object(chunk, block_xmit.PKT_CHUNK, dest)
+        b.tick(send_acks=False, send_outgoing=False)
+    assert 7 not in b.incoming
+
+    # a chunk with a different chunk_size from its block is dropped too
+    b._send_object(block_xmit.BlockSenderChunk(7, 100, 0, data[:50], 50, 0, 0), block_xmit.PKT_CHUNK, dest)
+    b._send_object(block_xmit.BlockSenderChunk(7, 100, 1, data[40:], 60, 0, 0), block_xmit.PKT_CHUNK, dest)
+    b._send_object(block_xmit.BlockSenderChunk(7, 100, 1, data[50:], 50, 0, 0), block_xmit.PKT_CHUNK, dest)
+    for i in range(3):
+        b.tick(send_acks=False, send_outgoing=False)
+    assert bytes(b.recv()) == data
+
+def test_bad_parity():
+    '''parity packets that don't fit their block are dropped'''
+    sock = LoopbackSock()
+    b = block_xmit.BlockSender(sock=sock, dest_ip='127.0.0.1', dest_port=1, bandwidth=1000000)
+    dest = ('127.0.0.1', 1)
+    data = bytes(os.urandom(100))
+    parity = block_xmit.xor_chunks([data[:50], data[50:]], 50)
+    b._send_object(block_xmit.BlockSenderChunk(7, 100, 0, data[:50], 50, 0, 0), block_xmit.PKT_CHUNK, dest)
+    bad = [block_xmit.BlockSenderParity(7, 100, 0, 4, parity, 50, 0, 0),
+           block_xmit.BlockSenderParity(7, 100, 1, 2, parity, 50, 0, 0),
+           block_xmit.BlockSenderParity(7, 200, 0, 2, parity, 50, 0, 0),
+           block_xmit.BlockSenderParity(7, 100, 0, 2, parity[:40], 40, 0, 0)]
+    for p in bad:
+        b._send_object(p, block_xmit.PKT_PARITY, dest)
+    for i in range(5):
+        b.tick(send_acks=False, send_outgoing=False)
+    assert b.get_fec_recovered() == 0
+    assert b.recv() is None
+
+    # a good one still recovers the missing chunk
+    b._send_object(block_xmit.BlockSenderParity(7, 100, 0, 2, parity, 50, 0, 0), block_xmit.PKT_PARITY, dest)
+    b.tick(send_acks=False, send_outgoing=False)
+    assert b.get_fec_recovered() == 1
+    assert bytes(b.recv()) == data
+
+class PartialMmsg:
+    '''a sendmmsg() with room for a few packets per call'''
+    def __init__(self, room):
+        self.room = room
+        self.sent = []
+
+    def sendmmsg(self, packets):
+        if self.room is None:
+            raise block_xmit.socket.error('send failed')
+        n = min(self.room, len(packets))
+        self.sent.extend(packets[:n])
+        return n
+
+    def recvmmsg(self):
+        return []
+
+def test_batch_unsent():
+    '''packets the socket buffer has no room for are sent next tick'''
+    b = block_xmit.BlockSender(sock=LoopbackSock(), dest_ip='127.0.0.1', dest_port=1, bandwidth=1000000)
+    b.mmsg = PartialMmsg(None)
+    b.send(bytes(os.urandom(5000)))
+    b.last_send_time -= 1
+    b.tick(send_acks=False)
+    assert b.send_count == 0
+    assert len(b.send_unsent) == 5
+    b.mmsg.room = 2
+    for i in range(3):
+        b.tick(send_acks=False, send_outgoing=False)
+    assert b.send_count == 5
+    assert len(b.send_unsent) == 0
+    chunk_ids = [block_xmit.struct.unpack_from('<H', parts[1], 12)[0] for (parts, dest) in b.mmsg.sent]
+    assert chunk_ids == [0, 1, 2, 3, 4]
+
+def test_xor_chunks():
+    a = bytes(os.urandom(100))
+    b = bytes(os.urandom(60))
+    p = block_xmit.xor_chunks([a, b, b''], 100)
+    assert len(p) == 100
+    assert block_xmit.xor_chunks([p, a], 100) == b + b'\0' * 40
+    assert block_xmit.xor_chunks([], 10) == b'\0' * 10
+
+def test_fec_recover():
+    '''a lost chunk is rebuilt from its parity packet without a retransmit'''
+    data = bytes(os.urandom(5500))
+    sock = LoopbackSock()
+    b = block_xmit.BlockSender(sock=sock, dest_ip='127.0.0.1', dest_port=1, bandwidth=1000000)
+    b.send(data, fec=4)
+    b.last_send_time -= 1
+    b.tick(send_acks=False)
+    # 6 chunks in groups of 4 and 2, each followed by its parity
+    types = [ord(buf[0]) for (buf, dest) in sock.packets]
+    assert types == [2, 2, 2, 2, 3, 2, 2, 3]
+    # lose a chunk from each group
+    del sock.packets[6]
+    del sock.packets[1]
+    for i in range(6):
+        b.tick(send_acks=False, send_outgoing=False)
+    assert b.get_fec_recovered() == 2
+    assert bytes(b.recv()) == data
+
+def test_compress():
+    '''blocks are only compressed once the receiver says it can decompress them'''
+    data = 'hello world ' * 1000
+    sock = LoopbackSock()
+    b = block_xmit.BlockSender(sock=sock, dest_ip='127.0.0.1', dest_port=1, bandwidth=1000000)
+    b.send(data, compress=True)
+    b.last_send_time -= 1
+    b.tick(send_acks=False)
+    types = [ord(buf[0]) for (buf, dest) in sock.packets]
+    assert types == [block_xmit.PKT_CHUNK] * 12
+    while b.sendq_size() > 0:
+        b.tick()
+    assert bytes(b.recv()) == data
+    assert b.peer_flags[('127.0.0.1', 1)] == block_xmit.FEATURES
+
+    # now the receiver has sent its features the block is compressed
+    del sock.packets[:]
+    b.send(data, compress=True, fec=2)
+    b.last_send_time -= 1
+    b.tick(send_acks=False)
+    types = [ord(buf[0]) for (buf, dest) in sock.packets]
+    assert types == [block_xmit.PKT_FLAGGED_CHUNK, block_xmit.PKT_FLAGGED_PARITY]
+    assert b.get_compression_saved() > 11000
+    while b.sendq_size() > 0:
+        b.tick()
+    assert bytes(b.recv()) == data
+
+    # incompressible data is sent as it is
+    data = bytes(os.urandom(3000))
+    del sock.packets[:]
+    b.send(data, compress=True)
+    b.last_send_time -= 1
+    b.tick(send_acks=False)
+    assert ord(sock.packets[0][0][0]) == block_xmit.PKT_CHUNK
+    while b.sendq_size() > 0:
+        b.tick()
+    assert bytes(b.recv()) == data
+
+def test_coalesced_acks():
+    '''acks for several blocks go in one packet, and are delayed until due'''
+    sock = LoopbackSock()
+    b = block_xmit.BlockSender(sock=sock, dest_ip='127.0.0.1', dest_port=1, bandwidth=1000000)
+    for i in range(10):
+        b.send(bytes(os.urandom(500)))
+    b.last_send_time -= 1
+    b.tick(send_acks=False)
+    assert len(sock.packets) == 10
+    # the chunks bring a features packet, so acks can be coalesced
+    b.tick(send_acks=False, send_outgoing=False)
+    assert len(sock.packets) == 0
+    b.tick(send_outgoing=False)
+    types = [ord(buf[0]) for (buf, dest) in sock.packets]
+    assert types == [block_xmit.PKT_ACKS]
+    (acks, packets, nbytes, saved) = b.get_ack_stats()
+    assert (acks, packets) == (10, 1)
+    assert saved > 9 * block_xmit.UDP_OVERHEAD
+    b.tick(send_outgoing=False)
+    assert b.sendq_size() == 0
+
+    # an incomplete block is acked after ack_delay
+    b.ack_delay = 10
+    b.send(bytes(os.urandom(3000)))
+    b.last_send_time -= 1
+    b.tick(send_acks=False)
+    del sock.packets[1]
+    b.tick(send_outgoing=False)
+    assert len(sock.packets) == 0
+    assert b.tick_deadline() > time.time() + 5
+    b.ack_due_time -= 10
+    b.tick(send_outgoing=False)
+    types = [ord(buf[0]) for (buf, dest) in sock.packets]
+    assert types == [block_xmit.PKT_ACK]
+
+    # with no ack due, the deadline is the retry time alone
+    b.acks_needed.add(None)
+    b.ack_due_time = None
+    b.ack_retry_time = time.time() + 3
+    assert b.tick_deadline() == b.ack_retry_time
+
+def test_fec_group_size():
+    b = block_xmit.BlockSender(dest_ip='127.0.0.1', fec=block_xmit.FEC_AUTO)
+    assert b.fec_group_size() == 0
+    b.efficiency = 0.7
+    assert b.fec_group_size() == 2
+    b.efficiency = 0.9
+    assert b.fec_group_size() == 9
+    b.efficiency = 0.0
+    assert b.fec_group_size() == 2
+
+@pytest.mark.parametrize("fec", [0, 4, block_xmit.FEC_AUTO])
+def test_fec_lossy(fec):
+    '''blocks arrive over a lossy link with and without FEC'''
+    b1 = block_xmit.BlockSender(dest_ip='127.0.0.1', bandwidth=1000000, fec=fec)
+    b2 = block_xmit.BlockSender(dest_ip='127.0.0.1', bandwidth=1000000)
+    b1.set_packet_loss(20)
+    b2.set_packet_loss(20)
+    b1.set_dest_port(b2.get_port())
+    b2.set_dest_port(b1.get_port())
+    blocks = [bytes(os.urandom(random.randint(1, 20000))) for i in range(20)]
+    for blk in blocks:
+        b1.send(blk)
+    received = []
+    t0 = time.time()
+    while (len(received) < len(blocks) or b1.sendq_size() > 0) and time.time() - t0 < 10:
+        b1.tick()
+        b2.tick()
+        blk = b2.recv(0.01)
+        if blk is not None:
+            received.append(bytes(blk))
+    assert sorted(received) == sorted(blocks)
+    if fec == 4:
+        assert b2.get_fec_recovered() > 0
+
+def test_pacing():
+    '''the pacing estimate follows a steady delivery rate'''
+    p = block_xmit.BlockSenderPacing(1000000)
+    assert p.rate(0) == 100000
+    t = 0
+    while t < 5:
+        t += 0.01
+        p.on_rtt(0.05, t)
+        p.on_ack(500, t)
+        p.rate(t)
+    assert abs(p.btl_bw - 50000) < 1000
+    assert p.state == 'probe'
+    assert 0.75*50000 - 1 <= p.rate(t) <= 1.25*50000 + 1
+    # the bandwidth is an upper bound
+    p.max_bandwidth = 20000
+    assert p.rate(t) == 20000
+
+class SimLink:
+    '''a one way link of limited capacity in bytes/second, with a queue
+    that drops packets once it holds more than queue_time seconds of data'''
+    def __init__(self, capacity, delay=0.02, queue_time=0.1):
+        self.capacity = capacity
+        self.delay = delay
+        self.queue_time = queue_time
+        self.free_time = 0
+        self.packets = []
+
+    def put(self, buf, src):
+        tnow = time.time()
+        start = max(tnow, self.free_time)
+        if start - tnow > self.queue_time:
+            return
+        self.free_time = start + len(buf) / float(self.capacity)
+        self.packets.append((self.free_time + self.delay, buf, src))
+
+    def get(self):
+        if len(self.packets) == 0 or self.packets[0][0] > time.time():
+            raise block_xmit.socket.error('no packet')
+        (t, buf, src) = self.packets.pop(0)
+        return (buf, src)
+
+class SimSock:
+    '''a socket sending over one SimLink and receiving from another'''
+    def __init__(self, addr, out_link, in_link):
+        self.addr = addr
+        self.out_link = out_link
+        self.in_link = in_link
+
+    def sendto(self, buf, dest):
+        self.out_link.put(buf, self.addr)
+
+    def recvfrom(self, size):
+        return self.in_link.get()
+
+def test_adaptive():
+    '''adaptive pacing finds the capacity of a link slower than the bandwidth'''
+    up = SimLink(100000)
+    down = SimLink(100000)
+    b1 = block_xmit.BlockSender(sock=SimSock(('a', 1), up, down), dest_ip='b', dest_port=2,
+                                bandwidth=1000000, adaptive=True)
+    b2 = block_xmit.BlockSender(sock=SimSock(('b', 2), down, up), dest_ip='a', dest_port=1,
+                                bandwidth=1000000)
+    for i in range(50):
+        b1.send(bytes(os.urandom(20000)))
+    t0 = time.time()
+    while time.time() - t0 < 3:
+        b1.tick()
+        b2.tick()
+        while b2.recv(0) is not None:
+            pass
+        time.sleep(0.002)
+    assert 50000 < b1.pacing.btl_bw < 200000
+    assert b1.get_send_rate() < 200000
+    assert b1.get_efficiency() > 0.8
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+'''
+test program for cuav_event
+'''
+
+import sys, os, select
+import pytest
+from cuav.lib import cuav_event
+
+
+class FakeClock:
+    '''a clock that only moves when sleep() is called'''
+    def __init__(self, t):
+        self.t = t
+
+    def time(self):
+        return self.t
+
+    def sleep(self, dt):
+        self.t += dt
+
+
+class FakeSender:
+    '''the parts of a BlockSender used by cuav_event.wait'''
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.sock = cuav_event.socket.socket(cuav_event.socket.AF_INET, cuav_event.socket.SOCK_DGRAM)
+
+    def tick_deadline(self):
+        return self.deadline
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+@pytest.fixture
+def selects(monkeypatch):
+    '''run wait() on a fake clock, recording the timeout and readable
+    files of each select() call. Functions in hooks are called at the
+    start of select(), to post events from'''
+    calls = []
+    hooks = []
+    real_select = select.select
+    def fake_select(rin, win, xin, timeout):
+        for func in hooks:
+            func()
+        ret = real_select(rin, win, xin, timeout)
+        calls.append((timeout, ret[0]))
+        return ret
+    monkeypatch.setattr(cuav_event, 'time', FakeClock(1000.0))
+    monkeypatch.setattr(cuav_event.select, 'select', fake_select)
+    return (calls, hooks)
+
+def test_wait_deadline(selects):
+    '''the wait ends at the sender's deadline, or the timeout'''
+    (calls, hooks) = selects
+    cuav_event.wait([FakeSender(1000.3)], 0.5)
+    assert calls[-1][0] == pytest.approx(0.3)
+    cuav_event.wait([FakeSender(None)], 0.5)
+    assert calls[-1][0] == pytest.approx(0.5)
+    # nothing is waited for if a sender has work due
+    cuav_event.wait([FakeSender(999.0)], 0.5)
+    assert len(calls) == 2
+
+def test_wait_queue(selects):
+    '''an event posted to a queue wakes a wait without waiting out the timeout'''
+    (calls, hooks) = selects
+    q = cuav_event.EventQueue()
+    q.put(1)
+    cuav_event.wait([FakeSender(None)], 10, [q])
+    assert len(calls) == 0
+    q.get()
+
+    # post while the wait is in select(). The wakeup makes the queue
+    # readable at once, so the 10 second timeout is never reached
+    hooks.append(lambda: q.put(2))
+    cuav_event.wait([FakeSender(None)], 10, [q])
+    assert calls == [(10, [q.fileno()])]
+    # and the wakeup is cleared for the next wait
+    del hooks[:]
+    assert select.select([q], [], [], 0)[0] == []
+    q.close()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+'''
+test program for cuav_framestore
+'''
+
+import sys, os, time, random, functools
+import pytest
+from cuav.lib import cuav_framestore, mav_position
+
+
+def test_FrameStore_lookup():
+    store = cuav_framestore.FrameStore()
+    frame_time = 1478954763.12
+    store.update(frame_time, filename='img2016111212460312Z.png')
+    store.update(frame_time + 0.001, pos='pos')
+
+    assert len(store) == 1
+    assert frame_time in store
+    assert frame_time + 0.5 not in store
+    assert store.get(frame_time, 'filename') == 'img2016111212460312Z.png'
+    assert store.get(frame_time, 'pos') == 'pos'
+    assert store.get(frame_time, 'missing', 3) == 3
+    assert store.get(frame_time + 0.5, 'filename') is None
+
+def test_FrameStore_eviction():
+    store = cuav_framestore.FrameStore(max_age=10, max_entries=5)
+    for i in range(20):
+        store.update(1000.0 + i, filename=str(i))
+    assert len(store) == 5
+    assert 1019.0 in store
+    assert 1014.0 not in store
+
+    store = cuav_framestore.FrameStore(max_age=10, max_entries=100)
+    for i in range(20):
+        store.update(1000.0 + i*2, filename=str(i))
+    assert len(store) == 6
+    assert 1026.0 not in store
+    assert 1028.0 in store
+
+def test_FrameStore_spill():
+    spillfile = os.path.join('.', 'frames.log')
+    store = cuav_framestore.FrameStore(max_age=10, max_entries=5, spill_filename=spillfile)
+    for i in range(200):
+        store.update(1000.0 + i*0.2, filename=str(i))
+    pos = mav_position.MavPosition(-30, 145, 34.56, 20, -56.67, 345, 1000.0)
+    store.update(1000.0, pos=pos)
+
+    assert len(store) == 5
+    assert store.get(1000.0, 'filename') == '0'
+    assert store.get(1000.0, 'pos').lat == -30
+    assert store.get(1000.0 + 50*0.2, 'filename') == '50'
+    assert store.get(1000.0 + 199*0.2, 'filename') == '199'
+    assert store.get(1000.1, 'filename') is None
+
+    # the index is rebuilt when appending to an existing spill file
+    store = cuav_framestore.FrameStore(spill_filename=spillfile, append=True)
+    assert store.get(1000.0 + 120*0.2, 'filename') == '120'
+
+    # a frame updated in memory after it was spilled has both sets of fields
+    store.update(1000.0 + 120*0.2, score=5)
+    assert store.lookup(1000.0 + 120*0.2) == {'filename': '120', 'score': 5}
+    store.update(1000.0 + 120*0.2, filename='new')
+    assert store.get(1000.0 + 120*0.2, 'filename') == 'new'
+
+    os.remove(spillfile)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+'''
+test program for cuav_imagestore
+'''
+
+import sys, os, time
+import pytest
+from cuav.lib import cuav_imagestore
+
+
+def make_images(tmpdir, count, size=1000):
+    '''create some image files, returning (frame_time, filename) tuples'''
+    ret = []
+    for i in range(count):
+        filename = os.path.join(str(tmpdir), 'img%u.jpg' % i)
+        with open(filename, 'wb') as f:
+            f.write('x' * size)
+        ret.append((1000.0 + i, filename))
+    return ret
+
+def test_ImageStore_budget(tmpdir):
+    images = make_images(tmpdir, 10)
+    store = cuav_imagestore.ImageStore(max_bytes=5000)
+    for (t, filename) in images:
+        store.add(t, filename)
+    # nothing is deleted until it has been scanned
+    assert len(store) == 10
+    assert store.total_bytes == 10000
+    assert store.lookup(1003.001) == images[3][1]
+
+    store.scanned(1000.0, keep=True)
+    store.scanned(1001.0)
+    store.scanned(1002.0)
+    assert len(store) == 8
+    assert not os.path.exists(images[1][1])
+    assert store.lookup(1001.0) is None
+    store.keep(1003.0)
+    for (t, filename) in images[3:]:
+        store.scanned(t)
+    # the frame with regions and the requested frame survive
+    assert store.total_bytes == 5000
+    assert store.evicted == 5
+    assert os.path.exists(images[0][1])
+    assert os.path.exists(images[3][1])
+    assert not os.path.exists(images[4][1])
+    assert os.path.exists(images[9][1])
+    assert store.lookup(1000.0) == images[0][1]
+    assert str(store) == '5/0.0MB/5'
+
+def test_ImageStore_unlimited(tmpdir):
+    images = make_images(tmpdir, 5)
+    store = cuav_imagestore.ImageStore()
+    for (t, filename) in images:
+        store.add(t, filename)
+    assert len(store) == 5
+    for (t, filename) in images:
+        store.scanned(t, keep=(t == 1001.0))
+    # nothing is deleted, and scanned images are no longer tracked
+    assert len(store) == 0
+    assert store.total_bytes == 0
+    assert store.evicted == 0
+    assert all(os.path.exists(filename) for (t, filename) in images)
+    # missing files are ignored
+    store.add(2000.0, os.path.join(str(tmpdir), 'missing.jpg'))
+    assert len(store) == 0
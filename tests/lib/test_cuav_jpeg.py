@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+'''
+test program for cuav_jpeg
+'''
+
+import sys, os
+import pytest
+import numpy as np
+import cv2
+from cuav.lib import cuav_jpeg
+
+
+def jpeg_file(tmpdir, rst_interval=None):
+    img = cv2.imread(os.path.join(os.getcwd(), 'tests', 'testdata', 'raw2016111223465120Z.png'))
+    filename = str(tmpdir.join('image.jpg'))
+    params = []
+    if rst_interval is not None:
+        params = [cv2.IMWRITE_JPEG_RST_INTERVAL, rst_interval]
+    cv2.imwrite(filename, img, params)
+    return filename
+
+def test_restart_interval():
+    assert cuav_jpeg.restart_interval(1280) == 8
+    assert cuav_jpeg.restart_interval(1296) == 3
+    assert cuav_jpeg.restart_interval(100) == 7
+
+@pytest.mark.parametrize("rotate180", [False, True])
+@pytest.mark.parametrize("rst_interval", [8, 80, 160])
+def test_window(tmpdir, rotate180, rst_interval):
+    filename = jpeg_file(tmpdir, rst_interval)
+    full = cv2.imread(filename)
+    if rotate180:
+        full = cv2.flip(full, -1)
+    jpeg = cuav_jpeg.JpegImage(filename, rotate180=rotate180)
+    assert jpeg.can_crop()
+    assert jpeg.shape() == (1280, 960)
+    for (x1, y1, x2, y2) in [(100, 100, 160, 160), (-20, -20, 10, 10), (1250, 930, 1300, 1000), (500, 300, 700, 700)]:
+        (img, x, y) = jpeg.window(x1, y1, x2, y2)
+        (h, w) = img.shape[:2]
+        assert x <= max(x1, 0) and y <= max(y1, 0)
+        assert x + w >= min(x2, 1280) and y + h >= min(y2, 960)
+        assert h < 960
+        diff = np.abs(img.astype(int) - full[y:y+h, x:x+w].astype(int))
+        assert diff.max() <= 4
+    assert jpeg.full_decodes == 0
+    assert jpeg.window_decodes == 4
+
+def test_no_restart_markers(tmpdir):
+    filename = jpeg_file(tmpdir)
+    jpeg = cuav_jpeg.JpegImage(filename)
+    assert not jpeg.can_crop()
+    assert jpeg.shape() == (1280, 960)
+    (img, x, y) = jpeg.window(100, 100, 160, 160)
+    assert (x, y) == (0, 0)
+    assert img.shape == (960, 1280, 3)
+    assert jpeg.full_decodes == 1
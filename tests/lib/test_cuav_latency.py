@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+'''
+test program for cuav_latency
+'''
+
+import sys, os, time, threading
+import pytest
+from cuav.lib import cuav_latency, cuav_command, block_xmit
+
+
+def test_LatencyHistogram():
+    hist = cuav_latency.LatencyHistogram()
+    assert hist.mean() == 0
+    assert hist.percentile(50) == 0
+    for latency in [0.005, 0.015, 0.015, 0.3, 100]:
+        hist.add(latency)
+    hist.add(-0.1)
+    assert hist.count == 6
+    assert hist.counts[0] == 2
+    assert hist.percentile(50) == 0.02
+    assert hist.percentile(90) == 100
+    assert hist.max == 100
+    assert str(hist).startswith('n=6 ')
+
+def test_LatencyTracker(tmpdir):
+    logfile = os.path.join(str(tmpdir), 'latency.log')
+    tracker = cuav_latency.LatencyTracker(logfile)
+    pkt = cuav_command.ThumbPacket(1000.0, [], None, None)
+    for (stage, t) in [('capture', 1000.0), ('decode', 1000.2), ('score', 1000.5), ('handoff', 1001.0)]:
+        pkt.stamp(stage, t)
+    # ground clock is 10 seconds behind the aircraft
+    pkt.stamp('received', 991.5)
+    pkt.stamp('displayed', 991.6)
+    tracker.add('thumb', pkt.stamps, clock_offset=10.0)
+    assert tracker.histogram('thumb', 'decode').mean() == pytest.approx(0.2)
+    assert tracker.histogram('thumb', 'received').mean() == pytest.approx(0.5)
+    assert tracker.histogram('thumb', 'total').mean() == pytest.approx(1.6)
+    assert ('thumb', 'enqueue') not in tracker.histograms
+    assert 'thumb total: n=1' in tracker.report()
+    assert len(open(logfile).readlines()) == 1
+
+def test_LatencyTracker_snapshot():
+    '''snapshots taken while other threads add packets lose none of them'''
+    tracker = cuav_latency.LatencyTracker()
+    stamps = {'capture': 1000.0, 'decode': 1000.1, 'scan': 1000.3}
+    def add_threadfunc():
+        for i in range(2000):
+            tracker.add('frame', stamps)
+    threads = [threading.Thread(target=add_threadfunc) for i in range(4)]
+    for t in threads:
+        t.start()
+    counts = []
+    while any(t.is_alive() for t in threads):
+        counts.append(tracker.snapshot().histogram('frame', 'scan').count)
+    for t in threads:
+        t.join()
+    counts.append(tracker.snapshot().histogram('frame', 'scan').count)
+    assert sum(counts) == 8000
+    assert tracker.histograms == {}
+
+def test_clock_offset():
+    bsend = block_xmit.BlockSender(dest_ip='127.0.0.1')
+    assert bsend.get_clock_offset() is None
+    chunk = block_xmit.BlockSenderChunk(0, 0, 0, '', 0, 0, 1005.0)
+    bsend._update_clock_offset(chunk, 1000.0)
+    assert bsend.get_clock_offset() == 5.0
+    # a slower chunk doesn't change the estimate
+    chunk.timestamp = 1004.0
+    bsend._update_clock_offset(chunk, 1000.0)
+    assert bsend.get_clock_offset() == 5.0
+    # but the remote clock stepping back does
+    chunk.timestamp = 900.0
+    bsend._update_clock_offset(chunk, 1000.0)
+    assert bsend.get_clock_offset() == -100.0
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+'''
+test program for cuav_mmsg
+'''
+
+import sys, os, time, socket
+import pytest
+from cuav.lib import cuav_mmsg
+
+
+def udp_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.setblocking(False)
+    return sock
+
+@pytest.mark.skipif(not cuav_mmsg.available(), reason="no sendmmsg/recvmmsg")
+def test_MmsgSocket():
+    s1 = udp_socket()
+    s2 = udp_socket()
+    m1 = cuav_mmsg.MmsgSocket(s1, count=4, size=2000)
+    m2 = cuav_mmsg.MmsgSocket(s2, count=4, size=2000)
+    with pytest.raises(socket.error):
+        m2.recvmmsg()
+
+    # more packets than fit in one call, gathered from several buffers
+    data = bytearray(os.urandom(1500))
+    packets = [([b'%u:' % i, memoryview(data)[:100*i]], s2.getsockname()) for i in range(10)]
+    assert m1.sendmmsg(packets) == 10
+    received = []
+    t0 = time.time()
+    while len(received) < 10 and time.time() - t0 < 2:
+        try:
+            received.extend(m2.recvmmsg())
+        except socket.error:
+            time.sleep(0.01)
+    assert len(received) == 10
+    for i in range(10):
+        (buf, addr) = received[i]
+        assert buf == b'%u:' % i + bytes(data[:100*i])
+        assert addr == s1.getsockname()
+
+    # and recvmmsg() can read packets from sendto()
+    s1.sendto(b'hello', ('localhost', s2.getsockname()[1]))
+    time.sleep(0.1)
+    assert m2.recvmmsg() == [(b'hello', s1.getsockname())]
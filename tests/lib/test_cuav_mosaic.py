@@ -151,3 +151,37 @@ def test_Mosaic():
     
     mosaic.image_mosaic.terminate()
     
+
+def test_Mosaic_tracks():
+    '''a better thumbnail of a tracked target replaces the earlier one'''
+    mocked_slipmap = mock.MagicMock(return_value=1)
+    C_params = CameraParams(lens=4.0, sensorwidth=5.0, xresolution=1280, yresolution=960)
+    mosaic = cuav_mosaic.Mosaic(mocked_slipmap, C=C_params)
+
+    f1 = os.path.join(os.getcwd(), 'tests', 'testdata', 'raw2016111223465120Z.png')
+    f2 = os.path.join(os.getcwd(), 'tests', 'testdata', 'raw2016111223465160Z.png')
+    img = cv2.imread(f1)
+    pos = mav_position.MavPosition(-30, 145, 34.56, 20, -56.67, 345, frame_time=1478994408.76)
+    regions = [cuav_region.Region(1020, 658, 1050, 678, (30, 30), scan_score=20),
+               cuav_region.Region(30, 54, 50, 74, (20, 20), scan_score=15)]
+    regions[0].score = 100
+    regions[1].score = 200
+    thumbs = cuav_mosaic.ExtractThumbs(cuav_region.CompositeThumbnail(img, regions), 2)
+    mosaic.add_regions(regions, thumbs, f1, pos, [1, 1], [7, None])
+    assert len(mosaic.regions) == 2
+
+    better = cuav_region.Region(200, 600, 220, 620, (20, 20), scan_score=45)
+    better.score = 300
+    thumbs = cuav_mosaic.ExtractThumbs(cuav_region.CompositeThumbnail(img, [better]), 1)
+    mosaic.add_regions([better], thumbs, f2, pos, [3], [7])
+    assert len(mosaic.regions) == 2
+    assert len(mosaic.regions_sorted) == 2
+    assert mosaic.regions[0].region is better
+    assert mosaic.regions[0].hits == 3
+    assert 'hits=3' in str(mosaic.regions[0])
+    assert mosaic.regions_sorted[0] is mosaic.regions[0]
+    # the region is now tagged by the frame of the better thumbnail
+    assert mosaic.ridx_by_frame_time[cuav_util.parse_frame_time(f1)] == [1]
+    assert mosaic.ridx_by_frame_time[cuav_util.parse_frame_time(f2)] == [0]
+
+    mosaic.image_mosaic.terminate()
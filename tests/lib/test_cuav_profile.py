@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+'''
+test program for cuav_profile
+'''
+
+import sys, os, time, threading
+import pytest
+from cuav.lib import cuav_profile
+
+
+def busy_threadfunc(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+def test_SamplingProfiler(tmpdir):
+    stop = threading.Event()
+    t = threading.Thread(target=busy_threadfunc, args=(stop,))
+    t.name = 'busy'
+    t.start()
+    done = []
+    profiler = cuav_profile.SamplingProfiler(interval=0.005)
+    profiler.start(0.3, done.append)
+    assert profiler.running()
+    profiler.thread.join(2.0)
+    stop.set()
+    t.join()
+    assert done == [profiler]
+    assert not profiler.running()
+    assert profiler.sample_count > 10
+
+    filename = os.path.join(str(tmpdir), 'profile.txt')
+    profiler.write(filename)
+    lines = open(filename).readlines()
+    assert len(lines) == len(profiler.samples)
+    busy = [l for l in lines if l.startswith('busy;')]
+    assert len(busy) > 0
+    assert 'busy_threadfunc (test_cuav_profile.py:' in busy[0]
+    assert int(busy[0].split()[-1]) > 0
+    assert 'busy: ' in profiler.summary(5)
+    assert len(profiler.summary(1).split('\n')) == 1
+
+def test_SamplingProfiler_empty():
+    profiler = cuav_profile.SamplingProfiler()
+    assert profiler.summary() == 'no samples'
+    assert not profiler.running()
@@ -6,7 +6,7 @@ test program for cuav_region
 import sys, os, time, random, functools, cv2
 import pytest
 import numpy as np
-from cuav.lib import cuav_region, cuav_util
+from cuav.lib import cuav_region, cuav_util, cuav_jpeg
 from cuav.lib.cuav_util import SubImage
 from cuav.lib import mav_position
 
@@ -128,3 +128,47 @@ def test_CompositeThumbnail():
     im_orig = cv2.imread(os.path.join(os.getcwd(), 'tests', 'testdata', 'test-8bit.png'))
     composite = cuav_region.CompositeThumbnail(im_orig, regions)
     assert cuav_util.image_shape(composite) == (300, 100)
+
+def test_CompositeThumbnail_edges():
+    im_orig = cv2.imread(os.path.join(os.getcwd(), 'tests', 'testdata', 'test-8bit.png'))
+    (w, h) = cuav_util.image_shape(im_orig)
+    regions = []
+    regions.append(cuav_region.Region(400, 300, 410, 310, (w, h)))
+    regions.append(cuav_region.Region(0, 0, 10, 10, (w, h)))
+    regions.append(cuav_region.Region(w-150, h-150, w-1, h-1, (w, h)))
+    composite = cuav_region.CompositeThumbnail(im_orig, regions, thumb_size=60)
+    assert cuav_util.image_shape(composite) == (180, 60)
+    assert (composite[:, 0:60] == im_orig[275:335, 375:435]).all()
+    assert (composite[:, 60:120] == SubImage(im_orig, (-25, -25, 60, 60))).all()
+    assert (composite[0:25, 60:120] == 0).all()
+
+def test_CompositeThumbnailJpeg(tmpdir):
+    im_orig = cv2.imread(os.path.join(os.getcwd(), 'tests', 'testdata', 'raw2016111223465120Z.png'))
+    (w, h) = cuav_util.image_shape(im_orig)
+    filename = str(tmpdir.join('image.jpg'))
+    cv2.imwrite(filename, im_orig, [cv2.IMWRITE_JPEG_RST_INTERVAL, cuav_jpeg.restart_interval(w)])
+    im_full = cv2.imread(filename)
+    regions = []
+    regions.append(cuav_region.Region(400, 300, 410, 310, (w, h)))
+    regions.append(cuav_region.Region(0, 0, 10, 10, (w, h)))
+    regions.append(cuav_region.Region(w-150, h-150, w-1, h-1, (w, h)))
+    jpeg = cuav_jpeg.JpegImage(filename)
+    composite = cuav_region.CompositeThumbnailJpeg(jpeg, regions, thumb_size=60)
+    assert jpeg.full_decodes == 0
+    assert jpeg.window_decodes == 3
+    expected = cuav_region.CompositeThumbnail(im_full, regions, thumb_size=60)
+    assert composite.shape == expected.shape
+    # only chroma upsampling at tile edges differs from a full decode
+    assert np.abs(composite.astype(int) - expected.astype(int)).max() <= 4
+
+    # many regions decode the whole image
+    jpeg = cuav_jpeg.JpegImage(filename)
+    composite = cuav_region.CompositeThumbnailJpeg(jpeg, regions, thumb_size=60, max_regions=2)
+    assert jpeg.full_decodes == 1
+    assert (composite == expected).all()
+
+def test_ScaleRegions():
+    regions = [cuav_region.Region(10, 20, 30, 40, (320, 240))]
+    regions = cuav_region.ScaleRegions(regions, (320, 240), (1280, 960))
+    assert regions[0].tuple() == (40, 80, 120, 160)
+    assert regions[0].scan_shape == (1280, 960)
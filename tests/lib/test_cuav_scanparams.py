@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+'''
+test program for cuav_scanparams
+'''
+
+import sys, os, time
+import pytest
+from MAVProxy.modules.lib.mp_settings import MPSettings, MPSetting
+from cuav.lib import cuav_scanparams
+from cuav.camera.cam_params import CameraParams
+
+
+def test_ScanParams():
+    image_settings = MPSettings([MPSetting('MinRegionArea', float, 0.15),
+                                 MPSetting('MaxRegionArea', float, 1.0)])
+    camera_settings = MPSettings([MPSetting('minalt', int, 30)])
+    c_params = CameraParams(lens=4.0, sensorwidth=5.0, xresolution=1280, yresolution=960)
+    sp = cuav_scanparams.ScanParams(alt_change=0.05)
+
+    parms = sp.get(image_settings, camera_settings, c_params, None)
+    assert parms == {'MinRegionArea': 0.15, 'MaxRegionArea': 1.0}
+    assert sp.get(image_settings, camera_settings, c_params, None) is parms
+
+    # altitude, with small changes ignored
+    parms = sp.get(image_settings, camera_settings, c_params, 100)
+    mpp = parms['MetersPerPixel']
+    assert sp.get(image_settings, camera_settings, c_params, 104) is parms
+    parms2 = sp.get(image_settings, camera_settings, c_params, 110)
+    assert parms2 is not parms
+    assert parms2['MetersPerPixel'] == pytest.approx(mpp * 1.1)
+    # minalt applies
+    parms = sp.get(image_settings, camera_settings, c_params, 5)
+    assert parms['MetersPerPixel'] == pytest.approx(mpp * 0.3)
+
+    # a setting change gives a new snapshot, leaving the old one alone
+    time.sleep(0.01)
+    image_settings.set('MinRegionArea', 0.5)
+    parms2 = sp.get(image_settings, camera_settings, c_params, 5)
+    assert parms2['MinRegionArea'] == 0.5
+    assert parms['MinRegionArea'] == 0.15
+    assert sp.rebuilds == 5
+
+def test_ScanParams_scale():
+    image_settings = MPSettings([MPSetting('MinRegionArea', float, 0.15)])
+    camera_settings = MPSettings([MPSetting('minalt', int, 30)])
+    c_params = CameraParams(lens=4.0, sensorwidth=5.0, xresolution=1280, yresolution=960)
+    sp = cuav_scanparams.ScanParams()
+    mpp = sp.get(image_settings, camera_settings, c_params, 100)['MetersPerPixel']
+    # a reduced image has larger pixels
+    parms = sp.get(image_settings, camera_settings, c_params, 100, scale=2)
+    assert parms['MetersPerPixel'] == pytest.approx(mpp * 2)
+    assert sp.get(image_settings, camera_settings, c_params, 100, scale=2) is parms
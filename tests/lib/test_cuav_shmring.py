@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+'''
+test program for cuav_shmring
+'''
+
+import sys, os, time
+import pytest
+import numpy
+from cuav.lib import cuav_shmring
+
+
+def test_FrameRing(tmpdir):
+    path = os.path.join(str(tmpdir), 'ring')
+    writer = cuav_shmring.FrameRingWriter(path, num_slots=3, slot_size=100*80*3)
+    reader = cuav_shmring.FrameRingReader(path)
+    assert reader.read_new() == []
+
+    img = (numpy.arange(100*80*3) % 251).astype(numpy.uint8).reshape((80, 100, 3))
+    writer.write(1000.5, img, 'a.jpg')
+    frames = reader.read_new()
+    assert len(frames) == 1
+    (frame_time, img2, filename) = frames[0]
+    assert frame_time == 1000.5
+    assert filename == 'a.jpg'
+    assert (img2 == img).all()
+
+    # mono and 16 bit frames
+    mono = numpy.arange(20*10, dtype=numpy.uint16).reshape((10, 20)) * 300
+    writer.write(1001, mono)
+    (frame_time, img2, filename) = reader.read_new()[0]
+    assert img2.dtype == numpy.uint16
+    assert (img2 == mono).all()
+    assert filename == ''
+
+    # frames overwritten before being read are dropped
+    for i in range(5):
+        writer.write(1002 + i, img)
+    frames = reader.read_new()
+    assert [f[0] for f in frames] == [1004, 1005, 1006]
+    assert reader.dropped == 2
+
+    with pytest.raises(cuav_shmring.FrameRingException):
+        writer.write(1010, numpy.zeros((100, 100, 3), dtype=numpy.uint8))
+
+    # a restarted writer carries on the sequence
+    writer.close()
+    writer = cuav_shmring.FrameRingWriter(path, num_slots=3, slot_size=100*80*3)
+    writer.write(1020, img)
+    assert [f[0] for f in reader.read_new()] == [1020]
+    assert not reader.changed()
+    reader.close()
+    writer.close()
+
+def test_FrameRing_invalid(tmpdir):
+    path = os.path.join(str(tmpdir), 'notring')
+    with open(path, 'wb') as f:
+        f.write(b'x' * 1000)
+    with pytest.raises(cuav_shmring.FrameRingException):
+        cuav_shmring.FrameRingReader(path)
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+'''
+test program for cuav_stripe
+'''
+
+import sys, os, time
+import pytest
+from cuav.lib import cuav_stripe, cuav_command
+
+
+def test_split():
+    assert cuav_stripe.split(10000, [1, 1]) == [5000, 5000]
+    assert cuav_stripe.split(10001, [3, 1]) == [7501, 2500]
+    assert sum(cuav_stripe.split(12345, [7, 3, 5])) == 12345
+    # a link whose share would be too small gets nothing
+    assert cuav_stripe.split(10000, [100, 1]) == [10000, 0]
+    assert sorted(cuav_stripe.split(900, [1, 1])) == [0, 900]
+    assert cuav_stripe.split(3000, [0, 1, 2]) == [0, 1000, 2000]
+    assert cuav_stripe.split(3000, [0, 0]) == [0, 0]
+
+def test_assemble():
+    buf = bytes(os.urandom(10000))
+    frags = cuav_stripe.fragments(1, buf, [2500, 0, 7500])
+    assert frags[1] is None
+    assert [f.index for f in frags if f is not None] == [0, 1]
+    a = cuav_stripe.StripeAssembler(max_age=10)
+    assert a.add(frags[2], 100) is None
+    assert a.add(frags[2], 100) is None
+    assert a.add(frags[0], 101) == buf
+    assert a.completed == 1
+    assert len(a.partial) == 0
+
+    # fragments that never complete are dropped
+    frags = cuav_stripe.fragments(2, buf, [5000, 5000])
+    assert a.add(frags[0], 200) is None
+    assert a.add(frags[1], 211) is None
+    assert a.expired == 1
+    assert len(a.partial) == 1
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+'''
+test program for cuav_track
+'''
+
+import sys, os, time
+import pytest
+from cuav.lib import cuav_track, cuav_region, cuav_util
+
+
+def make_region(lat, lon, score):
+    r = cuav_region.Region(10, 10, 25, 23, None, scan_score=450)
+    r.latlon = (lat, lon)
+    r.score = score
+    return r
+
+def test_TargetTracker():
+    tracker = cuav_track.TargetTracker(radius=30, window=60)
+    (lat, lon) = (-35.3630, 149.1650)
+    # first sighting is sent
+    (send, hits, tracks) = tracker.update(1000.0, [make_region(lat, lon, 500)])
+    assert len(send) == 1 and hits == [1]
+    track_id = tracks[0]
+    # a nearby worse detection is suppressed
+    (lat2, lon2) = cuav_util.gps_newpos(lat, lon, 90, 10)
+    (send, hits, tracks) = tracker.update(1001.0, [make_region(lat2, lon2, 400)])
+    assert send == [] and tracker.suppressed == 1
+    # a better one is sent with the hit count
+    (send, hits, tracks) = tracker.update(1002.0, [make_region(lat2, lon2, 800)])
+    assert len(send) == 1 and hits == [3] and tracks == [track_id]
+    # a separate target is sent
+    (lat3, lon3) = cuav_util.gps_newpos(lat, lon, 0, 100)
+    (send, hits, tracks) = tracker.update(1003.0, [make_region(lat3, lon3, 100)])
+    assert len(send) == 1 and hits == [1] and tracks == [track_id + 1]
+    assert len(tracker.clusters) == 2
+    # targets are forgotten after the window
+    (send, hits, tracks) = tracker.update(1100.0, [make_region(lat, lon, 100)])
+    assert len(send) == 1 and hits == [1]
+    assert len(tracker.clusters) == 1
+
+def test_TargetTracker_untracked():
+    tracker = cuav_track.TargetTracker(radius=30, window=60)
+    r = make_region(-35.3630, 149.1650, 500)
+    r.latlon = None
+    for i in range(3):
+        (send, hits, tracks) = tracker.update(1000.0 + i, [r])
+        assert send == [r] and tracks == [None]
+    tracker.radius = 0
+    r = make_region(-35.3630, 149.1650, 500)
+    for i in range(3):
+        (send, hits, tracks) = tracker.update(1000.0 + i, [r])
+        assert send == [r]
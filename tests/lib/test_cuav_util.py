@@ -212,6 +212,12 @@ def test_SubImage():
     region = (-20, 55, 100, 100)
     subimage = SubImage(img, region)
     assert subimage.shape == (100, 100, 3)
+
+    dest = numpy.zeros((100, 100, 3), dtype=img.dtype)
+    subimage = SubImage(img, region, dest=dest)
+    assert subimage is dest
+    assert (dest[:, 20:] == img[55:155, 0:80]).all()
+    assert (dest[:, :20] == 0).all()
     
 def test_OverlayImage():
     img = cv2.imread(os.path.join(os.getcwd(), 'tests', 'testdata', 'raw2016111223465120Z.png'))
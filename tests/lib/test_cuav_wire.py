@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+'''
+test program for cuav_wire
+'''
+
+import sys, os, time, cPickle
+import pytest
+import numpy, cv2
+from cuav.lib import cuav_wire, cuav_command, cuav_region, mav_position
+
+
+def make_thumb_packet(nregions=4):
+    '''a ThumbPacket like camera_air sends'''
+    regions = []
+    for i in range(nregions):
+        r = cuav_region.Region(numpy.int64(100+i), 200, 110+i, 212, (1280, 960), scan_score=0.5+i)
+        r.latlon = (-35.1+i*1.0e-4, 149.2)
+        r.score = 430+i
+        r.whiteness = 0.3
+        # extra scores that are not sent
+        r.hsv_score = 1.2
+        r.col_score = 4.5
+        regions.append(r)
+    regions[0].latlon = None
+    regions[0].whiteness = None
+    pos = mav_position.MavPosition(-35.1, 149.2, 100.5, 1.0, 2.0, 3.0, 1000.0)
+    img = numpy.zeros((32, 32*nregions, 3), dtype=numpy.uint8)
+    cv2.circle(img, (16, 16), 8, (255, 255, 255), -1)
+    (result, thumb) = cv2.imencode('.jpg', img, [int(cv2.IMWRITE_JPEG_QUALITY), 75])
+    tracks = [None] + [(1476 << 16) + i for i in range(1, nregions)]
+    pkt = cuav_command.ThumbPacket(1000.0, regions, thumb, pos, [1, 2, 3, 4][:nregions], tracks)
+    for stage in ['capture', 'decode', 'scan', 'encode', 'handoff']:
+        pkt.stamp(stage)
+    return pkt
+
+def test_thumb_packet():
+    pkt = make_thumb_packet()
+    pkt.blockid = 7
+    buf = cuav_wire.encode(pkt)
+    obj = cuav_wire.decode(buf)
+    assert isinstance(obj, cuav_command.ThumbPacket)
+    assert obj.timestamp == pkt.timestamp
+    assert obj.stamps == pkt.stamps
+    assert obj.blockid is None
+    assert obj.frame_time == pkt.frame_time
+    assert obj.hits == pkt.hits
+    assert obj.tracks == pkt.tracks
+    assert numpy.array_equal(obj.thumb, pkt.thumb)
+    assert obj.thumb.dtype == pkt.thumb.dtype
+    assert obj.pos.__dict__ == pkt.pos.__dict__
+    assert len(obj.regions) == len(pkt.regions)
+    for (r1, r2) in zip(obj.regions, pkt.regions):
+        assert isinstance(r1, cuav_region.Region)
+        assert r1.tuple() == r2.tuple()
+        assert r1.latlon == r2.latlon
+        assert r1.score == r2.score
+        assert r1.scan_score == r2.scan_score
+        assert r1.whiteness == r2.whiteness
+        assert r1.scan_shape == r2.scan_shape
+        assert not hasattr(r1, 'hsv_score')
+    assert obj.regions[0].latlon is None
+
+    # smaller than a pickle
+    assert len(buf) < len(cPickle.dumps(pkt, cPickle.HIGHEST_PROTOCOL)) - 500
+
+def test_commands():
+    report = cuav_command.PerfReport(5.5, {'scan': 1}, {'scan': 0.25}, 50.0, None, 100.0, None,
+                                     [(0, 1000.0, 0.9, 0.2)])
+    pkts = [cuav_command.ImagePacket(1000.0, numpy.arange(100, dtype=numpy.uint8), None, 10000),
+            cuav_command.CommandPacket('status'),
+            cuav_command.CommandResponse('x' * 1000),
+            cuav_command.ImageRequest(1000.0, True),
+            cuav_command.HeartBeat(),
+            cuav_command.CameraMessage(u'caf\xe9'),
+            cuav_command.ChangeCameraSetting('minscore', 50),
+            cuav_command.ChangeImageSetting('MinRegionArea', 0.5),
+            report,
+            cuav_command.StripePacket((1000.5, 3), 1, 2, 5000, 2500, 'y' * 2500),
+            cuav_command.BlockCancel((1000.5, 12))]
+    for pkt in pkts:
+        obj = cuav_wire.decode(cuav_wire.encode(pkt))
+        assert obj.__class__ is pkt.__class__
+        for (k, v) in pkt.__dict__.items():
+            if isinstance(v, numpy.ndarray):
+                assert numpy.array_equal(getattr(obj, k), v)
+            elif k != 'blockid' or isinstance(pkt, cuav_command.BlockCancel):
+                assert getattr(obj, k) == v
+    assert str(cuav_wire.decode(cuav_wire.encode(report))) == str(report)
+
+def test_errors():
+    class Unknown:
+        pass
+    with pytest.raises(cuav_wire.WireError):
+        cuav_wire.encode(Unknown())
+    with pytest.raises(cuav_wire.WireError):
+        cuav_wire.encode(cuav_command.CameraMessage(Unknown()))
+    pkt = cuav_command.HeartBeat()
+    pkt.stamp('unknown')
+    with pytest.raises(cuav_wire.WireError):
+        cuav_wire.encode(pkt)
+
+    buf = cuav_wire.encode(make_thumb_packet())
+    # truncated, other versions, unknown types and pickles are all rejected
+    for bad in [buf[:len(buf)//2], buf + 'x', buf[:2] + chr(cuav_wire.VERSION+1) + buf[3:],
+                buf[:3] + chr(200) + buf[4:], '',
+                cPickle.dumps(cuav_command.HeartBeat(), cPickle.HIGHEST_PROTOCOL)]:
+        with pytest.raises(cuav_wire.WireError):
+            cuav_wire.decode(bad)
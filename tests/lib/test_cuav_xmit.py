@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+'''
+test program for cuav_xmit
+'''
+
+import sys, os, time, random, functools
+import pytest
+from cuav.lib import cuav_xmit, block_xmit, cuav_region
+
+
+def test_QualityController():
+    bsend = block_xmit.BlockSender(dest_ip='127.0.0.1', bandwidth=1000)
+    ctl = cuav_xmit.QualityController(bsend, target_latency=5.0, min_quality=30, min_scale=0.5)
+    assert ctl.quality(90) == 90
+    assert ctl.scale() == 1.0
+    assert ctl.latency() == 0
+
+    # a backed up link lowers quality, then thumbnail scale
+    for i in range(10):
+        bsend.send(bytes(os.urandom(5000)))
+        ctl.record_send(5000)
+    assert ctl.latency() == 50.0
+    tnow = 1000
+    ctl.update(tnow)
+    assert ctl.quality(90) < 90
+    assert ctl.scale() == 1.0
+    for i in range(10):
+        tnow += 1
+        ctl.update(tnow)
+    assert ctl.quality(90) == 30
+    assert ctl.scale() < 1.0
+    assert ctl.scale() >= 0.5
+
+    # updates are rate limited
+    level = ctl.level
+    ctl.update(tnow + 0.1)
+    assert ctl.level == level
+
+    # and it recovers once the queue drains
+    bsend.outgoing = []
+    for i in range(30):
+        tnow += 1
+        ctl.update(tnow)
+    assert ctl.quality(90) == 90
+    assert ctl.scale() == 1.0
+
+def test_TransmitScheduler_priority():
+    sched = cuav_xmit.TransmitScheduler()
+    low = cuav_region.Region(10, 10, 25, 23, None, scan_score=450)
+    low.score = 100
+    high = cuav_region.Region(10, 10, 25, 23, None, scan_score=450)
+    high.score = 2000
+    p_low = sched.priority(1000.0, [low])
+    p_high = sched.priority(1000.0, [high])
+    assert 0 < p_low < p_high < 10000
+    assert sched.priority(1000.0, [low, high]) == p_high
+
+    # older frames go after newer ones
+    sched.priority(1120.0, [high])
+    assert sched.priority(1000.0, [high]) < p_high / 2
+
+    # closer to the target goes first
+    sched = cuav_xmit.TransmitScheduler()
+    near = cuav_region.Region(10, 10, 25, 23, None, scan_score=450)
+    near.score = 100
+    near.latlon = (-35.3630, 149.1650)
+    far = cuav_region.Region(10, 10, 25, 23, None, scan_score=450)
+    far.score = 100
+    far.latlon = (-35.3730, 149.1650)
+    target = (-35.3632, 149.1652, 0)
+    assert sched.priority(1000.0, [near], target) > sched.priority(1000.0, [far], target)
+
+def test_TransmitScheduler_make_room():
+    bsend = block_xmit.BlockSender(dest_ip='127.0.0.1')
+    sched = cuav_xmit.TransmitScheduler()
+    for priority in [50, 20, 70]:
+        blockid = bsend.send(bytes(os.urandom(100)), priority=priority)
+        sched.sent(bsend, blockid, priority)
+    assert not sched.make_room(bsend, 10)
+    assert bsend.sendq_size() == 3
+    assert sched.make_room(bsend, 30)
+    assert bsend.sendq_size() == 2
+    assert [blk.priority for blk in bsend.outgoing] == [70, 50]
+    assert sched.dropped == 2
@@ -7,13 +7,13 @@ import sys
 import pytest
 import os
 import mock
-import threading, time, cPickle
+import threading, time
 
 #for generating mocked mavlink messages
 from pymavlink.dialects.v20 import common
 
 import cuav.modules.camera_air as camera_air
-from cuav.lib import block_xmit, cuav_command, cuav_util
+from cuav.lib import block_xmit, cuav_command, cuav_util, cuav_stripe, cuav_wire
 
 @pytest.fixture
 def mpstate():
@@ -103,8 +103,8 @@ def test_camera_start(mpstate, image_file):
     #get the sent data
     b2.tick()
     b1.tick()
-    blk1 = cPickle.loads(str(b1.recv(0.1)))
-    blk2 = cPickle.loads(str(b2.recv(0.1)))
+    blk1 = cuav_wire.decode(str(b1.recv(0.1)))
+    blk2 = cuav_wire.decode(str(b2.recv(0.1)))
     time.sleep(0.05)
     loadedModule.cmd_camera(["status"])
     loadedModule.cmd_camera(["stop"])
@@ -119,6 +119,68 @@ def test_camera_start(mpstate, image_file):
     assert abs(blk1.timestamp - blk2.timestamp) < 0.01
     #assert loadedModule.xmit_queue == [0, 0]
 
+def test_camera_stripe(mpstate, image_file):
+    '''thumbnails striped across two links are reassembled'''
+    loadedModule = camera_air.init(mpstate)
+    parms = "/data/ChameleonArecort/params.json"
+    loadedModule.cmd_camera(["set", "camparms", parms])
+    loadedModule.cmd_camera(["set", "imagefile", image_file])
+    loadedModule.cmd_camera(["set", "minscore", "0"])
+    loadedModule.cmd_camera(["set", "xmit_stripe", "1"])
+    loadedModule.cmd_camera(["set", "gcs_address", "127.0.0.1:14550:14560:90000, 127.0.0.1:14650:14660:150000"])
+
+    b1 = block_xmit.BlockSender(dest_ip='127.0.0.1', port = 14550, dest_port = 14560)
+    b2 = block_xmit.BlockSender(dest_ip='127.0.0.1', port = 14650, dest_port = 14660)
+
+    capture_thread = sim_camera()
+    time.sleep(0.05)
+    loadedModule.cmd_camera(["start"])
+    # links are only striped across once they have heard from the ground
+    for b in [b1, b2]:
+        b.send(cuav_wire.encode(cuav_command.HeartBeat()))
+    assembler = cuav_stripe.StripeAssembler()
+    fragments = [0, 0]
+    thumbs = []
+    t0 = time.time()
+    while len(thumbs) == 0 and time.time() - t0 < 3:
+        for (i, b) in enumerate([b1, b2]):
+            b.tick()
+            buf = b.recv(0.01)
+            if buf is None:
+                continue
+            obj = cuav_wire.decode(str(buf))
+            if isinstance(obj, cuav_command.StripePacket):
+                fragments[i] += 1
+                buf = assembler.add(obj)
+                if buf is not None:
+                    obj = cuav_wire.decode(buf)
+            if isinstance(obj, cuav_command.ThumbPacket):
+                thumbs.append(obj)
+    loadedModule.cmd_camera(["stop"])
+    loadedModule.unload()
+    capture_thread.join(1.0)
+
+    assert fragments[0] > 0 and fragments[1] > 0
+    assert len(thumbs) > 0
+    assert thumbs[0].thumb is not None
+
+def test_stripe_full_links(mpstate):
+    '''room is made once per full link, whether or not the object is striped'''
+    import numpy
+    loadedModule = camera_air.init(mpstate)
+    loadedModule.cmd_camera(["set", "xmit_stripe", "1"])
+    links = [mock.Mock(), mock.Mock()]
+    for bsnd in links:
+        bsnd.sendq_size.return_value = loadedModule.camera_settings.maxqueue
+        bsnd.get_send_rate.return_value = 0
+    loadedModule.bsend = links
+    loadedModule.scheduler.make_room = mock.Mock(return_value=False)
+    thumb = cuav_command.ThumbPacket(1000.0, [], numpy.zeros((10, 10, 3), numpy.uint8), None)
+    loadedModule.send_object(thumb, priority=100)
+    loadedModule.unload()
+    assert loadedModule.scheduler.make_room.call_count == 2
+    assert not links[0].send.called and not links[1].send.called
+
 def test_camera_command(mpstate, image_file):
     '''send some commands via the block_xmit'''
     loadedModule = camera_air.init(mpstate)
@@ -130,7 +192,7 @@ def test_camera_command(mpstate, image_file):
 
     pkt = cuav_command.ChangeCameraSetting("minscore", 50)
     b1 = block_xmit.BlockSender(dest_ip='127.0.0.1', port = 14550, dest_port = 14560)
-    buf = cPickle.dumps(pkt, cPickle.HIGHEST_PROTOCOL)
+    buf = cuav_wire.encode(pkt)
 
     loadedModule.cmd_camera(["start"])
     time.sleep(0.1)
@@ -143,18 +205,20 @@ def test_camera_command(mpstate, image_file):
 
     assert loadedModule.camera_settings.minscore == 50
 
-def test_camera_image_request(mpstate, image_file):
-    '''image request via the block_xmit'''
+@pytest.mark.parametrize("batch", [0, 32])
+def test_camera_image_request(mpstate, image_file, batch):
+    '''image request via the block_xmit, with and without batching'''
     loadedModule = camera_air.init(mpstate)
     parms = "/data/ChameleonArecort/params.json"
     loadedModule.cmd_camera(["set", "camparms", parms])
     loadedModule.cmd_camera(["set", "imagefile", image_file])
     loadedModule.cmd_camera(["set", "minscore", "0"])
     loadedModule.cmd_camera(["set", "gcs_address", "127.0.0.1:14550:14560:2000000"])
+    loadedModule.cmd_camera(["set", "xmit_batch", str(batch)])
 
     filename = os.path.join(os.getcwd(), 'tests', 'testdata', 'raw2016111223465160Z.png')
     pkt = cuav_command.ImageRequest(cuav_util.parse_frame_time(filename), True)
-    buf = cPickle.dumps(pkt, cPickle.HIGHEST_PROTOCOL)
+    buf = cuav_wire.encode(pkt)
 
     capture_thread = sim_camera()
     time.sleep(0.05)
@@ -163,7 +227,7 @@ def test_camera_image_request(mpstate, image_file):
     loadedModule.cmd_camera(["status"])
 
     #don't load the block xmit until afterwards
-    b1 = block_xmit.BlockSender(dest_ip='127.0.0.1', port = 14550, dest_port = 14560)
+    b1 = block_xmit.BlockSender(dest_ip='127.0.0.1', port = 14550, dest_port = 14560, batch=batch)
     b1.tick()
     b1.send(buf)
     #b1.tick()
@@ -172,13 +236,13 @@ def test_camera_image_request(mpstate, image_file):
     while True:
         try:
             b1.tick()
-            blk = cPickle.loads(str(b1.recv(0.01, True)))
+            blk = cuav_wire.decode(str(b1.recv(0.01, True)))
             #only want paricular packets - discard all the heartbeats, etc
             if isinstance(blk, cuav_command.ImagePacket):
                 blkret.append(blk)
                 break
             time.sleep(0.05)
-        except cPickle.UnpicklingError:
+        except cuav_wire.WireError:
             continue
 
     loadedModule.cmd_camera(["stop"])
@@ -190,6 +254,19 @@ def test_camera_image_request(mpstate, image_file):
     assert isinstance(blkret[0], cuav_command.ImagePacket)
     assert blkret[0].jpeg is not None
 
+def test_image_request_unreadable(mpstate, tmpdir):
+    '''a requested image that can't be loaded is not sent'''
+    loadedModule = camera_air.init(mpstate)
+    filename = os.path.join(str(tmpdir), 'raw2016111223465160Z.png')
+    with open(filename, 'w') as f:
+        f.write('not an image')
+    frame_time = cuav_util.parse_frame_time(filename)
+    loadedModule.images.add(frame_time, filename)
+    loadedModule.send_image = mock.Mock()
+    loadedModule.handle_image_request(cuav_command.ImageRequest(frame_time, False), None)
+    loadedModule.unload()
+    assert not loadedModule.send_image.called
+
 def test_camera_airstart(mpstate, image_file):
     '''test the airstart - that cauv auto starts after vehicle has taken off'''
     loadedModule = camera_air.init(mpstate)
@@ -216,11 +293,11 @@ def test_camera_airstart(mpstate, image_file):
     while True:
         try:
             b1.tick()
-            blk = cPickle.loads(str(b1.recv(0.01, True)))
+            blk = cuav_wire.decode(str(b1.recv(0.01, True)))
             if isinstance(blk, cuav_command.CommandResponse) or isinstance(blk, cuav_command.CameraMessage):
                 blkret.append(blk)
             time.sleep(0.05)
-        except cPickle.UnpicklingError:
+        except cuav_wire.WireError:
             break
     loadedModule.cmd_camera(["stop"])
     loadedModule.unload()
@@ -229,3 +306,101 @@ def test_camera_airstart(mpstate, image_file):
     assert blkret[0].msg == "cuav airstart ready"
     assert blkret[1].msg == "Started cuav running"
 
+
+@pytest.mark.parametrize("rotate180", [False, True])
+def test_camera_shmring(mpstate, tmpdir, rotate180):
+    '''pass frames to the module through a shared memory ring'''
+    import cv2
+    from cuav.lib import cuav_shmring
+    ringfile = os.path.join(str(tmpdir), 'ring')
+    ring = cuav_shmring.FrameRingWriter(ringfile, num_slots=4, slot_size=1280*960*3)
+    loadedModule = camera_air.init(mpstate)
+    loadedModule.cmd_camera(["set", "camparms", "/data/ChameleonArecort/params.json"])
+    loadedModule.cmd_camera(["set", "shmring", ringfile])
+    loadedModule.cmd_camera(["set", "minscore", "0"])
+    loadedModule.cmd_camera(["set", "rotate180", str(rotate180)])
+    loadedModule.cmd_camera(["set", "gcs_address", "127.0.0.1:14750:14760:9000"])
+    imagefile = os.path.join(str(tmpdir), 'curcam.png')
+    stopfile = imagefile + '.stop'
+    open(stopfile, 'w').close()
+    loadedModule.cmd_camera(["set", "imagefile", imagefile])
+    loadedModule.cmd_camera(["start"])
+    time.sleep(0.2)
+    # the stopfile is removed while armed, as when capturing from files
+    assert not os.path.exists(stopfile)
+    for name in ['raw2016111223465120Z.png', 'raw2016111223465160Z.png', 'raw2016111223465213Z.png']:
+        filename = os.path.join(os.getcwd(), 'tests', 'testdata', name)
+        ring.write(cuav_util.parse_frame_time(filename), cv2.imread(filename), filename)
+        time.sleep(0.2)
+    time.sleep(0.5)
+    loadedModule.cmd_camera(["stop"])
+    loadedModule.unload()
+    ring.close()
+
+    assert loadedModule.capture_count == 3
+    assert loadedModule.scan_count == 3
+    assert loadedModule.region_count > 0
+    # the stages are on the local clock, not that of the 2016 frame times
+    for ((kind, stage), hist) in loadedModule.perf_latency.histograms.items():
+        assert hist.max < 60
+    frame_time = cuav_util.parse_frame_time('raw2016111223465160Z.png')
+    assert loadedModule.frames.get(frame_time, 'filename').endswith('raw2016111223465160Z.png')
+
+def test_perf_report(mpstate):
+    '''build a performance report'''
+    loadedModule = camera_air.init(mpstate)
+    loadedModule.scan_count = 10
+    loadedModule.perf_latency.add('frame', {'capture': 100.0, 'decode': 100.5, 'scan': 100.7})
+    time.sleep(0.1)
+    report = loadedModule.perf_report()
+    loadedModule.unload()
+    assert isinstance(report, cuav_command.PerfReport)
+    assert report.scan_fps > 0
+    assert report.queues == {'scan': 0, 'decode': 0, 'transmit': 0}
+    assert report.latencies['scan'] == pytest.approx(0.2)
+    assert report.links == []
+    assert 'queues decode=0 scan=0 transmit=0' in str(report)
+    report = cuav_wire.decode(cuav_wire.encode(report))
+    assert report.latencies['decode'] == pytest.approx(0.5)
+
+def test_camera_profile(mpstate, image_file, tmpdir):
+    '''profile the module threads'''
+    loadedModule = camera_air.init(mpstate)
+    imagefile = os.path.join(str(tmpdir), 'capture.jpg')
+    loadedModule.cmd_camera(["set", "imagefile", imagefile])
+    loadedModule.cmd_camera(["profile", "0.2", "5"])
+    loadedModule.profiler.thread.join(2.0)
+    loadedModule.unload()
+    profiles = [f for f in os.listdir(str(tmpdir)) if f.startswith('profile_air_')]
+    assert len(profiles) == 1
+    msgs = []
+    while not loadedModule.transmit_queue.empty():
+        (pkt, priority, linktosend) = loadedModule.transmit_queue.get()
+        if isinstance(pkt, cuav_command.CameraMessage):
+            msgs.append(pkt.msg)
+    assert msgs[0].startswith('Profile of ')
+    assert msgs[1].startswith('Profile top 5:')
+
+def test_camera_scan_reduce(tmpdir):
+    '''scan JPEGs at reduced size, with regions and thumbnails at full resolution'''
+    import cv2
+    from cuav.lib import cuav_jpeg
+    from cuav.tools import replay_air, playback
+    images = []
+    for name in ['raw2016111223465120Z', 'raw2016111223465160Z', 'raw2016111223465213Z']:
+        img = cv2.imread(os.path.join(os.getcwd(), 'tests', 'testdata', name + '.png'))
+        cv2.rectangle(img, (200, 700), (212, 712), (255, 0, 0), -1)
+        filename = str(tmpdir.join(name + '.jpg'))
+        cv2.imwrite(filename, img, [cv2.IMWRITE_JPEG_RST_INTERVAL, cuav_jpeg.restart_interval(img.shape[1])])
+        images.append(playback.ImageFile(cuav_util.parse_frame_time(filename), filename))
+    logfile = os.path.join(os.getcwd(), 'tests', 'testdata', 'flight.tlog')
+    settings = [('minscore', 0), ('RegionHue', 0)]
+    full = replay_air.replay(logfile, images, 'data/ChameleonArecort/params.json', str(tmpdir), settings)
+    result = replay_air.replay(logfile, images, 'data/ChameleonArecort/params.json', str(tmpdir),
+                               settings + [('scan_reduce', 2)])
+    assert result.scanned == 3
+    assert result.errors == 0
+    assert len(result.regions) > 0
+    # the target is found in the same place as at full resolution
+    (frame_time, latlon, score, hits) = result.regions[0]
+    assert min([cuav_util.gps_distance(latlon[0], latlon[1], r[1][0], r[1][1]) for r in full.regions]) < 2
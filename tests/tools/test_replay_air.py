@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+'''Test replay of a log and images through camera_air
+'''
+
+import sys
+import pytest
+import os
+import cuav.tools.replay_air as replay_air
+from cuav.tools import playback
+from cuav.lib import cuav_util
+
+
+def replay_images():
+    images = []
+    for name in ['raw2016111223465120Z.png', 'raw2016111223465160Z.png', 'raw2016111223465213Z.png']:
+        filename = os.path.join(os.getcwd(), 'tests', 'testdata', name)
+        images.append(playback.ImageFile(cuav_util.parse_frame_time(filename), filename))
+    return images
+
+def test_replay(tmpdir):
+    logfile = os.path.join(os.getcwd(), 'tests', 'testdata', 'flight.tlog')
+    settings = [('minscore', 0), ('RegionHue', 0)]
+    result = replay_air.replay(logfile, replay_images(), 'data/ChameleonArecort/params.json',
+                               str(tmpdir), settings)
+    assert result.frames == 3
+    assert result.scanned == 3
+    assert result.errors == 0
+    assert result.fps() > 0
+    assert result.latency.histogram('frame', 'scan').count == 3
+    assert result.latency.histogram('frame', 'total').count == 3
+    assert len(result.regions) > 0
+    for (frame_time, latlon, score, hits) in result.regions:
+        assert latlon is not None
+
+    # the same log and images give the same regions
+    again = replay_air.replay(logfile, replay_images(), 'data/ChameleonArecort/params.json',
+                              str(tmpdir), settings)
+    assert again.regions == result.regions
+
+    regionfile = str(tmpdir.join('regions.txt'))
+    result.write_regions(regionfile)
+    assert len(open(regionfile).readlines()) == len(result.regions)
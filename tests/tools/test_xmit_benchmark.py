@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+
+'''Test transmit loop benchmark
+'''
+
+import sys
+import pytest
+import os
+import cuav.tools.xmit_benchmark as xmit_benchmark
+
+
+def test_xmit_benchmark():
+    (poll_mean, poll_max, poll_cpu) = xmit_benchmark.run('poll', count=3, idle_time=0.2)
+    (event_mean, event_max, event_cpu) = xmit_benchmark.run('event', count=3, idle_time=0.2)
+    assert poll_mean is not None
+    assert event_mean is not None
+    # the timings depend on the machine's load, so are only reported. The
+    # wakeup behaviour is tested in tests/lib/test_cuav_event.py
+    print('poll latency mean %.1fms, event latency mean %.1fms' % (poll_mean*1000, event_mean*1000))